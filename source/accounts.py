@@ -0,0 +1,307 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import os
+
+from telethon.errors import FloodWaitError
+
+from rate_limiter import RateLimiter
+
+
+def load_accounts(args_dict, session='/data/collector_local'):
+    """
+    Retorna as contas usadas na coleta: a lista "accounts" da configuração
+    (ou o arquivo json indicado por ela), em que cada conta tem "session",
+    "api_id" e "api_hash", ou a conta única dada por api_id e api_hash.
+
+    Parâmetros
+    ------------
+        args_dict : dict
+            Argumentos de linha de comando e de configuração.
+        session : str
+            Sessão da conta única.
+    """
+    accounts = args_dict.get("accounts")
+    if isinstance(accounts, str):
+        with open(accounts) as json_file:
+            accounts = json.load(json_file)
+    if not accounts:
+        accounts = [{"session": session, "api_id": args_dict["api_id"],
+                     "api_hash": args_dict["api_hash"]}]
+    return accounts
+
+
+def rank_accounts(key, sessions):
+    """
+    Ordena as contas pela preferência para coletar um grupo (rendezvous
+    hashing). A ordem de cada grupo é estável entre execuções e só muda
+    para os grupos da conta que entra ou sai da lista.
+
+    Parâmetros
+    ------------
+        key : object
+            Identificador do grupo.
+        sessions : list
+            Sessões das contas.
+    """
+    def weight(index):
+        value = '%s:%s' % (key, sessions[index])
+        return hashlib.md5(value.encode('utf-8')).digest()
+    return sorted(range(len(sessions)), key=weight, reverse=True)
+
+
+class AccountOwners():
+    """
+    Guarda, entre execuções, a conta que coleta cada grupo básico. Nos
+    grupos básicos os ids das mensagens são próprios de cada conta, de modo
+    que as marcas e os ids já coletados de um grupo só valem para a conta
+    que o coletou.
+
+    Atributos
+    -----------
+    path : str
+            Caminho do arquivo json com a sessão da conta de cada grupo.
+
+    Métodos
+    -----------
+    get(key)
+        Retorna a sessão da conta do grupo (ou None).
+    set(key, session)
+        Atualiza a conta do grupo.
+    save()
+        Escreve as contas em disco de forma atômica.
+    """
+
+    def __init__(self, path='/data/account_owners.json'):
+        self.path = path
+        self.owners = dict()
+        if os.path.isfile(path):
+            with open(path, 'r') as json_file:
+                self.owners = json.load(json_file)
+
+    def get(self, key):
+        return self.owners.get(str(key))
+
+    def set(self, key, session):
+        self.owners[str(key)] = session
+
+    def save(self):
+        with open(self.path + '.temp', 'w') as json_file:
+            json.dump(self.owners, json_file)
+        os.replace(self.path + '.temp', self.path)
+
+
+class AccountPool():
+    """
+    Conjunto de contas (sessões) usadas em uma coleta dividida. Cada grupo
+    é atribuído a uma das contas que participam dele por rendezvous
+    hashing; quando essa conta está bloqueada por um FloodWait, o grupo
+    passa para a próxima conta na ordem de preferência. Cada conta tem seu
+    próprio limitador de requisições e seu próprio limite de grupos
+    coletados simultaneamente.
+
+    Atributos
+    -----------
+    accounts : list
+            Contas, com "session", "api_id" e "api_hash".
+    client_class : type
+            Classe do cliente do Telegram (substituível em testes).
+    limiters : list
+            Limitador de requisições de cada conta.
+    max_concurrent : int
+            Número máximo de grupos coletados simultaneamente por conta.
+    rebalance_wait : float
+            Espera restante (em segundos) a partir da qual uma conta
+            bloqueada cede seus grupos para outra.
+    owners : AccountOwners
+            Conta de cada grupo básico, mantida entre execuções (ou None).
+
+    Métodos
+    -----------
+    connect(**client_kwargs)
+        Conecta todas as contas.
+    list_dialogs(accept)
+        Lista os grupos de todas as contas.
+    pick(key, candidates, rebalance)
+        Escolhe a conta que coleta um grupo.
+    owner(key, candidates, collected)
+        Retorna a conta fixa de um grupo básico.
+    assign(key, candidates, rebalance)
+        Reserva a conta que coleta um grupo.
+    run(key, candidates, function, rebalance)
+        Coleta um grupo, trocando de conta após FloodWaits longos.
+    """
+
+    def __init__(self, accounts, client_class, limiter_args=None,
+                 max_concurrent=1, rebalance_wait=30.0, owners=None):
+        self.accounts = accounts
+        self.sessions = [account["session"] for account in accounts]
+        self.client_class = client_class
+        self.limiters = [RateLimiter(**(limiter_args or {})) for _ in accounts]
+        self.max_concurrent = max(1, max_concurrent)
+        self.rebalance_wait = rebalance_wait
+        self.owners = owners
+        self.semaphores = None
+        self.clients = list()
+
+    @contextlib.asynccontextmanager
+    async def connect(self, **client_kwargs):
+        """
+        Conecta todas as contas e as desconecta ao final do bloco.
+        """
+        async with contextlib.AsyncExitStack() as stack:
+            self.clients = list()
+            for account in self.accounts:
+                client = self.client_class(account["session"], account["api_id"],
+                                           account["api_hash"], **client_kwargs)
+                self.clients.append(await stack.enter_async_context(client))
+            try:
+                yield self.clients
+            finally:
+                self.clients = list()
+
+    async def _get_dialogs(self, client):
+        return [dialog async for dialog in client.iter_dialogs()]
+
+    async def list_dialogs(self, accept):
+        """
+        Lista os grupos de todas as contas. Retorna um dicionário, indexado
+        pelo id do grupo, com o diálogo de cada conta que participa dele.
+
+        Parâmetros
+        ------------
+            accept : callable
+                Filtro dos diálogos a coletar.
+        """
+        dialogs = dict()
+        for index, client in enumerate(self.clients):
+            for dialog in await self.limiters[index].call(self._get_dialogs, client):
+                if accept(dialog):
+                    dialogs.setdefault(abs(dialog.id), dict())[index] = dialog
+        return dialogs
+
+    def pick(self, key, candidates, rebalance=True):
+        """
+        Escolhe a conta que coleta o grupo: a preferida entre as que
+        participam dele ou, com rebalanceamento, a primeira que não está
+        bloqueada por um FloodWait longo (ou a que será liberada antes).
+
+        Parâmetros
+        ------------
+            key : object
+                Identificador do grupo.
+            candidates : dict
+                Diálogo do grupo em cada conta que participa dele.
+            rebalance : bool
+                Se o grupo pode ser coletado por outra conta.
+        """
+        ranked = [index for index in rank_accounts(key, self.sessions)
+                  if index in candidates]
+        if not rebalance:
+            return ranked[0]
+        for index in ranked:
+            if self.limiters[index].blocked_for() <= self.rebalance_wait:
+                return index
+        return min(ranked, key=lambda index: self.limiters[index].blocked_for())
+
+    def owner(self, key, candidates, collected=False):
+        """
+        Retorna a conta de um grupo básico: a registrada em uma execução
+        anterior ou, na primeira vez, a preferida entre as que participam
+        dele, que passa a ser registrada. Retorna None se a conta registrada
+        não participa mais do grupo ou saiu da lista de contas, já que outra
+        conta vê ids diferentes para as mesmas mensagens.
+
+        Parâmetros
+        ------------
+            key : object
+                Identificador do grupo.
+            candidates : dict
+                Diálogo do grupo em cada conta que participa dele.
+            collected : bool
+                Se o grupo já foi coletado antes de existir o registro. Nesse
+                caso a conta registrada é a primeira da lista, a única das
+                coletas com uma só conta.
+        """
+        if self.owners is None:
+            return self.pick(key, candidates, rebalance=False)
+        session = self.owners.get(key)
+        if session is None:
+            if collected and 0 in candidates:
+                index = 0
+            else:
+                index = self.pick(key, candidates, rebalance=False)
+            self.owners.set(key, self.sessions[index])
+            return index
+        if session in self.sessions and self.sessions.index(session) in candidates:
+            return self.sessions.index(session)
+        return None
+
+    @contextlib.asynccontextmanager
+    async def assign(self, key, candidates, rebalance=True):
+        """
+        Escolhe a conta que coleta o grupo e ocupa uma das suas vagas de
+        coleta simultânea durante o bloco. A escolha é refeita após a
+        espera pela vaga, pois a conta pode ter sido bloqueada nesse tempo.
+        """
+        while True:
+            index = self.pick(key, candidates, rebalance)
+            async with self.semaphore(index):
+                if self.pick(key, candidates, rebalance) != index:
+                    continue
+                yield index
+                return
+
+    async def run(self, key, candidates, function, rebalance=True):
+        """
+        Executa a corotina retornada por function(index) com a conta
+        atribuída ao grupo. Após um FloodWaitError a coleta é repetida (a
+        função deve poder ser repetida), por outra conta caso a espera
+        ultrapasse rebalance_wait.
+
+        Parâmetros
+        ------------
+            key : object
+                Identificador do grupo.
+            candidates : dict
+                Diálogo do grupo em cada conta que participa dele.
+            function : callable
+                Função que recebe o índice da conta e retorna a corotina.
+            rebalance : bool
+                Se o grupo pode ser coletado por outra conta.
+        """
+        retries = 0
+        while True:
+            async with self.assign(key, candidates, rebalance) as index:
+                limiter = self.limiters[index]
+                await limiter.acquire()
+                try:
+                    result = await function(index)
+                except FloodWaitError as e:
+                    limiter.flood_wait(e.seconds)
+                    retries += 1
+                    if retries > limiter.max_retries:
+                        raise
+                    continue
+                limiter.success()
+                return result
+
+    def semaphore(self, index):
+        """
+        Limite de grupos coletados simultaneamente pela conta.
+        """
+        if self.semaphores is None:
+            self.semaphores = [asyncio.Semaphore(self.max_concurrent)
+                               for _ in self.accounts]
+        return self.semaphores[index]
+
+    def get_limiter(self, client):
+        """
+        Retorna o limitador da conta do cliente (o da primeira conta para
+        clientes desconhecidos).
+        """
+        for index, other in enumerate(self.clients):
+            if other is client:
+                return self.limiters[index]
+        return self.limiters[0]
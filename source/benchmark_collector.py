@@ -0,0 +1,549 @@
+from telethon import events
+from telethon.errors import FloodWaitError
+from telethon.tl import types
+from PIL import Image
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import functools
+import io
+import json
+import random
+import shlex
+import shutil
+import string
+import tempfile
+import time
+import pytz
+
+import get_messages
+from get_messages import TelegramCollector, get_group_id
+
+MEDIA_MIME_TYPES = {'video': 'video/mp4', 'audio': 'audio/ogg',
+                    'other': 'application/pdf'}
+PAYLOAD_VARIANTS = 8
+
+
+def percentile(values, fraction):
+    """
+    Retorna o percentil (fraction entre 0 e 1) de uma lista ordenada.
+    """
+    if not values:
+        return None
+    index = min(len(values) - 1, int(round(fraction * (len(values) - 1))))
+    return values[index]
+
+
+def random_bytes(generator, size):
+    return generator.getrandbits(8 * size).to_bytes(size, 'little')
+
+
+def make_payload(mediatype, size, seed):
+    """
+    Gera o conteúdo de uma mídia sintética de aproximadamente size bytes.
+    Imagens são PNGs de ruído (para que o phash possa ser calculado); as
+    demais mídias são bytes aleatórios.
+    """
+    generator = random.Random(seed)
+    if mediatype != 'image':
+        return random_bytes(generator, size)
+    side = max(8, int((size / 3) ** 0.5))
+    pixels = random_bytes(generator, side * side * 3)
+    output = io.BytesIO()
+    Image.frombytes('RGB', (side, side), pixels).save(output, 'PNG')
+    return output.getvalue()
+
+
+class BenchmarkStats():
+    """
+    Medidas de uma execução do benchmark: momento em que cada mensagem foi
+    entregue pelo cliente falso, latência até a sua escrita, bytes de mídia
+    baixados e FloodWaits injetados.
+    """
+
+    def __init__(self):
+        self.fetched = dict()
+        self.latencies = list()
+        self.saved = 0
+        self.media_bytes = 0
+        self.flood_waits = 0
+
+    def fetch(self, group_id, message_id):
+        self.fetched.setdefault((group_id, message_id), time.monotonic())
+
+    def save(self, group_id, message_id):
+        self.saved += 1
+        fetched = self.fetched.pop((group_id, message_id), None)
+        if fetched is not None:
+            self.latencies.append(time.monotonic() - fetched)
+
+
+class FakeMessage():
+    """
+    Mensagem sintética com os atributos de telethon.tl.custom.Message usados
+    pelo coletor.
+    """
+
+    photo = document = audio = voice = video = video_note = contact = None
+    action = media = None
+    client = None
+
+    def __init__(self, group_id, message_id, date, text, sender, payload=None):
+        self.id = message_id
+        self.to_id = self.peer_id = types.PeerChat(chat_id=group_id)
+        self.from_id = types.PeerUser(user_id=sender)
+        self.date = date
+        self.message = text
+        self.payload = payload
+
+    async def download_media(self, file=None):
+        return await self.client.download(self, file)
+
+
+class FakeEvent():
+    """
+    Evento ao vivo (NewMessage ou ChatAction) de uma mensagem sintética.
+    """
+
+    def __init__(self, message):
+        self.message = self.action_message = message
+
+
+class FakeDialog():
+    """
+    Grupo sintético com os atributos de telethon.tl.custom.Dialog usados
+    pelo coletor.
+    """
+
+    def __init__(self, group_id, date):
+        self.id = -group_id
+        self.title = 'benchmark_%d' % (group_id)
+        self.is_group = True
+        self.is_channel = False
+        self.entity = types.Chat(id=group_id, title=self.title, photo=None,
+                                 participants_count=0, date=date, version=1)
+        self.messages = list()
+
+
+class SyntheticDataset():
+    """
+    Grupos, mensagens, notificações e mídias sintéticas de um benchmark. O
+    conteúdo é determinístico para a mesma semente.
+
+    Atributos
+    -----------
+    dialogs : list
+            Grupos sintéticos, com as mensagens em ordem crescente de id.
+    start_date : datetime.datetime
+            Data da primeira mensagem.
+    end_date : datetime.datetime
+            Data da última mensagem.
+    """
+
+    def __init__(self, dialogs=10, messages=1000, days=7, media_ratio=0.1,
+                 notification_ratio=0.01, media_size=100000,
+                 media_types=('image',), media_repeat=0.0, text_size=200,
+                 seed=1, payloads=None):
+        generator = random.Random(seed)
+        self.start_date = pytz.UTC.localize(datetime.datetime(2020, 1, 1))
+        self.end_date = self.start_date + datetime.timedelta(days=days)
+        self.media_ratio = media_ratio
+        self.notification_ratio = notification_ratio
+        self.media_types = list(media_types)
+        self.payloads = payloads if payloads is not None else dict()
+        self.media_size = media_size
+        self.texts = [''.join(generator.choice(string.ascii_letters + ' ')
+                              for _ in range(text_size)) for _ in range(64)]
+        self.generator = generator
+        self.media_ids = list()
+
+        step = (self.end_date - self.start_date) / max(1, messages)
+        self.dialogs = list()
+        for group_id in range(1, dialogs + 1):
+            dialog = FakeDialog(group_id, self.start_date)
+            for index in range(messages):
+                dialog.messages.append(self.new_message(
+                    group_id, group_id * 10 ** 7 + index,
+                    self.start_date + step * index, media_repeat))
+            self.dialogs.append(dialog)
+
+    def _get_payload(self, mediatype, media_id):
+        key = (mediatype, media_id % PAYLOAD_VARIANTS)
+        if key not in self.payloads:
+            self.payloads[key] = make_payload(mediatype, self.media_size,
+                                              media_id % PAYLOAD_VARIANTS)
+        return self.payloads[key]
+
+    def new_message(self, group_id, message_id, date, media_repeat=0.0):
+        """
+        Cria uma mensagem, notificação ou mensagem com mídia sintética.
+        """
+        generator = self.generator
+        sender = 1000 + generator.randrange(100)
+        draw = generator.random()
+        message = FakeMessage(group_id, message_id, date,
+                              self.texts[message_id % len(self.texts)], sender)
+        if draw < self.notification_ratio:
+            message.message = ''
+            message.action = types.MessageActionChatAddUser(users=[sender])
+        elif draw < self.notification_ratio + self.media_ratio:
+            # Repeated media keeps the id (forwarded to several groups)
+            if self.media_ids and generator.random() < media_repeat:
+                media_id = generator.choice(self.media_ids)
+            else:
+                media_id = len(self.media_ids) + 1
+                self.media_ids.append(media_id)
+            mediatype = self.media_types[media_id % len(self.media_types)]
+            self._add_media(message, mediatype, media_id)
+        return message
+
+    def _add_media(self, message, mediatype, media_id):
+        message.payload = self._get_payload(mediatype, media_id)
+        if mediatype == 'image':
+            message.photo = types.Photo(
+                id=media_id, access_hash=0, file_reference=b'',
+                date=message.date, sizes=[], dc_id=1)
+            message.media = types.MessageMediaPhoto(photo=message.photo)
+            return
+        message.document = types.Document(
+            id=media_id, access_hash=0, file_reference=b'', date=message.date,
+            mime_type=MEDIA_MIME_TYPES[mediatype],
+            size=len(message.payload), dc_id=1, attributes=[])
+        message.media = types.MessageMediaDocument(document=message.document)
+        if mediatype == 'video':
+            message.video = message.document
+        elif mediatype == 'audio':
+            message.audio = message.document
+
+
+class FakeTelegramClient():
+    """
+    Substituto local do telethon.TelegramClient para o benchmark do coletor.
+    Entrega as mensagens de um SyntheticDataset em páginas, simulando a
+    latência de cada requisição, a banda dos downloads e FloodWaits. Na
+    coleta ao vivo, gera novas mensagens e as entrega aos handlers
+    registrados e, em seguida, se desconecta.
+
+    Atributos
+    -----------
+    dataset : SyntheticDataset
+            Grupos e mensagens entregues.
+    stats : BenchmarkStats
+            Medidas da execução.
+    latency : float
+            Latência (em segundos) de cada requisição à API.
+    page_size : int
+            Número de mensagens por requisição.
+    bandwidth : float
+            Banda dos downloads (em bytes por segundo, 0 para ilimitada).
+    flood_rate : float
+            Probabilidade de uma requisição receber FloodWaitError.
+    flood_seconds : int
+            Espera pedida nos FloodWaitError injetados.
+    live_messages : int
+            Número de mensagens geradas na coleta ao vivo.
+    """
+
+    def __init__(self, dataset, stats, session=None, api_id=None,
+                 api_hash=None, latency=0.0, page_size=100, bandwidth=0.0,
+                 flood_rate=0.0, flood_seconds=1, live_messages=0, **kwargs):
+        self.dataset = dataset
+        self.stats = stats
+        self.latency = latency
+        self.page_size = max(1, page_size)
+        self.bandwidth = bandwidth
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.live_messages = live_messages
+        self.generator = random.Random(0)
+        self.handlers = list()
+
+    async def __aenter__(self):
+        await self._request()
+        return self
+
+    async def __aexit__(self, *args):
+        pass
+
+    async def _request(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            await asyncio.sleep(0)
+        if self.flood_rate and self.generator.random() < self.flood_rate:
+            self.stats.flood_waits += 1
+            raise FloodWaitError(request=None, capture=self.flood_seconds)
+
+    async def iter_dialogs(self):
+        await self._request()
+        for dialog in self.dataset.dialogs:
+            yield dialog
+
+    async def iter_messages(self, dialog, limit=None, offset_date=None,
+                            offset_id=0, min_id=0, max_id=0, reverse=False,
+                            **kwargs):
+        count = 0
+        for message in reversed(dialog.messages):
+            if offset_id and message.id >= offset_id:
+                continue
+            if offset_date and message.date >= offset_date:
+                continue
+            if min_id and message.id <= min_id:
+                break
+            if count % self.page_size == 0:
+                await self._request()
+            count += 1
+            message.client = self
+            self.stats.fetch(dialog.entity.id, message.id)
+            yield message
+
+    async def download(self, message, file):
+        if self.bandwidth:
+            await asyncio.sleep(len(message.payload) / float(self.bandwidth))
+        await self._request()
+        # Written in chunks, like the real client
+        for start in range(0, len(message.payload), 128 * 1024):
+            file.write(message.payload[start:start + 128 * 1024])
+        self.stats.media_bytes += len(message.payload)
+        return file
+
+    def on(self, event):
+        def decorator(handler):
+            self.handlers.append((event, handler))
+            return handler
+        return decorator
+
+    def is_connected(self):
+        return True
+
+    async def connect(self):
+        await self._request()
+
+    async def catch_up(self):
+        pass
+
+    async def run_until_disconnected(self):
+        dialogs = self.dataset.dialogs
+        for index in range(self.live_messages):
+            dialog = dialogs[index % len(dialogs)]
+            last_id = dialog.messages[-1].id if dialog.messages else 0
+            message = self.dataset.new_message(
+                dialog.entity.id, last_id + 1, datetime.datetime.now(pytz.UTC))
+            message.client = self
+            dialog.messages.append(message)
+            self.stats.fetch(dialog.entity.id, message.id)
+
+            kind = events.ChatAction if message.action else events.NewMessage
+            event = FakeEvent(message)
+            for event_type, handler in self.handlers:
+                if event_type is kind:
+                    await handler(event)
+            await asyncio.sleep(self.latency)
+
+
+class BenchmarkCollector(TelegramCollector):
+    """
+    Coletor que registra o momento em que cada mensagem e notificação é
+    escrita, para o cálculo da latência por mensagem.
+    """
+
+    def __init__(self, args, stats):
+        super().__init__(args)
+        self.stats = stats
+
+    def _write_message(self, item, date, daily_path, group_path,
+                       media_path=None):
+        super()._write_message(item, date, daily_path, group_path, media_path)
+        self.stats.save(item["group_id"], item["message_id"])
+
+    def _save_notification(self, message, path=None):
+        super()._save_notification(message, path)
+        self.stats.save(get_group_id(message), message.id)
+
+
+async def run_benchmark(mode, write_mode, options, payloads):
+    """
+    Executa uma coleta completa (run()) com o cliente falso em uma pasta
+    temporária e retorna as medidas.
+
+    Parâmetros
+    ------------
+        mode : str
+            Modo de coleta ("period", "continuous" ou "unread").
+        write_mode : str
+            Modo de escrita ("both", "day", "group" ou "sqlite").
+        options : argparse.Namespace()
+            Opções do benchmark.
+        payloads : dict
+            Conteúdo das mídias, compartilhado entre as execuções.
+    """
+    dataset = SyntheticDataset(
+        options.dialogs, options.messages, options.days, options.media_ratio,
+        options.notification_ratio, options.media_size, options.media_types,
+        options.media_repeat, options.text_size, options.seed, payloads)
+    stats = BenchmarkStats()
+    data_path = tempfile.mkdtemp(prefix='telegram_benchmark_')
+
+    args = get_messages.get_parser().parse_args(
+        ['-m', mode, '-w', write_mode, '--data_path', data_path,
+         '-s', dataset.start_date.strftime('%Y-%m-%d'),
+         '-e', dataset.end_date.strftime('%Y-%m-%d'),
+         '--max_reconnects', '0', '--reconnect_delay', '0',
+         '--api_id', '0', '--api_hash', 'benchmark'] +
+        shlex.split(options.collector_args))
+    collector = BenchmarkCollector(args, stats)
+    collector.client_class = functools.partial(
+        FakeTelegramClient, dataset, stats, latency=options.latency,
+        page_size=options.page_size, bandwidth=options.bandwidth,
+        flood_rate=options.flood_rate, flood_seconds=options.flood_seconds,
+        live_messages=options.live_messages)
+
+    output = contextlib.nullcontext() if options.verbose else \
+        contextlib.redirect_stdout(io.StringIO())
+    start = time.monotonic()
+    try:
+        with output:
+            await collector.run()
+        elapsed = time.monotonic() - start
+    finally:
+        if options.keep:
+            print('Benchmark data kept in ' + data_path)
+        else:
+            shutil.rmtree(data_path, ignore_errors=True)
+
+    latencies = sorted(stats.latencies)
+    return {
+        'mode': mode, 'write_mode': write_mode, 'seconds': elapsed,
+        'messages': stats.saved, 'media_bytes': stats.media_bytes,
+        'messages_per_second': stats.saved / elapsed,
+        'mb_per_second': stats.media_bytes / elapsed / 10 ** 6,
+        'p50_ms': percentile(latencies, 0.5) * 1000 if latencies else None,
+        'p99_ms': percentile(latencies, 0.99) * 1000 if latencies else None,
+        'flood_waits': stats.flood_waits,
+        'unsaved': len(stats.fetched)}
+
+
+def print_results(results):
+    header = ('%-10s %-6s %9s %9s %10s %8s %9s %9s %6s' % (
+        'mode', 'write', 'messages', 'seconds', 'msgs/s', 'MB/s', 'p50 ms',
+        'p99 ms', 'floods'))
+    print(header)
+    print('-' * len(header))
+    for result in results:
+        print('%-10s %-6s %9d %9.2f %10.1f %8.2f %9s %9s %6d' % (
+            result['mode'], result['write_mode'], result['messages'],
+            result['seconds'], result['messages_per_second'],
+            result['mb_per_second'],
+            '-' if result['p50_ms'] is None else '%.2f' % (result['p50_ms']),
+            '-' if result['p99_ms'] is None else '%.2f' % (result['p99_ms']),
+            result['flood_waits']))
+
+
+async def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark offline do coletor de mensagens, com um"
+        " cliente do Telegram falso e dados sintéticos.")
+
+    parser.add_argument("--modes", nargs="+", type=str,
+                        help="Modos de coleta medidos.",
+                        default=['period', 'continuous', 'unread'])
+
+    parser.add_argument("--write_modes", nargs="+", type=str,
+                        help="Modos de escrita medidos.",
+                        default=['both', 'day', 'group', 'sqlite'])
+
+    parser.add_argument("--dialogs", type=int,
+                        help="Número de grupos sintéticos.", default=10)
+
+    parser.add_argument("--messages", type=int,
+                        help="Número de mensagens do histórico de cada grupo.",
+                        default=1000)
+
+    parser.add_argument("--days", type=int,
+                        help="Número de dias cobertos pelo histórico.",
+                        default=7)
+
+    parser.add_argument("--live_messages", type=int,
+                        help="Número de mensagens geradas na coleta ao vivo.",
+                        default=1000)
+
+    parser.add_argument("--media_ratio", type=float,
+                        help="Fração das mensagens com mídia.", default=0.1)
+
+    parser.add_argument("--notification_ratio", type=float,
+                        help="Fração das mensagens que são notificações.",
+                        default=0.01)
+
+    parser.add_argument("--media_types", nargs="+", type=str,
+                        help="Tipos das mídias geradas (\'image\', \'video\',"
+                        " \'audio\', \'other\').", default=['image'])
+
+    parser.add_argument("--media_size", type=int,
+                        help="Tamanho aproximado (em bytes) de cada mídia.",
+                        default=100000)
+
+    parser.add_argument("--media_repeat", type=float,
+                        help="Probabilidade de uma mídia repetir uma mídia"
+                        " anterior (mesmo id no Telegram).", default=0.0)
+
+    parser.add_argument("--text_size", type=int,
+                        help="Número de caracteres do texto das mensagens.",
+                        default=200)
+
+    parser.add_argument("--latency", type=float,
+                        help="Latência (em segundos) de cada requisição à"
+                        " API.", default=0.0)
+
+    parser.add_argument("--page_size", type=int,
+                        help="Número de mensagens por requisição.",
+                        default=100)
+
+    parser.add_argument("--bandwidth", type=float,
+                        help="Banda dos downloads em bytes por segundo (0 para"
+                        " ilimitada).", default=0)
+
+    parser.add_argument("--flood_rate", type=float,
+                        help="Probabilidade de uma requisição receber"
+                        " FloodWaitError.", default=0.0)
+
+    parser.add_argument("--flood_seconds", type=int,
+                        help="Espera pedida nos FloodWaitError injetados.",
+                        default=1)
+
+    parser.add_argument("--collector_args", type=str,
+                        help="Argumentos adicionais do coletor (e.g."
+                        " \"--download_workers 8 --hash_workers 0\").",
+                        default='')
+
+    parser.add_argument("--seed", type=int,
+                        help="Semente dos dados sintéticos.", default=1)
+
+    parser.add_argument("-o", "--output", type=str,
+                        help="Arquivo json em que os resultados são"
+                        " salvos.", default=None)
+
+    parser.add_argument("--keep", action="store_true",
+                        help="Mantém as pastas de dados de cada execução.")
+
+    parser.add_argument("--verbose", action="store_true",
+                        help="Mostra a saída do coletor.")
+
+    options = parser.parse_args()
+
+    payloads = dict()
+    results = list()
+    for mode in options.modes:
+        for write_mode in options.write_modes:
+            results.append(await run_benchmark(mode, write_mode, options,
+                                               payloads))
+    print_results(results)
+
+    if options.output is not None:
+        with open(options.output, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
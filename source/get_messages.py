@@ -1,4 +1,4 @@
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, utils
 from PIL import Image
 
 import asyncio
@@ -11,6 +11,48 @@ import hashlib
 import imagehash
 import pytz
 import os
+import time
+import concurrent.futures
+
+from jsonl_writer import JsonlWriter
+from sqlite_store import SqliteStore
+from processed_ids import ProcessedIdStore
+from watermarks import DialogWatermarks
+from media_index import MediaIndex, get_media_key
+from accounts import AccountOwners, AccountPool, load_accounts
+import metrics
+
+MESSAGES_FETCHED = metrics.counter(
+    'telegram_messages_fetched_total',
+    'Mensagens e notificações recebidas da API.', ['group_id'])
+MESSAGES_SKIPPED = metrics.counter(
+    'telegram_messages_skipped_total',
+    'Mensagens recebidas e não salvas (já coletadas, de usuários excluídos'
+    ' ou fora do período).', ['group_id', 'reason'])
+MESSAGES_SAVED = metrics.counter(
+    'telegram_messages_saved_total', 'Mensagens e notificações salvas.',
+    ['group_id', 'kind'])
+MEDIA_DOWNLOADED = metrics.counter(
+    'telegram_media_downloaded_total', 'Mídias baixadas.', ['mediatype'])
+MEDIA_BYTES = metrics.counter(
+    'telegram_media_downloaded_bytes_total', 'Bytes de mídias baixados.',
+    ['mediatype'])
+MEDIA_REUSED = metrics.counter(
+    'telegram_media_reused_total',
+    'Mídias reaproveitadas de downloads anteriores.', ['mediatype'])
+MEDIA_SECONDS = metrics.histogram(
+    'telegram_media_download_seconds', 'Tempo de download das mídias.',
+    ['mediatype'])
+HASH_SECONDS = metrics.histogram(
+    'telegram_hash_seconds',
+    'Tempo de cálculo dos checksums e phashes (incluindo a espera no pool).')
+WRITE_SECONDS = metrics.histogram(
+    'telegram_write_seconds',
+    'Tempo de escrita dos registros ("record") e dos checkpoints'
+    ' ("checkpoint").', ['stage'])
+QUEUE_DEPTH = metrics.gauge(
+    'telegram_queue_depth', 'Itens aguardando nas filas de download e de'
+    ' eventos ao vivo.', ['queue'])
 
 def md5(fname):
     hash_md5 = hashlib.md5()
@@ -20,6 +62,102 @@ def md5(fname):
     return hash_md5.hexdigest()
 
 
+def get_group_id(message):
+    """
+    Retorna o id do grupo ou canal em que a mensagem foi enviada.
+
+    Parâmetros
+    ------------
+        message : telethon.tl.custom.message.Message()
+            Objeto da mensagem coletada.
+    """
+    try:
+        return message.to_id.chat_id
+    except AttributeError:
+        return message.to_id.channel_id
+
+
+def get_media_extension(message):
+    """
+    Retorna a extensão do arquivo da mídia da mensagem, obtida da foto ou do
+    documento baixado (inclusive os de prévias de links), e não do tipo da
+    mídia da mensagem.
+
+    Parâmetros
+    ------------
+        message : telethon.tl.custom.message.Message()
+            Objeto da mensagem coletada.
+    """
+    media = message.photo or message.document
+    if media is not None:
+        return utils.get_extension(media)
+    if message.contact is not None:
+        return ".vcard"
+    return utils.get_extension(message.media)
+
+
+class ChecksumFile():
+    """
+    Arquivo de escrita que atualiza o md5 do conteúdo à medida que os
+    blocos são recebidos, evitando reler o arquivo após o download. O
+    resultado é idêntico ao da função md5().
+
+    Atributos
+    -----------
+    name : str
+            Caminho do arquivo escrito.
+    """
+
+    def __init__(self, fname):
+        self.name = fname
+        self.hash_md5 = hashlib.md5()
+        pathlib.Path(os.path.dirname(fname)).mkdir(parents=True, exist_ok=True)
+        self.file = open(fname, "wb")
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode("utf-8")
+        self.hash_md5.update(data)
+        return self.file.write(data)
+
+    def tell(self):
+        return self.file.tell()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+    def hexdigest(self):
+        return self.hash_md5.hexdigest()
+
+
+def compute_hashes(fname, process_checksum, process_phash):
+    """
+    Calcula o checksum e/ou o phash de um arquivo. Executada nos workers
+    do pool de hashes, fora do loop de eventos.
+
+    Parâmetros
+    ------------
+        fname : str
+            Caminho para o arquivo.
+        process_checksum : bool
+            Se o checksum (md5) deve ser calculado.
+        process_phash : bool
+            Se o phash (imagens) deve ser calculado.
+    """
+    checksum = md5(fname) if process_checksum else None
+    phash = None
+    if process_phash:
+        try:
+            with Image.open(fname) as image:
+                phash = str(imagehash.phash(image))
+        except Exception:
+            print("Error computing the phash of " + fname)
+    return checksum, phash
+
+
 class TelegramCollector():
     """
     Classe que encapsula o coletor de grupos do Telegram. Possui
@@ -34,6 +172,9 @@ class TelegramCollector():
             Data de início do período de coleta (Modo "period").
     end_date : str
             Data de término do período de coleta (Modo "period").
+    data_path : str
+            Pasta em que as mensagens, mídias, o estado da coleta e a sessão
+            do Telegram são salvos.
     group_blacklist : list
             Lista de ids de grupos que devem ser excluídos da coleta.
     user_blacklist : list
@@ -58,6 +199,48 @@ class TelegramCollector():
             ID da API de Coleta gerado em my.telegram.org (Dado sensível).
     api_hash : str
             Hash da API de Coleta gerado em my.telegram.org (Dado sensível).
+    accounts : list
+            Contas usadas na coleta ("session", "api_id" e "api_hash"). Com
+            mais de uma conta os grupos são divididos entre elas.
+    client_class : type
+            Classe do cliente do Telegram (substituível em testes).
+    max_concurrent_dialogs : int
+            Número máximo de grupos coletados simultaneamente com o mesmo
+            cliente (Modos "period" e "continuous").
+    rebalance_wait : float
+            Espera por FloodWait (em segundos) a partir da qual os grupos de
+            uma conta passam a ser coletados por outra.
+    metrics_port : int
+            Porta do endpoint de métricas (0 desativa).
+    download_workers : int
+            Número de workers que baixam as mídias em paralelo à iteração
+            das mensagens (0 baixa as mídias durante a iteração).
+    download_queue_size : int
+            Tamanho máximo da fila de mídias aguardando download.
+    event_workers : int
+            Número de workers que persistem os eventos da coleta ao vivo (0
+            processa os eventos nos próprios handlers).
+    event_queue_size : int
+            Tamanho máximo da fila de eventos ao vivo.
+    reconnect_delay : float
+            Espera (em segundos) antes de reconectar a coleta ao vivo.
+    max_reconnects : int
+            Número máximo de reconexões da coleta ao vivo (negativo para
+            reconectar sempre).
+    event_batch_size : int
+            Número máximo de eventos processados por um worker de uma vez.
+    hash_workers : int
+            Número de workers do pool que calcula checksums e phashes (0
+            calcula no próprio loop de eventos).
+    hash_executor : str
+            Tipo de pool usado no cálculo dos hashes ("process" ou "thread").
+    writer : JsonlWriter
+            Escritor em lote dos arquivos de mensagens e notificações.
+    sqlite_path : str
+            Caminho do banco de dados do modo de escrita "sqlite" (por
+            padrão, telegram.db em data_path).
+    pool : AccountPool
+            Contas conectadas, com o limitador de requisições de cada uma.
     
     Métodos
     -----------
@@ -96,7 +279,11 @@ class TelegramCollector():
             print('Collection mode invalid <%s>!! Using <continuous> instead' %
                   (args_dict["collection_mode"]))
             args_dict["collection_mode"] = 'continuous'
-        if args_dict["write_mode"] not in ['both', 'day', 'group']:
+        if args_dict["hash_executor"] not in ['process', 'thread']:
+            print('Hash executor invalid <%s>!! Using <process> instead' % (
+                args_dict["hash_executor"]))
+            args_dict["hash_executor"] = 'process'
+        if args_dict["write_mode"] not in ['both', 'day', 'group', 'sqlite']:
             print('Save mode invalid <%s>!! Using <both> instead' % (
                 args_dict["write_mode"]))
             args_dict["write_mode"] = 'both'
@@ -105,6 +292,7 @@ class TelegramCollector():
         self.start_date            = args_dict["start_date"]
         self.end_date              = args_dict["end_date"]
         self.write_mode            = args_dict["write_mode"]
+        self.data_path             = args_dict["data_path"]
         self.group_blacklist       = args_dict["group_blacklist"]
         self.user_blacklist        = args_dict["user_blacklist"]
         self.collect_messages      = args_dict["collect_messages"]
@@ -119,59 +307,106 @@ class TelegramCollector():
         self.process_other_hashes  = args_dict["process_other_hashes"]
         self.api_id                = args_dict["api_id"]
         self.api_hash              = args_dict["api_hash"]
-
-    def _get_load_messages(self, path='/data/mid_file.txt'):
+        self.accounts              = load_accounts(
+            args_dict, os.path.join(self.data_path, "collector_local"))
+        self.client_class          = TelegramClient
+        self.rebalance_wait        = float(args_dict["rebalance_wait"])
+        self.metrics_port          = int(args_dict["metrics_port"])
+        self.max_concurrent_dialogs = max(1, int(args_dict["max_concurrent_dialogs"]))
+        self.download_workers      = int(args_dict["download_workers"])
+        self.download_queue_size   = max(1, int(args_dict["download_queue_size"]))
+        self.download_queue        = None
+        self.download_tasks        = list()
+        self.pending_media         = 0
+        self.event_workers         = int(args_dict["event_workers"])
+        self.event_queue_size      = max(1, int(args_dict["event_queue_size"]))
+        self.event_batch_size      = max(1, int(args_dict["event_batch_size"]))
+        self.event_queue           = None
+        self.event_tasks           = list()
+        self.event_queue_full      = False
+        self.pending_events        = 0
+        self.live_keys             = dict()
+        self.live_owners           = dict()
+        self.catching_up           = set()
+        self.reconnect_delay       = float(args_dict["reconnect_delay"])
+        self.max_reconnects        = int(args_dict["max_reconnects"])
+        self.hash_workers          = int(args_dict["hash_workers"])
+        self.hash_executor         = args_dict["hash_executor"]
+        self.hash_pool             = None
+        self.processed_ids         = None
+        self.in_flight             = set()
+        self.watermarks            = None
+        self.discarded_messages    = 0
+        self.media_index           = None
+        self.media_downloads       = dict()
+        self.writer                = JsonlWriter(
+            max_open_files=int(args_dict["writer_max_open_files"]),
+            max_buffered=int(args_dict["writer_buffer_size"]),
+            flush_interval=float(args_dict["writer_flush_interval"]),
+            fsync=args_dict["writer_fsync"],
+            compression=args_dict["writer_compression"],
+            segment_size=int(args_dict["writer_segment_size"]),
+            segment_interval=float(args_dict["writer_segment_interval"]))
+        self.sqlite_path           = (args_dict["sqlite_path"] or
+                                      os.path.join(self.data_path, "telegram.db"))
+        self.limiter_args          = {
+            "min_interval": float(args_dict["rate_min_interval"]),
+            "max_interval": float(args_dict["rate_max_interval"]),
+            "max_retries": int(args_dict["flood_max_retries"])}
+        self.pool                  = None
+        self.owners                = None
+        self.store                 = None
+
+    def _checkpoint(self):
         """
-        Carrega e retorna um conjunto de ids das mensagens já coletadas.
-
-        Parâmetros
-        ------------
-            path : str
-                Caminho para o arquivo contendo os ids das mensagens.
+        Escreve os registros acumulados e, em seguida, os ids e as marcas
+        das mensagens coletadas. Nesta ordem, um id só é persistido depois da
+        mensagem.
         """
-        messagesIDs = set()
-        
-        if os.path.isfile(path):
-            with open(path, 'r') as fin:
-                for line in fin:
-                    messagesIDs.add(int(line.strip()))
-
-        return messagesIDs
-
-    def _save_processed_ids(self, id_set, path='/data/mid_file.txt'):
+        with WRITE_SECONDS.time(stage="checkpoint"):
+            self.writer.flush()
+            if self.store is not None:
+                self.store.flush()
+            self.media_index.flush()
+            self.processed_ids.checkpoint()
+            if self.pending_media == 0 and self.pending_events == 0:
+                # Watermarks may only move past messages already written
+                self.watermarks.save()
+
+    def _reserve(self, group_id, message_id):
         """
-        Salva o conjunto de ids das mensagens já coletadas.
+        Reserva uma mensagem para ser salva. Retorna False se ela já foi
+        coletada ou se já está sendo salva (e.g. aguardando o download da
+        mídia), evitando que uma segunda passada sobre o mesmo trecho do
+        histórico a escreva novamente.
 
         Parâmetros
         ------------
-            path : str
-                Caminho para o arquivo contendo os ids das mensagens.
+            group_id : int
+                Id do grupo da mensagem.
+            message_id : int
+                Id da mensagem.
         """
-        with open(path+".temp", 'w') as fmid:
-            for id in id_set:
-                print(str(id), file=fmid)
-        
-        if os.path.isfile(path):
-            os.remove(path)
-        os.rename(path + ".temp", path)
+        key = (group_id, message_id)
+        if key in self.in_flight or self.processed_ids.contains(group_id, message_id):
+            return False
+        self.in_flight.add(key)
+        return True
 
-    def _append_processed_id(self, id, path='/data/mid_file.txt'):
+    def _release(self, group_id, message_id):
         """
-        Salva um novo id de uma mensagem coletada.
-
-        Parâmetros
-        ------------
-            path : str
-                Caminho para o arquivo contendo os ids das mensagens.
+        Libera a reserva de uma mensagem, depois de escrita ou caso ela não
+        possa ser salva.
         """
-        with open(path, 'a') as fmid:
-            print(str(id), file=fmid)
+        self.in_flight.discard((group_id, message_id))
 
-    async def _save_message(self, message, dialog_name, daily_path = "/data/mensagens/", group_path="/data/mensagens_grupo/"):
+    async def _save_message(self, message, dialog_name, daily_path=None, group_path=None):
         """
         Escreve em formato json a mensagem coletada no arquivo
         referente ao grupo em que ela foi enviada. Caso o arquivo do grupo
-        ainda não exista, ele será criado.
+        ainda não exista, ele será criado. Mensagens com mídias a serem
+        baixadas são enviadas para a fila de download e escritas pelos
+        workers assim que a mídia é obtida.
         Parâmetros
         ------------
             message : telethon.tl.custom.message.Message()
@@ -181,12 +416,13 @@ class TelegramCollector():
                 serão escritos.
         """
         #print(message) #log message
+        if daily_path is None:
+            daily_path = os.path.join(self.data_path, "mensagens/")
+        if group_path is None:
+            group_path = os.path.join(self.data_path, "mensagens_grupo/")
         
         item = dict()
-        try: 
-            item["group_id"] = message.to_id.chat_id
-        except:
-            item["group_id"] = message.to_id.channel_id
+        item["group_id"] = get_group_id(message)
                 
         item["message_id"] = message.id
         item["group_name"] = dialog_name
@@ -205,69 +441,298 @@ class TelegramCollector():
         item["mediatype"] = None
         item["phash"] = None
         item["checksum"] = None
+        media_path = None
         
         if message.media:
             if message.photo:
-                base_path = "/data/image/"
                 item["mediatype"] = "image"
             elif message.audio or message.voice:
-                base_path = "/data/audio/"
                 item["mediatype"] = "audio"
             elif message.video or message.video_note:
-                base_path = "/data/video/"
                 item["mediatype"] = "video"
             else:
-                base_path = "/data/others/"
                 item["mediatype"] = "other"
 
             if (item["mediatype"] == "image" and self.collect_images) or \
                     (item["mediatype"] == "audio" and self.collect_audios) or \
                     (item["mediatype"] == "video" and self.collect_videos) or \
                     (item["mediatype"] == "other" and self.collect_others):
-                path = os.path.join(base_path, message.date.strftime("%Y-%m-%d"), str(item["message_id"]))
-                try:
-                    file_path = await message.download_media(path)
-                    
-                    if file_path:
-                        if os.path.isfile(file_path): 
-                            
-                            item["file"] = file_path.split("/")[-1]
-
-                            if file_path != None and (
-                                    (item["mediatype"] == "image" and self.process_image_hashes) or 
-                                    (item["mediatype"] == "audio" and self.process_audio_hashes) or 
-                                    (item["mediatype"] == "video" and self.process_video_hashes) or 
-                                    (item["mediatype"] == "other" and self.process_other_hashes)):
-                                item["checksum"] = md5(file_path)
-                                if item["mediatype"] == "image":
-                                    try: 
-                                        item["phash"] = str(imagehash.phash(Image.open(file_path)))
-                                    except:
-                                        item["phash"] = str(imagehash.phash(Image.open(file_path)))
-                except:
-                    print ("Error getting the file")
-                    item["phash"] = None
-                    item["checksum"] = None
-                
+                if self.download_queue is not None:
+                    # Blocks only when the queue is full (backpressure)
+                    self.pending_media += 1
+                    await self.download_queue.put((message, item, daily_path, group_path))
+                    return
+                media_path = await self._download_media(message, item)
+
             print(item)
+        self._write_message(item, message.date, daily_path, group_path, media_path)
+
+    async def _download_media(self, message, item):
+        """
+        Baixa a mídia da mensagem e preenche os campos "file", "checksum" e
+        "phash" do registro da mensagem. Mídias já baixadas anteriormente
+        (mesma identidade no Telegram) reaproveitam o arquivo e os hashes
+        guardados no índice de mídias. Retorna o caminho do arquivo da mídia
+        (ou None, caso a mídia não tenha sido obtida).
+
+        Parâmetros
+        ------------
+            message : telethon.tl.custom.message.Message()
+                Objeto da mensagem coletada.
+            item : dict
+                Registro da mensagem que será escrito nos arquivos de saída.
+        """
+        process_hashes = (
+            (item["mediatype"] == "image" and self.process_image_hashes) or 
+            (item["mediatype"] == "audio" and self.process_audio_hashes) or 
+            (item["mediatype"] == "video" and self.process_video_hashes) or 
+            (item["mediatype"] == "other" and self.process_other_hashes))
+        media_key = get_media_key(message)
+        try:
+            if media_key is not None:
+                # Wait for a download of the same media that is in progress
+                while media_key in self.media_downloads:
+                    await self.media_downloads[media_key].wait()
+                entry = self.media_index.get(media_key)
+                if entry is not None and os.path.isfile(entry["path"]):
+                    await self._reuse_media(media_key, entry, item, process_hashes)
+                    MEDIA_REUSED.inc(mediatype=item["mediatype"])
+                    return entry["path"]
+                self.media_downloads[media_key] = asyncio.Event()
+
+            try:
+                # Media is downloaded by the account that fetched the message
+                limiter = self.pool.get_limiter(message.client)
+                return await limiter.call(self._fetch_media, message, item,
+                                          media_key, process_hashes)
+            finally:
+                if media_key is not None:
+                    self.media_downloads.pop(media_key).set()
+        except:
+            print ("Error getting the file")
+            item["phash"] = None
+            item["checksum"] = None
+            return None
+
+    async def _fetch_media(self, message, item, media_key, process_hashes):
+        """
+        Baixa a mídia da mensagem, calcula os hashes e registra o arquivo no
+        índice de mídias. Retorna o caminho do arquivo.
+
+        Parâmetros
+        ------------
+            message : telethon.tl.custom.message.Message()
+                Objeto da mensagem coletada.
+            item : dict
+                Registro da mensagem que será escrito nos arquivos de saída.
+            media_key : str
+                Identidade da mídia no Telegram (ou None).
+            process_hashes : bool
+                Se os hashes da mídia devem ser calculados.
+        """
+        base_path = os.path.join(self.data_path, "others" if item["mediatype"] == "other" else item["mediatype"])
+        path = os.path.join(base_path, message.date.strftime("%Y-%m-%d"), str(item["message_id"]))
+        extension = get_media_extension(message)
+        file_path = path + extension
+
+        # The media is written under another name and renamed at the end, so
+        # an interrupted download is not taken as a downloaded file. The
+        # checksum is updated while the chunks are written
+        media_file = ChecksumFile(path + ".temp" + extension)
+        start = time.monotonic()
+        try:
+            result = await message.download_media(media_file)
+            size = media_file.tell()
+        except BaseException:
+            media_file.close()
+            os.remove(media_file.name)
+            raise
+        media_file.close()
+
+        if result is None:
+            # Media kinds without a file (e.g. polls, locations)
+            os.remove(media_file.name)
+            return None
+        os.replace(media_file.name, file_path)
+        MEDIA_SECONDS.observe(time.monotonic() - start, mediatype=item["mediatype"])
+        MEDIA_DOWNLOADED.inc(mediatype=item["mediatype"])
+        MEDIA_BYTES.inc(size, mediatype=item["mediatype"])
+
+        item["file"] = file_path.split("/")[-1]
+        entry = {"path": file_path, "checksum": media_file.hexdigest(), "phash": None}
+
+        if process_hashes:
+            item["checksum"] = entry["checksum"]
+            if item["mediatype"] == "image":
+                _, entry["phash"] = await self._compute_hashes(file_path, False, True)
+                item["phash"] = entry["phash"]
+
+        if media_key is not None:
+            self.media_index.add(media_key, entry)
+        return file_path
+
+    async def _reuse_media(self, media_key, entry, item, process_hashes):
+        """
+        Preenche o registro da mensagem com o arquivo e os hashes de uma
+        mídia já baixada, calculando apenas os hashes que ainda faltam.
+
+        Parâmetros
+        ------------
+            media_key : str
+                Identidade da mídia no Telegram.
+            entry : dict
+                Entrada da mídia no índice.
+            item : dict
+                Registro da mensagem que será escrito nos arquivos de saída.
+            process_hashes : bool
+                Se os hashes da mídia devem ser preenchidos.
+        """
+        item["file"] = entry["path"].split("/")[-1]
+        if not process_hashes:
+            return
+
+        process_checksum = entry["checksum"] is None
+        process_phash = item["mediatype"] == "image" and entry["phash"] is None
+        if process_checksum or process_phash:
+            checksum, phash = await self._compute_hashes(
+                entry["path"], process_checksum, process_phash)
+            entry = dict(entry)
+            if process_checksum:
+                entry["checksum"] = checksum
+            if process_phash:
+                entry["phash"] = phash
+            self.media_index.add(media_key, entry)
+
+        item["checksum"] = entry["checksum"]
+        if item["mediatype"] == "image":
+            item["phash"] = entry["phash"]
+
+    async def _compute_hashes(self, file_path, process_checksum, process_phash):
+        """
+        Calcula os hashes do arquivo no pool de hashes, sem bloquear o loop
+        de eventos. Sem pool ("hash_workers" igual a zero) o cálculo é feito
+        diretamente.
+
+        Parâmetros
+        ------------
+            file_path : str
+                Caminho para o arquivo baixado.
+            process_checksum : bool
+                Se o checksum deve ser calculado.
+            process_phash : bool
+                Se o phash deve ser calculado.
+        """
+        with HASH_SECONDS.time():
+            if self.hash_pool is None:
+                return compute_hashes(file_path, process_checksum, process_phash)
+            loop = asyncio.get_event_loop()
+            return await loop.run_in_executor(self.hash_pool, compute_hashes,
+                                              file_path, process_checksum, process_phash)
+
+    def _start_hash_pool(self):
+        """
+        Cria o pool (de processos ou threads) usado no cálculo dos hashes.
+        """
+        if self.hash_workers <= 0 or self.hash_pool is not None:
+            return
+        if self.hash_executor == "process":
+            self.hash_pool = concurrent.futures.ProcessPoolExecutor(self.hash_workers)
+        else:
+            self.hash_pool = concurrent.futures.ThreadPoolExecutor(self.hash_workers)
+
+    def _stop_hash_pool(self):
+        """
+        Encerra o pool de hashes.
+        """
+        if self.hash_pool is not None:
+            self.hash_pool.shutdown(wait=True)
+            self.hash_pool = None
+
+    async def _download_worker(self):
+        """
+        Consome a fila de download: baixa a mídia de cada mensagem e escreve
+        o registro completo nos arquivos de saída.
+        """
+        while True:
+            message, item, daily_path, group_path = await self.download_queue.get()
+            try:
+                media_path = await self._download_media(message, item)
+                print(item)
+                self._write_message(item, message.date, daily_path, group_path,
+                                    media_path)
+            except Exception:
+                traceback.print_exc()
+            finally:
+                # A failed message may be collected again by a later pass
+                self._release(item["group_id"], item["message_id"])
+                self.pending_media -= 1
+                self.download_queue.task_done()
+
+    def _start_download_workers(self):
+        """
+        Cria a fila de download e inicia os workers. Com "download_workers"
+        igual a zero as mídias continuam sendo baixadas durante a iteração.
+        """
+        if self.download_workers <= 0:
+            return
+        self.download_queue = asyncio.Queue(maxsize=self.download_queue_size)
+        QUEUE_DEPTH.set_function(self.download_queue.qsize, queue="download")
+        self.download_tasks = [asyncio.ensure_future(self._download_worker())
+                               for _ in range(self.download_workers)]
+
+    async def _stop_download_workers(self):
+        """
+        Aguarda o término dos downloads pendentes e encerra os workers.
+        """
+        if self.download_queue is None:
+            return
+        await self.download_queue.join()
+        for task in self.download_tasks:
+            task.cancel()
+        await asyncio.gather(*self.download_tasks, return_exceptions=True)
+        self.download_queue = None
+        self.download_tasks = list()
+
+    def _write_message(self, item, date, daily_path, group_path, media_path=None):
+        """
+        Escreve o registro da mensagem nos arquivos por grupo e/ou por dia
+        ou no banco de dados, de acordo com o modo de escrita.
+
+        Parâmetros
+        ------------
+            item : dict
+                Registro da mensagem.
+            date : datetime.datetime
+                Data de envio da mensagem.
+            media_path : str
+                Caminho do arquivo da mídia da mensagem (ou None).
+        """
+        with WRITE_SECONDS.time(stage="record"):
+            self._write_message_record(item, date, daily_path, group_path,
+                                       media_path)
+        self.processed_ids.add(item["group_id"], item["message_id"])
+        self._release(item["group_id"], item["message_id"])
+        MESSAGES_SAVED.inc(group_id=item["group_id"], kind="message")
+
+    def _write_message_record(self, item, date, daily_path, group_path,
+                              media_path=None):
+        if self.write_mode == "sqlite":
+            self.store.write_message(item, media_path)
+
         # Save message on group ID file
         if self.write_mode == "group" or self.write_mode == "both":
             message_group_filename = os.path.join(group_path, "mensagens_grupo_" + str(item["group_id"]) + ".json" )
 
             # Save message on file for all messages of the group
-            with open(message_group_filename, "a") as json_file:
-                json.dump(item, json_file)
-                print("", file=json_file)
+            self.writer.write(message_group_filename, item, item["data"])
 
         if self.write_mode == "day" or self.write_mode == "both":
-            message_day_filename = os.path.join(daily_path, "mensagens_" + message.date.strftime("%Y-%m-%d") + ".json")
+            message_day_filename = os.path.join(daily_path, "mensagens_" + date.strftime("%Y-%m-%d") + ".json")
 
             # Save message on file for all messages of the day
-            with open(message_day_filename, "a") as json_file:
-                json.dump(item, json_file)
-                print("", file=json_file)
+            self.writer.write(message_day_filename, item, item["data"])
     
-    def _save_notification(self, message, path='/data/notificacoes/'):
+    def _save_notification(self, message, path=None):
         """
         Escreve em formato json a notificação contida na mensagem no arquivo
         referente ao grupo em que ela foi enviada. Caso o arquivo do grupo
@@ -280,14 +745,13 @@ class TelegramCollector():
                 Caminho da pasta em que os arquivos de notificações serão
                 escritos.
         """
+        if path is None:
+            path = os.path.join(self.data_path, "notificacoes/")
         notification = dict()
 
         notification["message_id"] = message.id
         
-        try: 
-            notification["group_id"] = message.to_id.chat_id
-        except:
-            notification["group_id"] = message.to_id.channel_id
+        notification["group_id"] = get_group_id(message)
         notification["date"] = message.date.strftime("%Y-%m-%d %H:%M:%S")       
         notification["action"] = {"action_class" : type(message.action).__name__ , 
                                   "fields" : message.action.__dict__}
@@ -304,44 +768,503 @@ class TelegramCollector():
             path, "notificacoes_grupo_" + str(notification["group_id"]) + ".json" )
 
         # Save message on file for all messages of the group
-        with open(notification_group_filename, "a") as json_file:
-            json.dump(notification, json_file)
-            print("", file=json_file)
+        with WRITE_SECONDS.time(stage="record"):
+            if self.write_mode == "sqlite":
+                self.store.write_notification(notification)
+            else:
+                self.writer.write(notification_group_filename, notification,
+                                  notification["date"])
+        self.processed_ids.add(notification["group_id"], notification["message_id"])
+        self._release(notification["group_id"], notification["message_id"])
+        MESSAGES_SAVED.inc(group_id=notification["group_id"], kind="notification")
 
-    async def _run_unread_collector(self):
-        async_client = TelegramClient('/data/collector_local', self.api_id, self.api_hash)
-        group_names = {}
+    async def _flush_periodically(self):
+        """
+        Garante que registros acumulados e ids coletados cheguem ao disco
+        mesmo quando não há novas mensagens (e.g. durante a coleta ao vivo).
+        """
+        while True:
+            await asyncio.sleep(self.writer.flush_interval)
+            self._checkpoint()
+
+    async def _run_unread_collector(self, start_date, end_date):
+        """
+        Coleta as mensagens e notificações ao vivo. A cada conexão (e
+        reconexão), as mensagens enviadas enquanto o coletor estava
+        desconectado são buscadas para cada grupo a partir da sua marca
+        antes de os eventos ao vivo serem retomados. As mensagens ao vivo
+        persistidas avançam as marcas, de forma que a recuperação depende
+        apenas do tempo sem conexão.
+
+        Com várias contas, cada grupo é acompanhado apenas pela conta
+        atribuída a ele; os eventos recebidos pelas demais são ignorados.
+
+        Parâmetros
+        ------------
+            start_date : datetime.datetime
+                Data de início do período de coleta.
+            end_date : datetime.datetime
+                Data de término do período de coleta.
+        """
+        # FloodWaits are raised to the rate limiters instead of slept silently
+        async with self.pool.connect(flood_sleep_threshold=0) as clients:
+            group_names = {}
+            owned = [list() for _ in clients]
+            candidates = await self._list_candidates()
+            for key, account_dialogs in candidates.items():
+                # Live updates are never moved between accounts
+                index = self.pool.pick(key, account_dialogs, rebalance=False)
+                dialog = account_dialogs[index]
+                #TODO: Check why dialog.id is a negative number
+                group_names[str(abs(dialog.id))] = dialog.title
+                self.live_keys[dialog.entity.id] = self._watermark_key(dialog)
+                self.live_owners[dialog.entity.id] = index
+                owned[index].append(dialog)
+
+            self._start_download_workers()
+            self._start_event_workers()
+            try:
+                await asyncio.gather(*[
+                    self._run_live_client(index, client, owned[index],
+                                          group_names, start_date, end_date)
+                    for index, client in enumerate(clients)])
+            finally:
+                # Queued events may still enqueue media downloads
+                await self._stop_event_workers()
+                await self._stop_download_workers()
+                self._checkpoint()
+
+    async def _run_live_client(self, index, client, dialogs, group_names,
+                               start_date, end_date):
+        """
+        Recebe os eventos ao vivo de uma conta, reconectando e recuperando
+        as mensagens perdidas dos grupos atribuídos a ela.
 
-        @async_client.on(events.NewMessage)
+        Parâmetros
+        ------------
+            index : int
+                Índice da conta.
+            client : telethon.TelegramClient()
+                Cliente conectado da conta.
+            dialogs : list
+                Grupos atribuídos à conta.
+            group_names : dict
+                Nomes dos grupos, indexados pelo id em texto.
+        """
+        # Handlers only filter and enqueue; persistence runs in the workers
+        @client.on(events.NewMessage)
         async def event_handler(event):
             message = event.message
             if (self.collect_messages and message.to_id.chat_id and 
                     group_names[str(message.to_id.chat_id)] and 
+                    self.live_owners.get(get_group_id(message)) == index and
                     str(message.from_id) not in self.user_blacklist):
-                await self._save_message(message, group_names[str(message.to_id.chat_id)])
-                self._append_processed_id(message.id)
+                await self._enqueue_event(("message", message, group_names[str(message.to_id.chat_id)]))
 
-        @async_client.on(events.ChatAction)
+        @client.on(events.ChatAction)
         async def event_handler(event):
             message = event.action_message
             if (self.collect_notifications and message.to_id.chat_id and 
                     group_names[str(message.to_id.chat_id)] and 
+                    self.live_owners.get(get_group_id(message)) == index and
                     str(message.from_id) not in self.user_blacklist):
-                self._save_notification(message)
-                self._append_processed_id(message.id)
+                await self._enqueue_event(("notification", message, None))
                 if (type(message.action).__name__ == "MessageActionChatEditTitle") :
                     #in case the title changes
                     group_names[str(message.to_id.chat_id)] = message.action.title
 
-        await async_client.start()
+        reconnects = 0
+        while True:
+            if not client.is_connected():
+                await client.connect()
+            await self._catch_up_dialogs(client, dialogs, start_date,
+                                         end_date, index)
+            await client.run_until_disconnected()
+
+            reconnects += 1
+            if 0 <= self.max_reconnects < reconnects:
+                break
+            print("Disconnected from the API. Reconnecting in %d seconds" %
+                  (self.reconnect_delay))
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def _catch_up_dialogs(self, client, dialogs, start_date, end_date,
+                                index=0):
+        """
+        Recupera as atualizações perdidas pela sessão (client.catch_up()) e
+        busca, para cada grupo com marca, as mensagens mais novas que a
+        marca, usando a conta de índice index. Enquanto um grupo é
+        recuperado, incluindo as atualizações reenviadas pelo catch_up(),
+        as mensagens ao vivo dele não avançam a sua marca.
+        """
+        dialogs = [dialog for dialog in dialogs
+                   if self.watermarks.get(self._watermark_key(dialog)) is not None]
+        keys = [self._watermark_key(dialog) for dialog in dialogs]
+        self.catching_up.update(keys)
+        try:
+            await self.pool.limiters[index].call(client.catch_up)
+        except BaseException:
+            self.catching_up.difference_update(keys)
+            raise
+        semaphore = self.pool.semaphore(index)
+
+        async def catch_up(dialog):
+            key = self._watermark_key(dialog)
+            try:
+                async with semaphore:
+                    await self.pool.limiters[index].call(
+                        self._collect_newer_messages, client, dialog,
+                        self.watermarks.get(key), start_date, end_date)
+            except Exception:
+                print("Error catching up messages for " + str(dialog.id) + " - " + str(dialog.title))
+                traceback.print_exc()
+            finally:
+                self.catching_up.discard(key)
+
+        await asyncio.gather(*[catch_up(dialog) for dialog in dialogs])
+
+    def _advance_watermark(self, message):
+        """
+        Avança a marca do grupo até uma mensagem recebida ao vivo. Grupos
+        ainda sem marca passam a ter uma a partir dessa mensagem, o que
+        permite recuperar o que for perdido em uma desconexão.
 
-        async for dialog in async_client.iter_dialogs():
-            if ((dialog.is_group or dialog.is_channel) and dialog.title not in self.group_blacklist and
-                    str(abs(dialog.id)) not in self.group_blacklist):
-                #TODO: Check why dialog.id is a negative number
-                group_names[str(abs(dialog.id))] = dialog.title
+        Parâmetros
+        ------------
+            message : telethon.tl.custom.message.Message()
+                Mensagem persistida.
+        """
+        key = self.live_keys.get(get_group_id(message))
+        if key is None or key in self.catching_up:
+            return
+        mark = self.watermarks.get(key)
+        if mark is None:
+            self.watermarks.set(key, {
+                "max_id": message.id, "min_id": message.id,
+                "covered_since": message.date.strftime("%Y-%m-%d %H:%M:%S"),
+                "complete": False})
+        elif message.id > mark["max_id"]:
+            mark["max_id"] = message.id
+
+    async def _enqueue_event(self, event):
+        """
+        Envia um evento ao vivo para a fila de eventos. Com a fila cheia, a
+        espera retarda o processamento das atualizações até que os workers
+        a esvaziem (backpressure). Sem workers, o evento é processado
+        imediatamente.
+
+        Parâmetros
+        ------------
+            event : tuple
+                Tipo ("message" ou "notification"), mensagem e nome do grupo.
+        """
+        kind, message, dialog_name = event
+        group_id = get_group_id(message)
+        MESSAGES_FETCHED.inc(group_id=group_id)
+        # Updates replayed by catch_up() may also be fetched by the dialog
+        # catch-up; the first one to reserve the message saves it
+        if not self._reserve(group_id, message.id):
+            MESSAGES_SKIPPED.inc(group_id=group_id, reason="collected")
+            return
+        if self.event_queue is None:
+            await self._process_event(event)
+            return
+        if self.event_queue.full() and not self.event_queue_full:
+            self.event_queue_full = True
+            print("Event queue full (%d events). Slowing down update "
+                  "processing." % (self.event_queue.qsize()))
+        self.pending_events += 1
+        try:
+            await self.event_queue.put(event)
+        except BaseException:
+            self.pending_events -= 1
+            self._release(group_id, message.id)
+            raise
 
-        await async_client.run_until_disconnected()
+    async def _process_event(self, event):
+        """
+        Salva um evento ao vivo, já reservado por _enqueue_event().
+        """
+        kind, message, dialog_name = event
+        try:
+            if kind == "message":
+                await self._save_message(message, dialog_name)
+            else:
+                self._save_notification(message)
+        except BaseException:
+            self._release(get_group_id(message), message.id)
+            raise
+        self._advance_watermark(message)
+
+    async def _event_worker(self):
+        """
+        Consome a fila de eventos ao vivo em lotes: aguarda um evento e
+        processa junto os demais já enfileirados, até o tamanho do lote.
+        """
+        while True:
+            batch = [await self.event_queue.get()]
+            while (len(batch) < self.event_batch_size and
+                    not self.event_queue.empty()):
+                batch.append(self.event_queue.get_nowait())
+            try:
+                for event in batch:
+                    try:
+                        await self._process_event(event)
+                    except Exception:
+                        traceback.print_exc()
+                    finally:
+                        self.pending_events -= 1
+            finally:
+                for _ in batch:
+                    self.event_queue.task_done()
+                if self.event_queue.qsize() < self.event_queue.maxsize // 2:
+                    self.event_queue_full = False
+
+    def _start_event_workers(self):
+        """
+        Cria a fila de eventos ao vivo e inicia os workers. Com
+        "event_workers" igual a zero os eventos são processados nos próprios
+        handlers.
+        """
+        if self.event_workers <= 0:
+            return
+        self.event_queue = asyncio.Queue(maxsize=self.event_queue_size)
+        QUEUE_DEPTH.set_function(self.event_queue.qsize, queue="event")
+        self.event_tasks = [asyncio.ensure_future(self._event_worker())
+                            for _ in range(self.event_workers)]
+
+    async def _stop_event_workers(self):
+        """
+        Processa os eventos ainda enfileirados e encerra os workers.
+        """
+        if self.event_queue is None:
+            return
+        await self.event_queue.join()
+        for task in self.event_tasks:
+            task.cancel()
+        await asyncio.gather(*self.event_tasks, return_exceptions=True)
+        self.event_queue = None
+        self.event_tasks = list()
+
+    def _accept_dialog(self, dialog):
+        #TODO: Check why dialog.id is a negative number
+        return ((dialog.is_group or dialog.is_channel) and
+                dialog.title not in self.group_blacklist and
+                str(abs(dialog.id)) not in self.group_blacklist)
+
+    async def _list_candidates(self):
+        """
+        Lista os grupos a coletar e as contas que podem coletar cada um.
+        Canais podem ser coletados por qualquer conta que participa deles.
+        Nos grupos básicos os ids das mensagens são próprios de cada conta,
+        então cada grupo é coletado sempre pela mesma conta (ver
+        AccountOwners); grupos cuja conta não participa mais deles são
+        ignorados.
+        """
+        candidates = dict()
+        for key, account_dialogs in (await self.pool.list_dialogs(self._accept_dialog)).items():
+            dialog = next(iter(account_dialogs.values()))
+            if dialog.is_channel:
+                candidates[key] = account_dialogs
+                continue
+            collected = self.watermarks.get(self._watermark_key(dialog)) is not None
+            index = self.pool.owner(key, account_dialogs, collected)
+            if index is None:
+                print("Skipping " + str(dialog.id) + " - " + str(dialog.title) +
+                      ": its messages were collected by account " +
+                      str(self.owners.get(key)) + ", which is not a member anymore.")
+                continue
+            candidates[key] = {index: account_dialogs[index]}
+        # Owners are kept before any of their messages is persisted
+        self.owners.save()
+        return candidates
+
+    def _watermark_key(self, dialog):
+        """
+        Retorna a chave da marca de coleta do grupo. No modo "period" cada
+        janela de datas possui suas próprias marcas.
+
+        Parâmetros
+        ------------
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo ou canal coletado.
+        """
+        if self.collection_mode == 'period':
+            return "%d_%s_%s" % (abs(dialog.id), self.start_date, self.end_date)
+        return str(abs(dialog.id))
+
+    async def _collect_dialog(self, client, dialog, start_date, end_date):
+        """
+        Coleta o histórico de mensagens e notificações de um único grupo ou
+        canal. Pode ser executado concorrentemente para vários grupos com o
+        mesmo cliente, já que o estado compartilhado (ids coletados e
+        arquivos de saída) só é alterado sem pontos de suspensão.
+
+        Se o grupo já foi coletado antes, apenas as mensagens mais novas que
+        a sua marca são pedidas à API e a coleta do passado continua a partir
+        da mensagem mais antiga já alcançada.
+
+        Parâmetros
+        ------------
+            client : telethon.TelegramClient()
+                Cliente conectado à API do Telegram.
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo ou canal a ser coletado.
+            start_date : datetime.datetime
+                Data de início do período de coleta.
+            end_date : datetime.datetime
+                Data de término do período de coleta (Modo "period").
+        """
+        if   dialog.is_group:   inst = 'group'
+        if dialog.is_channel: inst = 'channel'
+        print("Collecting mssages for " + str(inst) + ":" + str(dialog.id) + " - " + str(dialog.title))
+
+        key = self._watermark_key(dialog)
+        mark = self.watermarks.get(key)
+        history_args = dict()
+        window_args = dict()
+        discarded = 0
+
+        if self.collection_mode == 'period':
+            # Ask the API only for messages up to the end of the period
+            # (offset_date is exclusive)
+            window_args["offset_date"] = end_date + datetime.timedelta(seconds=1)
+
+        if mark is not None:
+            discarded += await self._collect_newer_messages(
+                client, dialog, mark, start_date, end_date, window_args)
+
+            covered_since = pytz.UTC.localize(datetime.datetime.strptime(
+                mark["covered_since"], "%Y-%m-%d %H:%M:%S"))
+            if mark["complete"] or covered_since <= start_date:
+                self._report_discarded(dialog, discarded)
+                return
+            # Messages below min_id are already inside the period
+            history_args["offset_id"] = mark["min_id"]
+        else:
+            history_args.update(window_args)
+
+        # Walk backwards from the oldest message reached so far
+        async for message in client.iter_messages(dialog, **history_args):
+            new_mark = mark is None
+            if new_mark:
+                mark = {"max_id": message.id, "min_id": message.id,
+                        "covered_since": message.date.strftime("%Y-%m-%d %H:%M:%S"),
+                        "complete": False}
+            if (message.date < start_date):
+                discarded += 1
+                mark["covered_since"] = start_date.strftime("%Y-%m-%d %H:%M:%S")
+                if new_mark:
+                    self.watermarks.set(key, mark)
+                break
+            if (message.date > end_date and self.collection_mode == 'period'):
+                discarded += 1
+            else:
+                await self._collect_message(message, dialog)
+            mark["min_id"] = message.id
+            mark["covered_since"] = message.date.strftime("%Y-%m-%d %H:%M:%S")
+            if new_mark:
+                # A checkpoint during the first save must not persist a mark
+                # covering a message that was not written yet
+                self.watermarks.set(key, mark)
+        else:
+            if mark is not None:
+                mark["complete"] = True
+
+        self._report_discarded(dialog, discarded)
+
+    async def _collect_newer_messages(self, client, dialog, mark, start_date,
+                                      end_date, window_args=None):
+        """
+        Coleta as mensagens do grupo mais novas que a marca e, ao final,
+        avança a marca. Retorna o número de mensagens descartadas por
+        estarem fora do período.
+
+        Parâmetros
+        ------------
+            client : telethon.TelegramClient()
+                Cliente conectado à API do Telegram.
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo ou canal a ser coletado.
+            mark : dict
+                Marca do grupo (ver DialogWatermarks).
+            start_date : datetime.datetime
+                Data de início do período de coleta.
+            end_date : datetime.datetime
+                Data de término do período de coleta (Modo "period").
+            window_args : dict
+                Limites adicionais da consulta (e.g. offset_date).
+        """
+        discarded = 0
+        newest_id = None
+        async for message in client.iter_messages(dialog, min_id=mark["max_id"], **(window_args or {})):
+            if newest_id is None:
+                newest_id = message.id
+            if (message.date < start_date):
+                discarded += 1
+                break
+            if (message.date > end_date and self.collection_mode == 'period'):
+                discarded += 1
+                continue
+            await self._collect_message(message, dialog)
+
+        # The range above max_id is only contiguous after the full pass
+        if newest_id is not None:
+            mark["max_id"] = max(mark["max_id"], newest_id)
+        return discarded
+
+    def _report_discarded(self, dialog, discarded):
+        """
+        Contabiliza e informa as mensagens recebidas da API que estavam fora
+        do período de coleta.
+
+        Parâmetros
+        ------------
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo ou canal coletado.
+            discarded : int
+                Número de mensagens descartadas.
+        """
+        self.discarded_messages += discarded
+        if discarded:
+            group_id = dialog.entity.id
+            MESSAGES_FETCHED.inc(discarded, group_id=group_id)
+            MESSAGES_SKIPPED.inc(discarded, group_id=group_id, reason="period")
+        if discarded:
+            print("Discarded " + str(discarded) + " fetched messages outside the period for " +
+                  str(dialog.id) + " - " + str(dialog.title))
+
+    async def _collect_message(self, message, dialog):
+        """
+        Salva uma mensagem ou notificação do histórico, caso ela ainda não
+        tenha sido coletada e não esteja excluída da coleta.
+
+        Parâmetros
+        ------------
+            message : telethon.tl.custom.message.Message()
+                Objeto da mensagem coletada.
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo ou canal da mensagem.
+        """
+        group_id = get_group_id(message)
+        MESSAGES_FETCHED.inc(group_id=group_id)
+        if str(message.from_id) in self.user_blacklist:
+            MESSAGES_SKIPPED.inc(group_id=group_id, reason="blacklist")
+            return
+        if not self._reserve(group_id, message.id):
+            MESSAGES_SKIPPED.inc(group_id=group_id, reason="collected")
+            return
+
+        try:
+            if (not message.action) and self.collect_messages:
+                await self._save_message(message, dialog.entity.title)
+            elif message.action and self.collect_notifications:
+                self._save_notification(message)
+            else:
+                self._release(group_id, message.id)
+        except BaseException:
+            self._release(group_id, message.id)
+            raise
 
     async def run(self):
         """
@@ -350,66 +1273,110 @@ class TelegramCollector():
         """
 
         # Create data directories
-        pathlib.Path("/data/mensagens").mkdir(parents=True, exist_ok=True)
-        pathlib.Path("/data/image").mkdir(parents=True, exist_ok=True)
-        pathlib.Path("/data/others").mkdir(parents=True, exist_ok=True)
-        pathlib.Path("/data/audio").mkdir(parents=True, exist_ok=True)
-        pathlib.Path("/data/video").mkdir(parents=True, exist_ok=True)
-        pathlib.Path("/data/mensagens_grupo").mkdir(parents=True, exist_ok=True)
-        pathlib.Path("/data/notificacoes").mkdir(parents=True, exist_ok=True)
+        for folder in ["mensagens", "image", "others", "audio", "video",
+                       "mensagens_grupo", "notificacoes"]:
+            pathlib.Path(self.data_path, folder).mkdir(parents=True, exist_ok=True)
 
         # Get start and end dates
         utc = pytz.UTC
         start_date = utc.localize(datetime.datetime.strptime(self.start_date, "%Y-%m-%d"))
         end_date = utc.localize(datetime.datetime.strptime(self.end_date, "%Y-%m-%d"))
 
+        # Every account writes to the same stores, which skip repeated ids
+        self.owners = AccountOwners(
+            os.path.join(self.data_path, "account_owners.json"))
+        self.pool = AccountPool(self.accounts, self.client_class,
+                                self.limiter_args, self.max_concurrent_dialogs,
+                                self.rebalance_wait, self.owners)
+
         # Load previous saved messages
-        previous_ids = self._get_load_messages()
+        self.processed_ids = ProcessedIdStore(
+            os.path.join(self.data_path, "processed_ids"),
+            os.path.join(self.data_path, "mid_file.txt"),
+            output_paths=[os.path.join(self.data_path, folder) for folder in
+                          ["mensagens_grupo", "mensagens", "notificacoes"]])
+        self.watermarks = DialogWatermarks(
+            os.path.join(self.data_path, "watermarks.json"))
+        self.media_index = MediaIndex(
+            os.path.join(self.data_path, "media_index.json"))
+        if self.write_mode == 'sqlite':
+            self.store = SqliteStore(self.sqlite_path,
+                                     max_buffered=self.writer.max_buffered,
+                                     flush_interval=self.writer.flush_interval)
+
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = metrics.start_server(self.metrics_port)
+
+        # Hashes are computed outside the event loop
+        self._start_hash_pool()
+        flush_task = asyncio.ensure_future(self._flush_periodically())
         print("Starting " + self.collection_mode + " collection.")
         try:
             if (self.collection_mode != 'unread'):
-                async with TelegramClient('/data/collector_local', self.api_id, self.api_hash) as client:
+                # FloodWaits are raised to the rate limiters instead of
+                # slept silently, so they can move dialogs between accounts
+                async with self.pool.connect(flood_sleep_threshold=0) as clients:
                 
                     print("Susccessfully connected to API")
-                    async for dialog in client.iter_dialogs():
-                        #TODO: Check why dialog.id is a negative number
-                        if ((dialog.is_group or dialog.is_channel) and dialog.title not in self.group_blacklist and
-                            str(abs(dialog.id)) not in self.group_blacklist):
-                            
-                            if   dialog.is_group:   inst = 'group'
-                            if dialog.is_channel: inst = 'channel'
-                            print("Collecting mssages for " + str(inst) + ":" + str(dialog.id) + " - " + str(dialog.title))
-                            async for message in client.iter_messages(dialog):
-                                if (message.date < start_date):
-                                    break
-                                if (message.date > end_date and self.collection_mode == 'period'):
-                                    continue
-                                
-                                if (message.id in previous_ids or str(message.from_id) in self.user_blacklist):
-                                    continue
-
-                                if (not message.action) and self.collect_messages:
-                                    await self._save_message(message, dialog.entity.title)
-                                    previous_ids.add(message.id)   
-                                elif message.action and self.collect_notifications:
-                                    self._save_notification(message)
-                                    previous_ids.add(message.id)   
-
-            self._save_processed_ids(previous_ids)
-
-            print("Finished collection.")
+                    candidates = await self._list_candidates()
+                    dialogs = [next(iter(account_dialogs.values()))
+                               for account_dialogs in candidates.values()]
+
+                    async def collect(key, account_dialogs):
+                        # Message ids of basic groups differ between
+                        # accounts, so only channels may change account
+                        dialog = next(iter(account_dialogs.values()))
+                        # A retried dialog resumes from its watermark
+                        await self.pool.run(
+                            key, account_dialogs,
+                            lambda index: self._collect_dialog(
+                                clients[index], account_dialogs[index],
+                                start_date, end_date),
+                            rebalance=dialog.is_channel)
+
+                    self._start_download_workers()
+                    try:
+                        results = await asyncio.gather(
+                            *[collect(key, account_dialogs) for key, account_dialogs
+                              in candidates.items()], return_exceptions=True)
+                    finally:
+                        # Downloads need the client, so drain them before disconnecting
+                        await self._stop_download_workers()
+                    for dialog, result in zip(dialogs, results):
+                        if isinstance(result, Exception):
+                            print("Error collecting messages for " + str(dialog.id) + " - " + str(dialog.title))
+                            traceback.print_exception(type(result), result, result.__traceback__)
+
+            self._checkpoint()
+
+            print("Finished collection. " + str(self.discarded_messages) +
+                  " fetched messages were outside the period.")
         except Exception as e:
             traceback.print_exc()
-            self._save_processed_ids(previous_ids)
-
-        if (self.collection_mode == 'unread' or 
-                self.collection_mode == 'continuous'): 
-            print("Starting unread message collection.")
-            await self._run_unread_collector()
+            self._checkpoint()
 
-
-
-async def main():
+        try:
+            if (self.collection_mode == 'unread' or 
+                    self.collection_mode == 'continuous'): 
+                print("Starting unread message collection.")
+                await self._run_unread_collector(start_date, end_date)
+        finally:
+            flush_task.cancel()
+            self.writer.close()
+            if self.store is not None:
+                self.store.close()
+            self.processed_ids.close()
+            self.media_index.close()
+            self._stop_hash_pool()
+            metrics.stop_server(metrics_server)
+
+
+
+def get_parser():
+    """
+    Retorna o parser dos argumentos de linha de comando do coletor.
+    """
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-m", "--collection_mode", type=str,
@@ -426,7 +1393,12 @@ async def main():
                         " \'period\').", default='2999-12-31')
 
     parser.add_argument("-w", "--write_mode", type=str,
-                        help="Modo de salvamento das mensagens no arquivos de saída(\'both\', \'day\', \'group\'). ", default='both')
+                        help="Modo de salvamento das mensagens no arquivos de saída(\'both\', \'day\', \'group\', \'sqlite\'). ", default='both')
+
+    parser.add_argument("--sqlite_path", type=str,
+                        help="Banco de dados das mensagens, notificações e"
+                        " mídias no modo de escrita \'sqlite\' (por padrão,"
+                        " telegram.db em data_path).", default=None)
 
     parser.add_argument("--collect_messages", type=bool,
                         help="Se mensagens de texto devem ser coletadas"
@@ -476,6 +1448,110 @@ async def main():
                         help="Lista de usuários que devem ser excluídos da"
                         " coleta", default=[])
 
+    parser.add_argument("--max_concurrent_dialogs", type=int,
+                        help="Número máximo de grupos cujo histórico é coletado"
+                        " simultaneamente.", default=1)
+
+    parser.add_argument("--download_workers", type=int,
+                        help="Número de workers que baixam mídias em paralelo"
+                        " (0 baixa as mídias durante a iteração).", default=4)
+
+    parser.add_argument("--download_queue_size", type=int,
+                        help="Tamanho máximo da fila de mídias aguardando"
+                        " download.", default=100)
+
+    parser.add_argument("--event_workers", type=int,
+                        help="Número de workers que persistem os eventos da"
+                        " coleta ao vivo (0 processa nos handlers).",
+                        default=2)
+
+    parser.add_argument("--event_queue_size", type=int,
+                        help="Tamanho máximo da fila de eventos da coleta ao"
+                        " vivo.", default=1000)
+
+    parser.add_argument("--event_batch_size", type=int,
+                        help="Número máximo de eventos processados por lote.",
+                        default=100)
+
+    parser.add_argument("--reconnect_delay", type=float,
+                        help="Espera (em segundos) antes de reconectar a"
+                        " coleta ao vivo.", default=10.0)
+
+    parser.add_argument("--max_reconnects", type=int,
+                        help="Número máximo de reconexões da coleta ao vivo"
+                        " (negativo para reconectar sempre).", default=-1)
+
+    parser.add_argument("--hash_workers", type=int,
+                        help="Número de workers que calculam checksums e"
+                        " phashes fora do loop de eventos (0 calcula no"
+                        " próprio loop).", default=2)
+
+    parser.add_argument("--hash_executor", type=str,
+                        help="Tipo de pool usado no cálculo dos hashes"
+                        " (\'process\' ou \'thread\').", default='process')
+
+    parser.add_argument("--writer_max_open_files", type=int,
+                        help="Número máximo de arquivos de saída mantidos"
+                        " abertos.", default=256)
+
+    parser.add_argument("--writer_buffer_size", type=int,
+                        help="Número de registros acumulados antes da escrita"
+                        " em disco.", default=1000)
+
+    parser.add_argument("--writer_flush_interval", type=float,
+                        help="Intervalo máximo (em segundos) entre escritas"
+                        " em disco.", default=5.0)
+
+    parser.add_argument("--writer_fsync", type=str,
+                        help="Política de fsync dos arquivos de saída"
+                        " (\'never\', \'flush\', \'close\').", default='never')
+
+    parser.add_argument("--writer_compression", type=str,
+                        help="Compressão dos arquivos de saída (\'none\' ou"
+                        " \'gzip\', em segmentos rotacionados).",
+                        default='none')
+
+    parser.add_argument("--writer_segment_size", type=int,
+                        help="Tamanho (em bytes) que dispara a rotação dos"
+                        " segmentos comprimidos (0 não rotaciona por"
+                        " tamanho).", default=64 * 1024 * 1024)
+
+    parser.add_argument("--writer_segment_interval", type=float,
+                        help="Idade (em segundos) que dispara a rotação dos"
+                        " segmentos comprimidos (0 não rotaciona por idade).",
+                        default=0)
+
+    parser.add_argument("--rate_min_interval", type=float,
+                        help="Intervalo mínimo (em segundos) entre"
+                        " requisições à API.", default=0.0)
+
+    parser.add_argument("--rate_max_interval", type=float,
+                        help="Intervalo máximo (em segundos) entre"
+                        " requisições após FloodWaits.", default=60.0)
+
+    parser.add_argument("--flood_max_retries", type=int,
+                        help="Número máximo de novas tentativas de uma"
+                        " requisição após FloodWait.", default=5)
+
+    parser.add_argument("--rebalance_wait", type=float,
+                        help="Espera por FloodWait (em segundos) a partir da"
+                        " qual os grupos de uma conta passam a ser coletados"
+                        " por outra (coleta com várias contas).", default=30.0)
+
+    parser.add_argument("--metrics_port", type=int,
+                        help="Porta do endpoint de métricas no formato do"
+                        " Prometheus (0 desativa).", default=0)
+
+    parser.add_argument("--accounts", type=str,
+                        help="Arquivo json com a lista de contas da coleta"
+                        " (\'session\', \'api_id\' e \'api_hash\' de cada"
+                        " uma). Os grupos são divididos entre as contas.")
+
+    parser.add_argument("--data_path", type=str,
+                        help="Pasta em que as mensagens, mídias, o estado da"
+                        " coleta e a sessão do Telegram são salvos.",
+                        default='/data')
+
     parser.add_argument("--api_id", type=str,
                         help="ID da API de Coleta gerado em my.telegram.org (Dado sensível)")
 
@@ -494,7 +1570,11 @@ async def main():
                         "arquivo sobescreveram os argumentos de linha de "
                         "comando, caso eles sejam fornecidos.")
 
-    args = parser.parse_args()
+    return parser
+
+
+async def main():
+    args = get_parser().parse_args()
 
     try:
         collector = TelegramCollector(args)
@@ -0,0 +1,364 @@
+import collections
+import gzip
+import json
+import os
+import time
+import glob
+import zlib
+
+
+def get_index_path(path):
+    """
+    Caminho do índice de segmentos de um arquivo de saída (e.g.
+    mensagens_2020-01-01.index.json).
+    """
+    root, ext = os.path.splitext(path)
+    return root + '.index' + ext
+
+
+def get_segment_path(path, number):
+    """
+    Caminho de um segmento comprimido de um arquivo de saída (e.g.
+    mensagens_2020-01-01.00000.json.gz).
+    """
+    root, ext = os.path.splitext(path)
+    return '%s.%05d%s.gz' % (root, number, ext)
+
+
+def load_segments(path):
+    """
+    Retorna as entradas do índice de segmentos de um arquivo de saída
+    (lista vazia se o arquivo não foi escrito em segmentos).
+    """
+    index_path = get_index_path(path)
+    if not os.path.isfile(index_path):
+        return list()
+    with open(index_path, 'r') as json_file:
+        return json.load(json_file)
+
+
+def list_segmented(directory):
+    """
+    Retorna os arquivos de saída de uma pasta escritos em segmentos.
+    """
+    paths = list()
+    for index_path in sorted(glob.glob(os.path.join(directory, '*.index.json'))):
+        paths.append(index_path[:-len('.index.json')] + '.json')
+    return paths
+
+
+def _overlaps(entry, start, end):
+    if entry['start'] is None:
+        return True
+    return ((start is None or entry['end'] >= start) and
+            (end is None or entry['start'] <= end))
+
+
+def get_segments(path, start=None, end=None):
+    """
+    Retorna os caminhos dos segmentos de um arquivo de saída cujo intervalo
+    de datas intersecta o período indicado.
+    """
+    return [os.path.join(os.path.dirname(path), entry['file'])
+            for entry in load_segments(path) if _overlaps(entry, start, end)]
+
+
+def _read_segment_lines(segment_path, chunk_size=64 * 1024):
+    """
+    Lê as linhas completas de um segmento gzip, membro a membro. Um membro
+    truncado ou corrompido (e.g. de um coletor interrompido) encerra a
+    leitura do segmento, mantendo as linhas já decodificadas.
+    """
+    pending = b''
+    decompressor = zlib.decompressobj(wbits=31)
+    with open(segment_path, 'rb') as gz_file:
+        data = gz_file.read(chunk_size)
+        while data:
+            backup = decompressor.copy()
+            try:
+                pending += decompressor.decompress(data)
+            except zlib.error:
+                # Recovers the output that precedes the corrupt data
+                for start in range(len(data)):
+                    try:
+                        pending += backup.decompress(data[start:start + 1])
+                    except zlib.error:
+                        break
+                for line in pending.split(b'\n')[:-1]:
+                    yield line
+                break
+            lines = pending.split(b'\n')
+            # A truncated line ends an interrupted segment
+            pending = lines.pop()
+            for line in lines:
+                yield line
+            if decompressor.eof:
+                data = decompressor.unused_data
+                decompressor = zlib.decompressobj(wbits=31)
+                if data:
+                    continue
+            data = gz_file.read(chunk_size)
+
+
+def read_records(path, start=None, end=None):
+    """
+    Lê os registros de um arquivo de saída: o arquivo sem compressão, se
+    existir, e os segmentos comprimidos cujo intervalo de datas intersecta o
+    período. Os demais segmentos não são abertos.
+
+    Parâmetros
+    ------------
+        path : str
+            Caminho do arquivo de saída.
+        start : str
+            Data mínima dos registros (None para não limitar).
+        end : str
+            Data máxima dos registros (None para não limitar).
+    """
+    if os.path.isfile(path):
+        with open(path, 'r') as json_file:
+            for line in json_file:
+                yield json.loads(line.strip())
+
+    for segment_path in get_segments(path, start, end):
+        for line in _read_segment_lines(segment_path):
+            yield json.loads(line.decode('utf-8'))
+
+
+def get_stamp(path, start=None, end=None):
+    """
+    Tamanho e data de modificação do arquivo e dos segmentos lidos por
+    read_records(), que mudam sempre que registros são escritos.
+    """
+    stamp = list()
+    for file_path in [path] + get_segments(path, start, end):
+        if os.path.isfile(file_path):
+            stat = os.stat(file_path)
+            stamp.append((os.path.basename(file_path), stat.st_size,
+                          stat.st_mtime_ns))
+    return tuple(stamp)
+
+
+class JsonlWriter():
+    """
+    Escritor de arquivos json (um registro por linha) que mantém um cache
+    LRU de arquivos abertos e acumula os registros em memória, escrevendo-os
+    em lote. Evita abrir e fechar os arquivos de saída a cada mensagem
+    coletada.
+
+    Com compressão, cada arquivo de saída é escrito em segmentos gzip que
+    são rotacionados por tamanho e/ou idade. Um índice ao lado dos
+    segmentos registra o intervalo de datas de cada um, permitindo que as
+    leituras ignorem os segmentos fora do período desejado.
+
+    Atributos
+    -----------
+    max_open_files : int
+            Número máximo de arquivos mantidos abertos simultaneamente.
+    max_buffered : int
+            Número de registros acumulados que dispara a escrita em disco.
+    flush_interval : float
+            Intervalo máximo (em segundos) entre duas escritas em disco.
+    fsync : str
+            Política de sincronização com o disco ("never", "flush" ou
+            "close").
+    compression : str
+            Compressão dos arquivos de saída ("none" ou "gzip").
+    segment_size : int
+            Tamanho (em bytes comprimidos) que dispara a rotação do segmento
+            (0 não rotaciona por tamanho).
+    segment_interval : float
+            Idade (em segundos) que dispara a rotação do segmento (0 não
+            rotaciona por idade).
+
+    Métodos
+    -----------
+    write(path, record, date)
+        Acumula um registro para ser escrito no arquivo indicado.
+    flush()
+        Escreve todos os registros acumulados.
+    close()
+        Escreve os registros acumulados e fecha todos os arquivos.
+    """
+
+    def __init__(self, max_open_files=256, max_buffered=1000,
+                 flush_interval=5.0, fsync='never', compression='none',
+                 segment_size=0, segment_interval=0):
+        if fsync not in ['never', 'flush', 'close']:
+            print('Fsync policy invalid <%s>!! Using <never> instead' % (fsync))
+            fsync = 'never'
+        if compression not in ['none', 'gzip']:
+            print('Compression invalid <%s>!! Using <none> instead' % (
+                compression))
+            compression = 'none'
+
+        self.max_open_files = max(1, max_open_files)
+        self.max_buffered = max(1, max_buffered)
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+        self.compression = compression
+        self.segment_size = segment_size
+        self.segment_interval = segment_interval
+        self.segments = dict()
+        self.handles = collections.OrderedDict()
+        self.buffers = dict()
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def write(self, path, record, date=None):
+        """
+        Acumula um registro para ser escrito no arquivo indicado. Os
+        registros são escritos quando algum dos limites é atingido.
+
+        Parâmetros
+        ------------
+            path : str
+                Caminho do arquivo de saída.
+            record : dict
+                Registro a ser escrito.
+            date : str
+                Data do registro ("%Y-%m-%d %H:%M:%S"), registrada no índice
+                dos segmentos.
+        """
+        if self.compression != 'none':
+            self._add_to_segment(path, date)
+        self.buffers.setdefault(path, list()).append(json.dumps(record) + "\n")
+        self.buffered += 1
+        if self.buffered >= self.max_buffered:
+            self.flush()
+        else:
+            self.flush_if_due()
+
+    def flush_if_due(self):
+        """
+        Escreve os registros acumulados caso o intervalo máximo entre
+        escritas tenha sido atingido.
+        """
+        if (self.buffered and
+                time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Escreve todos os registros acumulados nos respectivos arquivos. Os
+        índices dos segmentos são escritos antes dos registros, de forma que
+        o intervalo de datas de um segmento nunca é menor que o de seus
+        registros.
+        """
+        self._save_indexes()
+        for path, lines in self.buffers.items():
+            self._write_lines(path, lines)
+
+        self.buffers = dict()
+        self.buffered = 0
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        """
+        Escreve os registros acumulados e fecha todos os arquivos abertos.
+        """
+        self.flush()
+        while self.handles:
+            _, json_file = self.handles.popitem(last=False)
+            self._close_handle(json_file)
+
+    def _get_handle(self, path):
+        """
+        Retorna o arquivo aberto para o caminho, abrindo-o se necessário e
+        fechando o arquivo usado há mais tempo quando o limite é atingido.
+
+        Parâmetros
+        ------------
+            path : str
+                Caminho do arquivo de saída.
+        """
+        if path in self.handles:
+            self.handles.move_to_end(path)
+            return self.handles[path]
+
+        while len(self.handles) >= self.max_open_files:
+            _, json_file = self.handles.popitem(last=False)
+            self._close_handle(json_file)
+
+        if self.compression == 'gzip':
+            segment = self.segments[path][-1]
+            segment_path = os.path.join(os.path.dirname(path), segment['file'])
+            json_file = gzip.open(segment_path, "ab")
+        else:
+            json_file = open(path, "a")
+        self.handles[path] = json_file
+        return json_file
+
+    def _write_lines(self, path, lines):
+        json_file = self._get_handle(path)
+        if self.compression == 'gzip':
+            json_file.write("".join(lines).encode('utf-8'))
+            json_file.flush()
+            self.segments[path][-1]['size'] = os.fstat(json_file.fileno()).st_size
+        else:
+            json_file.write("".join(lines))
+            json_file.flush()
+        if self.fsync == 'flush':
+            os.fsync(json_file.fileno())
+
+    def _add_to_segment(self, path, date):
+        """
+        Registra um novo registro no segmento atual do arquivo, iniciando um
+        novo segmento quando o atual atinge o tamanho ou a idade máxima.
+        """
+        restarted = False
+        if path not in self.segments:
+            self.segments[path] = load_segments(path)
+            # The last segment of a previous run may end in an unfinished
+            # gzip member (e.g. the collector was killed); appending to it
+            # would leave the new records behind a truncated stream
+            restarted = bool(self.segments[path])
+        segments = self.segments[path]
+
+        if not segments or restarted or self._segment_is_full(segments[-1]):
+            if segments:
+                # Buffered records belong to the segment being closed
+                if path in self.buffers:
+                    self._save_indexes()
+                    self.buffered -= len(self.buffers[path])
+                    self._write_lines(path, self.buffers.pop(path))
+                if path in self.handles:
+                    self._close_handle(self.handles.pop(path))
+            number = len(segments)
+            segments.append({
+                'file': os.path.basename(get_segment_path(path, number)),
+                'start': date, 'end': date, 'records': 0, 'size': 0,
+                'created': time.time()})
+
+        segment = segments[-1]
+        if date is not None:
+            if segment['start'] is None or date < segment['start']:
+                segment['start'] = date
+            if segment['end'] is None or date > segment['end']:
+                segment['end'] = date
+        segment['records'] += 1
+        segment['dirty'] = True
+
+    def _segment_is_full(self, segment):
+        if segment['records'] == 0:
+            return False
+        if self.segment_size and segment['size'] >= self.segment_size:
+            return True
+        return bool(self.segment_interval and
+                    time.time() - segment['created'] >= self.segment_interval)
+
+    def _save_indexes(self):
+        for path, segments in self.segments.items():
+            dirty = [segment.pop('dirty', False) for segment in segments]
+            if not any(dirty):
+                continue
+            index_path = get_index_path(path)
+            with open(index_path + '.temp', 'w') as json_file:
+                json.dump(segments, json_file)
+            os.replace(index_path + '.temp', index_path)
+
+    def _close_handle(self, json_file):
+        if self.fsync == 'close':
+            json_file.flush()
+            os.fsync(json_file.fileno())
+        json_file.close()
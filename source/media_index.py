@@ -0,0 +1,69 @@
+import json
+import os
+
+
+def get_media_key(message):
+    """
+    Retorna a identidade da mídia da mensagem no Telegram (id da foto ou
+    do documento). Mídias encaminhadas para vários grupos mantêm o mesmo
+    id. Retorna None para mídias sem identidade.
+
+    Parâmetros
+    ------------
+        message : telethon.tl.custom.message.Message()
+            Objeto da mensagem coletada.
+    """
+    if message.photo is not None:
+        return 'photo:%d' % (message.photo.id)
+    if message.document is not None:
+        return 'document:%d' % (message.document.id)
+    return None
+
+
+class MediaIndex():
+    """
+    Índice persistente das mídias já baixadas, indexado pela identidade da
+    mídia no Telegram. Cada entrada guarda o caminho do arquivo, o checksum
+    e o phash (quando calculado), permitindo reaproveitá-los quando a mesma
+    mídia aparece novamente. As entradas são acrescentadas a um arquivo
+    json (uma por linha); em caso de repetição vale a última.
+
+    Atributos
+    -----------
+    path : str
+            Caminho do arquivo do índice.
+
+    Métodos
+    -----------
+    get(key)
+        Retorna a entrada de uma mídia (ou None).
+    add(key, entry)
+        Adiciona ou atualiza a entrada de uma mídia.
+    """
+
+    def __init__(self, path='/data/media_index.json'):
+        self.path = path
+        self.entries = dict()
+        if os.path.isfile(path):
+            with open(path, 'r') as json_file:
+                for line in json_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Interrupted write at the end of the file
+                        continue
+                    self.entries[entry.pop('key')] = entry
+        self.file = open(path, 'a')
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def add(self, key, entry):
+        self.entries[key] = entry
+        self.file.write(json.dumps(dict(entry, key=key)) + '\n')
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,69 @@
+import json
+import os
+
+
+class MembershipState():
+    """
+    Guarda, para cada grupo, os integrantes vistos na última coleta de
+    metadados e o número de coletas desde o último checkpoint completo.
+    Permite que uma nova coleta escreva apenas as diferenças (entradas,
+    saídas e alterações de perfil) em relação à anterior.
+
+    Cada grupo é guardado em um arquivo json próprio, escrito de forma
+    atômica ao fim da coleta do grupo.
+
+    Atributos
+    -----------
+    path : str
+            Pasta dos arquivos de estado.
+
+    Métodos
+    -----------
+    load(group_id)
+        Retorna os integrantes e o número de coletas desde o checkpoint.
+    save(group_id, members, runs)
+        Substitui o estado de um grupo.
+    """
+
+    def __init__(self, path='/data/metadata_state/'):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+
+    def _get_filename(self, group_id):
+        return os.path.join(self.path, 'membros_%s.json' % (group_id))
+
+    def load(self, group_id):
+        """
+        Retorna os integrantes do grupo (dicionário indexado pelo id do
+        usuário, em texto) e o número de coletas desde o último checkpoint.
+        Retorna (None, 0) se o grupo ainda não foi coletado.
+
+        Parâmetros
+        ------------
+            group_id : int
+                Id do grupo.
+        """
+        filename = self._get_filename(group_id)
+        if not os.path.isfile(filename):
+            return None, 0
+        with open(filename, 'r') as json_file:
+            state = json.load(json_file)
+        return state['members'], state['runs']
+
+    def save(self, group_id, members, runs):
+        """
+        Substitui o estado do grupo.
+
+        Parâmetros
+        ------------
+            group_id : int
+                Id do grupo.
+            members : dict
+                Integrantes do grupo indexados pelo id do usuário.
+            runs : int
+                Número de coletas desde o último checkpoint.
+        """
+        filename = self._get_filename(group_id)
+        with open(filename + '.temp', 'w') as json_file:
+            json.dump({'runs': runs, 'members': members}, json_file)
+        os.replace(filename + '.temp', filename)
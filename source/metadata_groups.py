@@ -1,4 +1,4 @@
-from telethon import TelegramClient, events
+from telethon import TelegramClient, events, functions, types
 
 import asyncio
 import os
@@ -7,9 +7,37 @@ import json
 import argparse
 import traceback
 import datetime
-import random
 import time
 
+from accounts import AccountPool, load_accounts
+from membership_state import MembershipState
+import metrics
+
+# Members per GetParticipantsRequest (the API maximum)
+PARTICIPANTS_PAGE = 200
+
+# Fields whose change is reported in the "diff" membership mode
+PROFILE_FIELDS = ['username', 'first_name', 'last_name', 'number', 'isBot',
+                  'photo_id']
+
+GROUPS_COLLECTED = metrics.counter(
+    'telegram_metadata_groups_total', 'Grupos com metadados coletados.',
+    ['group_type'])
+GROUP_SECONDS = metrics.histogram(
+    'telegram_metadata_group_seconds', 'Tempo de coleta de cada grupo.')
+MEMBERS_LISTED = metrics.counter(
+    'telegram_metadata_members_total', 'Integrantes listados.', ['group_id'])
+MEMBERSHIP_EVENTS = metrics.counter(
+    'telegram_membership_events_total',
+    'Registros escritos em membros.json no modo "diff".', ['event'])
+PROFILE_PICS = metrics.counter(
+    'telegram_profile_pics_total',
+    'Fotos de perfil baixadas ("downloaded"), já existentes ("cached") ou'
+    ' com erro ("failed").', ['result'])
+PROFILE_PIC_SECONDS = metrics.histogram(
+    'telegram_profile_pic_download_seconds',
+    'Tempo de download das fotos de perfil.')
+
 class GroupMetadataCollector():
     """
     Classe que encapsula o coletor de metadados de grupos do Telegram. Possui
@@ -21,6 +49,30 @@ class GroupMetadataCollector():
     -----------
     group_blacklist : list
             Lista de ids de grupos que devem ser excluídos da coleta.
+    accounts : list
+            Contas usadas na coleta ("session", "api_id" e "api_hash"). Com
+            mais de uma conta os grupos são divididos entre elas.
+    client_class : type
+            Classe do cliente do Telegram (substituível em testes).
+    rebalance_wait : float
+            Espera por FloodWait (em segundos) a partir da qual os grupos de
+            uma conta passam a ser coletados por outra.
+    metrics_port : int
+            Porta do endpoint de métricas (0 desativa).
+    profile_pic_path : str
+            Pasta das fotos de perfil, compartilhada entre as coletas. Cada
+            foto é identificada pelo id do usuário e pelo id da foto, e só é
+            baixada novamente quando o usuário a troca.
+    profile_pic_workers : int
+            Número máximo de fotos de perfil baixadas simultaneamente.
+    membership_mode : str
+            Forma de registrar os integrantes dos grupos: "full" (lista
+            completa em grupos.json) ou "diff" (apenas entradas, saídas e
+            alterações de perfil em membros.json, escritas à medida que os
+            integrantes são listados).
+    checkpoint_every : int
+            No modo "diff", a cada quantas coletas de um grupo todos os seus
+            integrantes são escritos (checkpoint completo).
 
     Métodos
     -----------
@@ -55,12 +107,309 @@ class GroupMetadataCollector():
         self.api_hash              = args_dict["api_hash"]
         self.profile_pic           = args_dict["profile_pic"]
         self.profiles              = args_dict["profiles"]
+        self.accounts              = load_accounts(args_dict)
+        self.client_class          = TelegramClient
+        self.rebalance_wait        = float(args_dict["rebalance_wait"])
+        self.metrics_port          = int(args_dict["metrics_port"])
+        self.limiter_args          = {
+            "min_interval": float(args_dict["rate_min_interval"]),
+            "max_interval": float(args_dict["rate_max_interval"]),
+            "max_retries": int(args_dict["flood_max_retries"])}
+        self.profile_pic_path      = args_dict["profile_pic_path"]
+        self.profile_pic_workers   = max(1, int(args_dict["profile_pic_workers"]))
+        if args_dict["membership_mode"] not in ['full', 'diff']:
+            print('Membership mode invalid <%s>!! Using <full> instead' % (
+                args_dict["membership_mode"]))
+            args_dict["membership_mode"] = 'full'
+        self.membership_mode       = args_dict["membership_mode"]
+        self.checkpoint_every      = max(1, int(args_dict["checkpoint_every"]))
+        self.membership_state      = None
+
+    def _accept_dialog(self, dialog):
+        return ((dialog.is_group or dialog.is_channel) and
+                dialog.title not in self.group_blacklist and
+                str(abs(dialog.id)) not in self.group_blacklist)
+
+    async def _iter_participants(self, client, dialog, limiter):
+        """
+        Lista os integrantes do grupo. Em canais e supergrupos a listagem é
+        feita em páginas, cada uma pedida pelo limitador: um FloodWaitError
+        repete apenas a página em que ocorreu, sem recomeçar a listagem.
+        Grupos básicos são listados em uma única requisição.
+
+        Parâmetros
+        ------------
+            client : telethon.TelegramClient()
+                Cliente conectado à API do Telegram.
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo listado.
+            limiter : RateLimiter
+                Limitador de requisições da conta do cliente.
+        """
+        if not dialog.is_channel:
+            for member in await limiter.call(client.get_participants, dialog):
+                yield member
+            return
+
+        seen = set()
+        offset = 0
+        while True:
+            page = await limiter.call(client, functions.channels.GetParticipantsRequest(
+                dialog.input_entity, types.ChannelParticipantsSearch(''),
+                offset, PARTICIPANTS_PAGE, 0))
+            if not page.users:
+                return
+            offset += len(page.participants)
+            users = {user.id: user for user in page.users}
+            for participant in page.participants:
+                if isinstance(participant, types.ChannelParticipantLeft):
+                    continue
+                user_id = getattr(participant, 'user_id', None)
+                if user_id is None:
+                    # Banned participants are given by peer
+                    user_id = getattr(participant.peer, 'user_id', None)
+                user = users.get(user_id)
+                if user is None or user_id in seen:
+                    continue
+                seen.add(user_id)
+                user.participant = participant
+                yield user
+
+    async def _get_participants(self, client, dialog, limiter):
+        return [member async for member in
+                self._iter_participants(client, dialog, limiter)]
+
+    def _get_user(self, member):
+        user = dict()
+        #TODO: changed some stuff here.
+        user['id'] = member.id
+        user['username'] = member.username
+        user['first_name'] = member.first_name
+        user['last_name'] = member.last_name
+        user['number'] = member.phone
+        user['isBot'] = member.bot
+        user['profile_pic'] = None
+        return user
+
+    def _get_profile_pic_filename(self, member):
+        """
+        Retorna o caminho da foto de perfil atual do usuário no armazenamento
+        compartilhado, ou None se o usuário não possui foto.
+
+        Parâmetros
+        ------------
+            member : telethon.tl.types.User()
+                Integrante do grupo.
+        """
+        # UserProfilePhotoEmpty has no photo_id
+        photo_id = getattr(member.photo, 'photo_id', None)
+        if photo_id is None:
+            return None
+        return os.path.join(self.profile_pic_path,
+                            '%d_%d.jpg' % (member.id, photo_id))
+
+    async def _download_profile_pic(self, client, member, filename, semaphore,
+                                    limiter):
+        """
+        Baixa a foto de perfil do usuário. O arquivo é escrito com outro
+        nome e renomeado ao final, de forma que downloads interrompidos não
+        sejam tomados como fotos já baixadas.
+
+        Retorna o caminho da foto, ou None se não foi possível baixá-la.
+        """
+        temp_filename = filename[:-len('.jpg')] + '.temp.jpg'
+        async with semaphore:
+            try:
+                with PROFILE_PIC_SECONDS.time():
+                    result = await limiter.call(
+                        client.download_profile_photo, member, temp_filename)
+            except:
+                print('Error downloading profile picture for', member.id, member.username)
+                PROFILE_PICS.inc(result="failed")
+                return None
+        if result is None:
+            return None
+        os.replace(temp_filename, filename)
+        PROFILE_PICS.inc(result="downloaded")
+        return filename
+
+    async def _collect_membership_diff(self, client, dialog, members_file,
+                                       semaphore, limiter):
+        """
+        Lista os integrantes do grupo e escreve em membros.json, à medida
+        que são listados, apenas as diferenças em relação à coleta anterior:
+        entradas ("join"), alterações de perfil ("change", com os campos
+        alterados) e saídas ("leave"). Em um checkpoint (primeira coleta do
+        grupo ou a cada checkpoint_every coletas) os integrantes sem
+        alteração também são escritos ("member"). Retorna o resumo da
+        coleta, guardado no registro do grupo.
+
+        Parâmetros
+        ------------
+            client : telethon.TelegramClient()
+                Cliente conectado à API do Telegram.
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo coletado.
+            members_file : file
+                Arquivo membros.json da coleta.
+            semaphore : asyncio.Semaphore()
+                Limite de downloads simultâneos de fotos de perfil.
+            limiter : RateLimiter
+                Limitador de requisições da conta do cliente.
+        """
+        group_id = dialog.entity.id
+        previous, runs = self.membership_state.load(group_id)
+        checkpoint = previous is None or runs + 1 >= self.checkpoint_every
+        current = dict()
+        counts = {'join': 0, 'change': 0, 'leave': 0, 'member': 0}
+        downloads = list()
+
+        def write(event, user, changed=None):
+            record = {'group_id': group_id, 'event': event, 'user': user}
+            if changed is not None:
+                record['changed'] = changed
+            members_file.write(json.dumps(record) + '\n')
+            counts[event] += 1
+            MEMBERSHIP_EVENTS.inc(event=event)
+
+        def handle(member):
+            key = str(member.id)
+            if key in current:
+                # Listed twice when members join during the listing
+                return
+            MEMBERS_LISTED.inc(group_id=group_id)
+            user = self._get_user(member)
+            user['photo_id'] = getattr(member.photo, 'photo_id', None)
+            if self.profile_pic:
+                # The path is known before the photo is downloaded
+                user['profile_pic'] = self._get_profile_pic_filename(member)
+                if (user['profile_pic'] is not None and
+                        not os.path.isfile(user['profile_pic'])):
+                    downloads.append(self._download_profile_pic(
+                        client, member, user['profile_pic'], semaphore,
+                        limiter))
+                elif user['profile_pic'] is not None:
+                    PROFILE_PICS.inc(result="cached")
+            current[key] = user
+
+            old = previous.get(key) if previous is not None else None
+            if old is None:
+                write('join' if previous is not None else 'member', user)
+                return
+            changed = [field for field in PROFILE_FIELDS
+                       if old.get(field) != user.get(field)]
+            if changed:
+                write('change', user, changed)
+            elif checkpoint:
+                write('member', user)
+
+        async for member in self._iter_participants(client, dialog, limiter):
+            handle(member)
+        if previous is not None:
+            for key, user in previous.items():
+                if key not in current:
+                    write('leave', user)
+        members_file.flush()
+
+        await asyncio.gather(*downloads)
+        self.membership_state.save(group_id, current,
+                                   0 if checkpoint else runs + 1)
+
+        return {'mode': 'checkpoint' if checkpoint else 'diff',
+                'total_members': len(current), 'joins': counts['join'],
+                'leaves': counts['leave'], 'changes': counts['change']}
+
+    async def _collect_group(self, client, dialog, limiter, now, folder,
+                             members_file, semaphore):
+        """
+        Coleta os metadados e os integrantes de um grupo e escreve o
+        registro do grupo em grupos.json.
+
+        Parâmetros
+        ------------
+            client : telethon.TelegramClient()
+                Cliente conectado da conta que coleta o grupo.
+            dialog : telethon.tl.custom.dialog.Dialog()
+                Grupo coletado.
+            limiter : RateLimiter
+                Limitador de requisições da conta do cliente.
+            now : datetime.datetime
+                Data da coleta.
+            folder : str
+                Pasta da coleta.
+            members_file : file
+                Arquivo membros.json da coleta (modo "diff") ou None.
+            semaphore : asyncio.Semaphore()
+                Limite de downloads simultâneos de fotos de perfil.
+        """
+        with GROUP_SECONDS.time():
+            await self._collect_group_metadata(client, dialog, limiter, now,
+                                               folder, members_file, semaphore)
+
+    async def _collect_group_metadata(self, client, dialog, limiter, now,
+                                      folder, members_file, semaphore):
+        group = {}
+
+        creator_id = None
+        #TODO: check what kind is and dont know how to get creator
+        group['group_id'] = dialog.entity.id
+        # group['creator'] = creator
+        # group['kind'] = kind
+        group['creation'] = dict()
+        group['creation']['creation_date'] = dialog.entity.date.strftime('%Y-%m-%d %H:%M:%S')
+        group['creation']['creation_timestamp'] = int(datetime.datetime.timestamp(dialog.entity.date))
+        group['title'] = dialog.entity.title
+        group['collection_date'] = now.strftime('%Y-%m-%d')
+        
+        if dialog.is_channel:  groupType = "channel"
+        if dialog.is_group:    groupType = "group"
+        group['group_type'] = groupType
+       
+        print(group)
+        
+        if dialog.is_group and self.profiles and members_file is not None:
+            group['membership'] = await self._collect_membership_diff(
+                client, dialog, members_file, semaphore, limiter)
+            self._write_group(folder, group)
+            GROUPS_COLLECTED.inc(group_type=groupType)
+            return
+
+        participants = list()
+        downloads = dict()
+        if dialog.is_group and self.profiles:
+            members = await self._get_participants(client, dialog, limiter)
+            for member in members:
+                MEMBERS_LISTED.inc(group_id=dialog.entity.id)
+                user = self._get_user(member)
+                
+                if self.profile_pic:
+                    # Only new or changed photos are downloaded
+                    filename = self._get_profile_pic_filename(member)
+                    if filename is not None and os.path.isfile(filename):
+                        user['profile_pic'] = filename
+                        PROFILE_PICS.inc(result="cached")
+                    elif filename is not None:
+                        downloads[len(participants)] = self._download_profile_pic(
+                            client, member, filename, semaphore, limiter)
+                    
+                participants.append(user)
+
+        results = await asyncio.gather(*downloads.values())
+        for index, filename in zip(downloads.keys(), results):
+            participants[index]['profile_pic'] = filename
+        group['members'] = participants
+        self._write_group(folder, group)
+        GROUPS_COLLECTED.inc(group_type=groupType)
 
     async def run(self):
         """
         Faz a coleta dos metadados de grupos de Telegram de acordo
         com os parâmetros fornecidos na criação do objeto de coleta.
 
+        Com várias contas, cada grupo é coletado por uma das contas que
+        participam dele (uma de cada vez por conta), e todas escrevem na
+        mesma pasta de coleta.
+
         Parâmetros
         ------------
             profile_path : str
@@ -70,69 +419,52 @@ class GroupMetadataCollector():
         now = datetime.datetime.now()
         new_folder = '/data/metadata_grupos_%s/' % (now.strftime('%Y-%m-%d_%H-%M-%S'))
         pathlib.Path(new_folder).mkdir(parents=True, exist_ok=True)
-        pathlib.Path(os.path.join(new_folder, "profile_pics")).mkdir(parents=True, exist_ok=True)
+        pathlib.Path(self.profile_pic_path).mkdir(parents=True, exist_ok=True)
+        semaphore = asyncio.Semaphore(self.profile_pic_workers)
+        members_file = None
+        if self.membership_mode == 'diff':
+            self.membership_state = MembershipState()
+            members_file = open(os.path.join(new_folder, 'membros.json'), 'a')
+
+        metrics_server = None
+        if self.metrics_port:
+            metrics_server = metrics.start_server(self.metrics_port)
 
-        async with TelegramClient('/data/collector_local', self.api_id, self.api_hash) as client:
+        pool = AccountPool(self.accounts, self.client_class, self.limiter_args,
+                           rebalance_wait=self.rebalance_wait)
+        # FloodWaits are raised to the rate limiter instead of slept silently
+        async with pool.connect(flood_sleep_threshold=0) as clients:
             
             print("Login na API do Telegram realizado com sucesso. Coletando grupos")
-            async for dialog in client.iter_dialogs():
-                WAIT_TIME = random.randint(10, 25)
-                await asyncio.sleep(WAIT_TIME)
-                if (
-                    (not (dialog.is_group or dialog.is_channel) ) or 
-                    (dialog.title in self.group_blacklist) or
-                    str(abs(dialog.id)) in self.group_blacklist):
-                        continue
-                
-                group = {}
-
-                creator_id = None
-                #TODO: check what kind is and dont know how to get creator
-                group['group_id'] = dialog.entity.id
-                # group['creator'] = creator
-                # group['kind'] = kind
-                group['creation'] = dict()
-                group['creation']['creation_date'] = dialog.entity.date.strftime('%Y-%m-%d %H:%M:%S')
-                group['creation']['creation_timestamp'] = int(datetime.datetime.timestamp(dialog.entity.date))
-                group['title'] = dialog.entity.title
-                group['collection_date'] = now.strftime('%Y-%m-%d')
-                
-                if dialog.is_channel:  groupType = "channel"
-                if dialog.is_group:    groupType = "group"
-                group['group_type'] = groupType
-               
-                print(group)
-                
-                participants = list()
-                if dialog.is_group and self.profiles:
-                    async for member in client.iter_participants(dialog):
-                        user = dict()
-                        #TODO: changed some stuff here.
-                        user['id'] = member.id
-                        user['username'] = member.username
-                        user['first_name'] = member.first_name
-                        user['last_name'] = member.last_name
-                        user['number'] = member.phone
-                        user['isBot'] = member.bot
-                        user['profile_pic'] = None
-                            
-                        
-                        if self.profile_pic:
-                            user['profile_pic'] = os.path.join(new_folder, "profile_pics", str(member.id) + '.jpg')
-                            if not os.path.isfile(user['profile_pic']):
-                                try:
-                                    await client.download_profile_photo(member, user['profile_pic'])
-                                except:
-                                    print('Error downloading profile picture for', member.id, member.username)
-                            
-                        participants.append(user)
-                group['members'] = participants
-                
-                filename = os.path.join(new_folder, 'grupos.json')
-                with open(filename, 'a') as json_file:
-                    json.dump(group, json_file)
-                    print('', file=json_file)
-                
+            candidates = await pool.list_dialogs(self._accept_dialog)
+
+            async def collect(key, account_dialogs):
+                # A flood-limited account hands its next groups to another
+                async with pool.assign(key, account_dialogs) as index:
+                    await self._collect_group(
+                        clients[index], account_dialogs[index],
+                        pool.limiters[index], now, new_folder, members_file,
+                        semaphore)
+
+            results = await asyncio.gather(
+                *[collect(key, account_dialogs) for key, account_dialogs
+                  in candidates.items()], return_exceptions=True)
+            for account_dialogs, result in zip(candidates.values(), results):
+                if isinstance(result, Exception):
+                    dialog = next(iter(account_dialogs.values()))
+                    print("Erro coletando o grupo " + str(dialog.id) + " - " + str(dialog.title))
+                    traceback.print_exception(type(result), result, result.__traceback__)
+
+        if members_file is not None:
+            members_file.close()
+        metrics.stop_server(metrics_server)
+
+    def _write_group(self, folder, group):
+        filename = os.path.join(folder, 'grupos.json')
+        with open(filename, 'a') as json_file:
+            json.dump(group, json_file)
+            print('', file=json_file)
+
 def str2bool(v):
     if isinstance(v, bool):
        return v
@@ -154,10 +486,55 @@ async def main():
                         const=True, default=False,
                         help="Flag para baixar ou não as fotos de perfil dos usuários ")
                         
+    parser.add_argument("--profile_pic_path", type=str,
+                        help="Pasta das fotos de perfil, compartilhada entre"
+                        " as coletas.", default='/data/profile_pics/')
+
+    parser.add_argument("--profile_pic_workers", type=int,
+                        help="Número máximo de fotos de perfil baixadas"
+                        " simultaneamente.", default=4)
+
+    parser.add_argument("--membership_mode", type=str,
+                        help="Registro dos integrantes: \'full\' (lista"
+                        " completa em grupos.json) ou \'diff\' (entradas,"
+                        " saídas e alterações em membros.json).",
+                        default='full')
+
+    parser.add_argument("--checkpoint_every", type=int,
+                        help="No modo \'diff\', a cada quantas coletas todos"
+                        " os integrantes de um grupo são escritos.",
+                        default=10)
+
     parser.add_argument("--profiles", type=str2bool, nargs='?',
                         const=True, default=True,
                         help="Flag para listar quem sÃo os usuários ")
 
+    parser.add_argument("--rate_min_interval", type=float,
+                        help="Intervalo mínimo (em segundos) entre"
+                        " requisições à API.", default=0.0)
+
+    parser.add_argument("--rate_max_interval", type=float,
+                        help="Intervalo máximo (em segundos) entre"
+                        " requisições após FloodWaits.", default=60.0)
+
+    parser.add_argument("--flood_max_retries", type=int,
+                        help="Número máximo de novas tentativas de uma"
+                        " requisição após FloodWait.", default=5)
+
+    parser.add_argument("--rebalance_wait", type=float,
+                        help="Espera por FloodWait (em segundos) a partir da"
+                        " qual os grupos de uma conta passam a ser coletados"
+                        " por outra (coleta com várias contas).", default=30.0)
+
+    parser.add_argument("--metrics_port", type=int,
+                        help="Porta do endpoint de métricas no formato do"
+                        " Prometheus (0 desativa).", default=0)
+
+    parser.add_argument("--accounts", type=str,
+                        help="Arquivo json com a lista de contas da coleta"
+                        " (\'session\', \'api_id\' e \'api_hash\' de cada"
+                        " uma). Os grupos são divididos entre as contas.")
+
     parser.add_argument("--api_id", type=str,
                         help="ID da API de Coleta gerado em my.telegram.org (Dado sensível)")
 
@@ -0,0 +1,300 @@
+import contextlib
+import http.server
+import math
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+
+
+def _escape(value, quotes=True):
+    value = str(value).replace('\\', '\\\\').replace('\n', '\\n')
+    if quotes:
+        value = value.replace('"', '\\"')
+    return value
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % (','.join('%s="%s"' % (name, _escape(value))
+                              for name, value in pairs))
+
+
+class Metric():
+    """
+    Métrica com rótulos. Cada combinação de valores dos rótulos é uma série
+    própria. As séries podem ser atualizadas pelo loop de eventos e lidas
+    pela thread do servidor de métricas.
+
+    Atributos
+    -----------
+    name : str
+            Nome da métrica.
+    help : str
+            Descrição da métrica.
+    labelnames : tuple
+            Nomes dos rótulos.
+    """
+
+    kind = 'untyped'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.series = dict()
+        self.lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError('Metric %s expects labels %s, got %s' % (
+                self.name, list(self.labelnames), sorted(labels)))
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self):
+        with self.lock:
+            return [(self.name, key, None, value)
+                    for key, value in self.series.items()]
+
+    def render(self):
+        """
+        Retorna a métrica no formato de texto do Prometheus.
+        """
+        lines = ['# HELP %s %s' % (self.name, _escape(self.help, quotes=False)),
+                 '# TYPE %s %s' % (self.name, self.kind)]
+        for name, key, extra, value in self._samples():
+            lines.append('%s%s %s' % (name, _format_labels(self.labelnames, key, extra),
+                                      _format_value(value)))
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    """
+    Contador que só aumenta (e.g. mensagens coletadas).
+    """
+
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Valor que aumenta e diminui (e.g. tamanho de uma fila). O valor pode
+    ser dado por uma função, avaliada a cada leitura das métricas.
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, help, labelnames=()):
+        super().__init__(name, help, labelnames)
+        self.functions = dict()
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.functions.pop(key, None)
+            self.series[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.series[key] = self.series.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set_function(self, function, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.functions[key] = function
+            self.series[key] = 0
+
+    def _samples(self):
+        with self.lock:
+            functions = dict(self.functions)
+            values = dict(self.series)
+        for key, function in functions.items():
+            try:
+                values[key] = function()
+            except Exception:
+                pass
+        return [(self.name, key, None, value) for key, value in values.items()]
+
+
+class Histogram(Metric):
+    """
+    Distribuição de valores observados (e.g. latências, em segundos) em
+    faixas cumulativas, com a soma e a contagem das observações.
+
+    Atributos
+    -----------
+    buckets : tuple
+            Limites superiores das faixas.
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                series = self.series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][index] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """
+        Observa a duração do bloco.
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def _samples(self):
+        samples = list()
+        with self.lock:
+            for key, (counts, total, count) in self.series.items():
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    samples.append((self.name + '_bucket', key,
+                                    ('le', _format_value(bound)), cumulative))
+                samples.append((self.name + '_sum', key, None, total))
+                samples.append((self.name + '_count', key, None, count))
+        return samples
+
+
+class Registry():
+    """
+    Conjunto das métricas de um processo. As métricas são criadas uma única
+    vez por nome; pedir novamente uma métrica existente a retorna.
+
+    Métodos
+    -----------
+    counter(name, help, labelnames)
+        Retorna um contador.
+    gauge(name, help, labelnames)
+        Retorna um medidor.
+    histogram(name, help, labelnames, buckets)
+        Retorna um histograma.
+    render()
+        Retorna todas as métricas no formato de texto do Prometheus.
+    """
+
+    def __init__(self):
+        self.metrics = dict()
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, *args, **kwargs):
+        with self.lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = self.metrics[name] = cls(name, *args, **kwargs)
+            elif not isinstance(metric, cls):
+                raise ValueError('Metric %s already registered as %s' % (
+                    name, metric.kind))
+            return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self._get(Counter, name, help, labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self._get(Gauge, name, help, labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._get(Histogram, name, help, labelnames, buckets)
+
+    def render(self):
+        with self.lock:
+            metrics = list(self.metrics.values())
+        return '\n'.join(metric.render() for metric in metrics) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def counter(name, help, labelnames=()):
+    return REGISTRY.counter(name, help, labelnames)
+
+
+def gauge(name, help, labelnames=()):
+    return REGISTRY.gauge(name, help, labelnames)
+
+
+def histogram(name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.histogram(name, help, labelnames, buckets)
+
+
+def start_server(port, address='', registry=REGISTRY):
+    """
+    Expõe as métricas em http://<address>:<port>/metrics, no formato de
+    texto do Prometheus, em uma thread separada. Retorna o servidor, que é
+    encerrado com stop_server().
+
+    Parâmetros
+    ------------
+        port : int
+            Porta do servidor.
+        address : str
+            Endereço do servidor (vazio para todas as interfaces).
+        registry : Registry
+            Métricas expostas.
+    """
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?')[0] not in ['/', '/metrics']:
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type',
+                             'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Scrapes would flood the collector output
+            pass
+
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    print('Serving metrics on port %d' % (server.server_address[1]))
+    return server
+
+
+def stop_server(server):
+    if server is not None:
+        server.shutdown()
+        server.server_close()
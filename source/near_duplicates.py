@@ -0,0 +1,251 @@
+import numpy as np
+
+SHINGLE_BASE = np.uint64(1000003)
+BLOCK_SIZE = 2048
+
+
+def _mix64(values):
+    """
+    Espalha os bits de um vetor de inteiros de 64 bits (finalizador do
+    splitmix64).
+    """
+    values = (values ^ (values >> np.uint64(30))) * np.uint64(0xbf58476d1ce4e5b9)
+    values = (values ^ (values >> np.uint64(27))) * np.uint64(0x94d049bb133111eb)
+    return values ^ (values >> np.uint64(31))
+
+
+def shingle_hashes(text, shingle_size=5):
+    """
+    Retorna os hashes (64 bits, ordenados e sem repetição) dos shingles de
+    caracteres do texto. Os hashes são determinísticos entre execuções e
+    processos.
+
+    Parâmetros
+    ------------
+        text : str
+            Texto da mensagem.
+        shingle_size : int
+            Número de caracteres de cada shingle.
+    """
+    codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32).astype(np.uint64)
+    size = min(shingle_size, len(codes))
+    count = len(codes) - size + 1
+    hashes = np.zeros(count, dtype=np.uint64)
+    for i in range(size):
+        hashes = hashes * SHINGLE_BASE + codes[i:i + count]
+    return np.unique(_mix64(hashes))
+
+
+class MinHashLSH():
+    """
+    Índice de quase-duplicatas de textos baseado em assinaturas MinHash e
+    LSH (locality sensitive hashing). Cada texto é reduzido aos seus
+    shingles de caracteres; a assinatura estima a similaridade de Jaccard
+    entre os conjuntos de shingles e as faixas da assinatura indexam os
+    textos em buckets. Apenas os textos que compartilham algum bucket são
+    comparados, e a similaridade dos candidatos é verificada contra o
+    limiar.
+
+    Atributos
+    -----------
+    threshold : float
+            Similaridade mínima para considerar dois textos iguais.
+    num_perm : int
+            Número de permutações (tamanho da assinatura).
+    bands : int
+            Número de faixas do LSH (deve dividir num_perm).
+    shingle_size : int
+            Número de caracteres de cada shingle.
+    verification : str
+            Forma de verificar os candidatos: "minhash" (similaridade
+            estimada pelas assinaturas) ou "exact" (Jaccard exato entre os
+            conjuntos de shingles, que ficam em memória). Em ambas a
+            similaridade é a dos shingles, e não a dos conjuntos de
+            caracteres de summarization_util.compare_texts().
+
+    Métodos
+    -----------
+    features(text)
+        Calcula a assinatura (e os shingles) de um texto.
+    match(features)
+        Retorna a chave do primeiro grupo similar ao texto (ou None).
+    insert(key, features)
+        Adiciona um novo grupo ao índice.
+    """
+
+    def __init__(self, threshold=0.75, num_perm=128, bands=32,
+                 shingle_size=5, verification='minhash', seed=1):
+        if num_perm % bands != 0:
+            raise ValueError('num_perm (%d) must be divisible by bands (%d)'
+                             % (num_perm, bands))
+        if verification not in ['minhash', 'exact']:
+            raise ValueError('Unknown verification mode: %s' % (verification))
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.shingle_size = shingle_size
+        self.verification = verification
+
+        # Fixed seed: signatures are comparable across runs and processes
+        random_state = np.random.RandomState(seed)
+        self.perm_a = (random_state.randint(0, 2**62, num_perm, dtype=np.int64)
+                       .astype(np.uint64) * np.uint64(2) + np.uint64(1))
+        self.perm_b = random_state.randint(0, 2**62, num_perm,
+                                           dtype=np.int64).astype(np.uint64)
+
+        self.buckets = [dict() for _ in range(bands)]
+        self.keys = list()
+        self.signatures = list()
+        self.shingles = list()
+
+    def features(self, text):
+        """
+        Calcula a assinatura MinHash do texto e, na verificação exata, o
+        conjunto de shingles.
+
+        Parâmetros
+        ------------
+            text : str
+                Texto da mensagem.
+        """
+        shingles = shingle_hashes(text, self.shingle_size)
+        signature = np.full(self.num_perm, np.iinfo(np.uint32).max,
+                            dtype=np.uint32)
+        # Blocks bound the memory used by very long texts
+        for start in range(0, len(shingles), BLOCK_SIZE):
+            block = shingles[start:start + BLOCK_SIZE]
+            values = (np.outer(self.perm_a, block) +
+                      self.perm_b[:, None]) >> np.uint64(32)
+            signature = np.minimum(signature, values.min(axis=1).astype(np.uint32))
+
+        if self.verification == 'exact':
+            return signature, shingles
+        return signature, None
+
+    def match(self, features):
+        """
+        Retorna a chave do grupo mais antigo cuja similaridade com o texto
+        atinge o limiar, ou None caso não exista.
+
+        Parâmetros
+        ------------
+            features : tuple
+                Assinatura e shingles retornados por features().
+        """
+        signature, shingles = features
+        candidates = set()
+        for band, buckets in enumerate(self.buckets):
+            candidates.update(buckets.get(self._band_key(signature, band), ()))
+
+        for index in sorted(candidates):
+            if self._similarity(index, signature, shingles) >= self.threshold:
+                return self.keys[index]
+        return None
+
+    def insert(self, key, features):
+        """
+        Adiciona um novo grupo ao índice, representado pelo texto cujas
+        características são fornecidas.
+
+        Parâmetros
+        ------------
+            key : object
+                Chave do grupo na sumarização.
+            features : tuple
+                Assinatura e shingles retornados por features().
+        """
+        signature, shingles = features
+        index = len(self.keys)
+        self.keys.append(key)
+        self.signatures.append(signature)
+        self.shingles.append(shingles)
+        for band, buckets in enumerate(self.buckets):
+            buckets.setdefault(self._band_key(signature, band), list()).append(index)
+
+    def _band_key(self, signature, band):
+        return signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def _similarity(self, index, signature, shingles):
+        if self.verification == 'exact':
+            other = self.shingles[index]
+            intersection = np.intersect1d(shingles, other, assume_unique=True).size
+            union = shingles.size + other.size - intersection
+            return intersection / float(union) if union else 0.0
+        return float(np.mean(self.signatures[index] == signature))
+
+
+def hamming_distance(value1, value2):
+    return bin(value1 ^ value2).count('1')
+
+
+class HammingIndex():
+    """
+    Índice de hashes perceptuais (phash) para busca de vizinhos dentro de
+    um raio de Hamming, baseado em multi-index hashing: o hash é dividido
+    em raio + 1 partes e, pelo princípio da casa dos pombos, dois hashes a
+    uma distância de no máximo raio coincidem em pelo menos uma das partes.
+    Apenas os hashes que compartilham alguma parte são comparados.
+
+    Atributos
+    -----------
+    radius : int
+            Distância de Hamming máxima entre dois hashes do mesmo grupo.
+    bits : int
+            Número de bits dos hashes.
+
+    Métodos
+    -----------
+    match(value)
+        Retorna a chave do grupo mais antigo dentro do raio (ou None).
+    insert(key, value)
+        Adiciona um novo grupo representado pelo hash.
+    """
+
+    def __init__(self, radius, bits=64):
+        self.radius = radius
+        self.bits = bits
+        parts = min(radius + 1, bits)
+        bounds = [bits * i // parts for i in range(parts + 1)]
+        self.parts = [(start, (1 << (end - start)) - 1)
+                      for start, end in zip(bounds[:-1], bounds[1:])]
+        self.tables = [dict() for _ in self.parts]
+        self.keys = list()
+        self.values = list()
+
+    def match(self, value):
+        """
+        Retorna a chave do grupo mais antigo cujo hash representante está a
+        uma distância de no máximo raio, ou None caso não exista.
+
+        Parâmetros
+        ------------
+            value : int
+                Hash perceptual.
+        """
+        candidates = set()
+        for table, (shift, mask) in zip(self.tables, self.parts):
+            candidates.update(table.get((value >> shift) & mask, ()))
+
+        for index in sorted(candidates):
+            if hamming_distance(value, self.values[index]) <= self.radius:
+                return self.keys[index]
+        return None
+
+    def insert(self, key, value):
+        """
+        Adiciona um novo grupo ao índice.
+
+        Parâmetros
+        ------------
+            key : object
+                Chave do grupo na sumarização.
+            value : int
+                Hash perceptual representante do grupo.
+        """
+        index = len(self.keys)
+        self.keys.append(key)
+        self.values.append(value)
+        for table, (shift, mask) in zip(self.tables, self.parts):
+            table.setdefault((value >> shift) & mask, list()).append(index)
@@ -0,0 +1,246 @@
+import glob
+import os
+import struct
+
+import jsonl_writer
+
+# Each chunk is a bitmap covering CHUNK_SIZE consecutive message ids of a group
+CHUNK_SIZE = 4096
+CHUNK_BYTES = CHUNK_SIZE // 8
+
+SNAPSHOT_MAGIC = b'PIDS1\n'
+CHUNK_HEADER = struct.Struct('<qq')
+LOG_RECORD = struct.Struct('<qq')
+
+# Group of the ids that earlier versions imported from mid_file.txt, which
+# carries no group; such snapshots are rebuilt from the output files
+LEGACY_GROUP = 0
+
+
+def iter_output_ids(directories):
+    """
+    Retorna os pares (id do grupo, id da mensagem) dos registros escritos
+    nos arquivos de saída das pastas (arquivos json e segmentos
+    comprimidos).
+
+    Parâmetros
+    ------------
+        directories : list
+            Pastas dos arquivos de saída (e.g. mensagens_grupo).
+    """
+    for directory in directories:
+        paths = set(path for path in glob.glob(os.path.join(directory, '*.json'))
+                    if not path.endswith('.index.json'))
+        paths.update(jsonl_writer.list_segmented(directory))
+        for path in sorted(paths):
+            try:
+                for record in jsonl_writer.read_records(path):
+                    if 'group_id' in record and 'message_id' in record:
+                        yield int(record['group_id']), int(record['message_id'])
+            except ValueError:
+                # Lines written after an interrupted write are not readable
+                print('Stopped reading collected ids at an invalid record'
+                      ' of ' + path)
+
+
+class ProcessedIdStore():
+    """
+    Armazena os ids das mensagens já coletadas, identificadas pelo par
+    (id do grupo, id da mensagem). Os ids ficam em memória em bitmaps
+    esparsos por grupo, com verificação em tempo constante. Em disco, novos
+    ids são apenas acrescentados a um log, que é periodicamente compactado
+    em um snapshot dos bitmaps escrito de forma atômica.
+
+    Atributos
+    -----------
+    path : str
+            Prefixo dos arquivos do armazenamento (".snapshot" e ".log").
+    compact_every : int
+            Número de registros no log que dispara a compactação.
+    output_paths : list
+            Pastas dos arquivos de saída da coleta. Na migração do antigo
+            mid_file.txt, que guarda apenas o id da mensagem (repetido entre
+            canais), os pares coletados são reconstruídos a partir delas.
+
+    Métodos
+    -----------
+    contains(group_id, message_id)
+        Verifica se a mensagem já foi coletada.
+    add(group_id, message_id)
+        Marca a mensagem como coletada.
+    checkpoint()
+        Persiste os ids pendentes e compacta o log se necessário.
+    close()
+        Persiste e compacta o armazenamento.
+    """
+
+    def __init__(self, path='/data/processed_ids',
+                 legacy_path='/data/mid_file.txt', compact_every=1000000,
+                 output_paths=()):
+        self.path = path
+        self.snapshot_path = path + '.snapshot'
+        self.log_path = path + '.log'
+        self.compact_every = compact_every
+        self.chunks = dict()
+        self.pending = list()
+        self.log_records = 0
+
+        if os.path.isfile(self.snapshot_path) or os.path.isfile(self.log_path):
+            self._load_snapshot()
+            self._replay_log()
+            if self._drop_legacy():
+                self._import_outputs(output_paths)
+                self.compact()
+        elif os.path.isfile(legacy_path):
+            self._import_outputs(output_paths)
+            self.compact()
+
+        if getattr(self, 'log', None) is None:
+            self.log = open(self.log_path, 'ab')
+
+    def contains(self, group_id, message_id):
+        """
+        Verifica se a mensagem já foi coletada.
+
+        Parâmetros
+        ------------
+            group_id : int
+                Id do grupo ou canal da mensagem.
+            message_id : int
+                Id da mensagem.
+        """
+        return self._test(group_id, message_id)
+
+    def add(self, group_id, message_id):
+        """
+        Marca a mensagem como coletada. O id só é escrito em disco no
+        próximo checkpoint.
+
+        Parâmetros
+        ------------
+            group_id : int
+                Id do grupo ou canal da mensagem.
+            message_id : int
+                Id da mensagem.
+        """
+        if self._set(group_id, message_id):
+            self.pending.append(LOG_RECORD.pack(group_id, message_id))
+
+    def flush(self):
+        """
+        Escreve no log os ids marcados desde o último checkpoint.
+        """
+        if self.pending:
+            self.log.write(b''.join(self.pending))
+            self.log_records += len(self.pending)
+            self.pending = list()
+        self.log.flush()
+
+    def checkpoint(self):
+        """
+        Escreve os ids pendentes e compacta o log caso ele tenha atingido
+        o limite de registros.
+        """
+        self.flush()
+        if self.log_records >= self.compact_every:
+            self.compact()
+
+    def compact(self):
+        """
+        Escreve um novo snapshot com todos os ids e esvazia o log. O
+        snapshot é substituído atomicamente; uma interrupção antes de o log
+        ser esvaziado apenas faz com que ids repetidos sejam relidos.
+        """
+        if getattr(self, 'log', None) is not None:
+            self.flush()
+
+        temp_path = self.snapshot_path + '.temp'
+        with open(temp_path, 'wb') as fsnap:
+            fsnap.write(SNAPSHOT_MAGIC)
+            for (group_id, index), bits in self.chunks.items():
+                fsnap.write(CHUNK_HEADER.pack(group_id, index))
+                fsnap.write(bits)
+            fsnap.flush()
+            os.fsync(fsnap.fileno())
+        os.replace(temp_path, self.snapshot_path)
+
+        if getattr(self, 'log', None) is not None:
+            self.log.close()
+        open(self.log_path, 'wb').close()
+        self.log = open(self.log_path, 'ab')
+        self.log_records = 0
+
+    def close(self):
+        """
+        Persiste os ids pendentes, compacta o log e fecha os arquivos.
+        """
+        self.compact()
+        self.log.close()
+
+    def _test(self, group_id, message_id):
+        index, bit = divmod(message_id, CHUNK_SIZE)
+        bits = self.chunks.get((group_id, index))
+        return bits is not None and bool(bits[bit >> 3] & (1 << (bit & 7)))
+
+    def _set(self, group_id, message_id):
+        """
+        Marca o bit da mensagem e retorna se ela ainda não estava marcada.
+        """
+        index, bit = divmod(message_id, CHUNK_SIZE)
+        bits = self.chunks.get((group_id, index))
+        if bits is None:
+            bits = bytearray(CHUNK_BYTES)
+            self.chunks[(group_id, index)] = bits
+        mask = 1 << (bit & 7)
+        if bits[bit >> 3] & mask:
+            return False
+        bits[bit >> 3] |= mask
+        return True
+
+    def _load_snapshot(self):
+        if not os.path.isfile(self.snapshot_path):
+            return
+        with open(self.snapshot_path, 'rb') as fsnap:
+            data = memoryview(fsnap.read())
+        if bytes(data[:len(SNAPSHOT_MAGIC)]) != SNAPSHOT_MAGIC:
+            raise ValueError('Invalid processed ids snapshot: ' +
+                             self.snapshot_path)
+
+        record_size = CHUNK_HEADER.size + CHUNK_BYTES
+        offset = len(SNAPSHOT_MAGIC)
+        while offset + record_size <= len(data):
+            group_id, index = CHUNK_HEADER.unpack_from(data, offset)
+            offset += CHUNK_HEADER.size
+            self.chunks[(group_id, index)] = bytearray(
+                data[offset:offset + CHUNK_BYTES])
+            offset += CHUNK_BYTES
+
+    def _replay_log(self):
+        if not os.path.isfile(self.log_path):
+            return
+        with open(self.log_path, 'rb') as flog:
+            data = flog.read()
+        # A truncated trailing record (interrupted write) is ignored
+        size = len(data) - len(data) % LOG_RECORD.size
+        if size != len(data):
+            with open(self.log_path, 'r+b') as flog:
+                flog.truncate(size)
+        for group_id, message_id in LOG_RECORD.iter_unpack(data[:size]):
+            self._set(group_id, message_id)
+        self.log_records = size // LOG_RECORD.size
+
+    def _drop_legacy(self):
+        """
+        Remove os ids sem grupo importados por versões anteriores e retorna
+        se havia algum.
+        """
+        legacy = [key for key in self.chunks if key[0] == LEGACY_GROUP]
+        for key in legacy:
+            del self.chunks[key]
+        return bool(legacy)
+
+    def _import_outputs(self, output_paths):
+        count = 0
+        for group_id, message_id in iter_output_ids(output_paths):
+            count += self._set(group_id, message_id)
+        print('Rebuilt %d collected ids from the output files' % (count))
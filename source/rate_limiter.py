@@ -0,0 +1,160 @@
+from telethon.errors import FloodWaitError
+
+import asyncio
+
+import metrics
+
+FLOOD_WAITS = metrics.counter('telegram_flood_waits_total',
+                              'FloodWaitError recebidos da API.')
+FLOOD_WAIT_SECONDS = metrics.counter('telegram_flood_wait_seconds_total',
+                                     'Segundos de espera pedidos pela API.')
+
+
+class RateLimiter():
+    """
+    Limitador de requisições à API do Telegram compartilhado pelas tarefas
+    de um coletor. Sem sinais de limitação as requisições seguem sem
+    espera. Ao receber um FloodWaitError, todas as novas requisições
+    aguardam o tempo pedido pela API e o intervalo entre requisições é
+    aumentado de acordo com a espera pedida; passado o período de espera, o
+    intervalo volta a diminuir gradualmente com o tempo sem novos
+    FloodWaitError.
+
+    Atributos
+    -----------
+    min_interval : float
+            Intervalo mínimo (em segundos) entre o início de duas
+            requisições.
+    max_interval : float
+            Intervalo máximo (em segundos) alcançado pelo recuo.
+    backoff : float
+            Fator de aumento do intervalo a cada FloodWaitError.
+    recovery : float
+            Fator de redução do intervalo a cada recovery_interval segundos
+            sem FloodWaitError.
+    recovery_interval : float
+            Tempo (em segundos), contado a partir do fim da espera pedida
+            pela API, após o qual o intervalo é reduzido.
+    max_retries : int
+            Número máximo de novas tentativas de uma chamada após
+            FloodWaitError.
+
+    Métodos
+    -----------
+    acquire()
+        Aguarda a vez de fazer uma requisição.
+    call(function, *args, **kwargs)
+        Executa uma corotina respeitando o limite e tentando novamente após
+        FloodWaitError.
+    blocked_for()
+        Retorna o tempo restante da espera pedida pela API.
+    """
+
+    def __init__(self, min_interval=0.0, max_interval=60.0, backoff=2.0,
+                 recovery=0.5, recovery_interval=5.0, max_retries=5):
+        self.min_interval = min_interval
+        self.max_interval = max(min_interval, max_interval)
+        self.backoff = backoff
+        self.recovery = recovery
+        self.recovery_interval = recovery_interval
+        self.max_retries = max_retries
+        self.interval = min_interval
+        self.next_time = 0.0
+        self.blocked_until = 0.0
+        self.recovered_at = 0.0
+        self.successes = 0
+        self.flood_waits = 0
+        self.lock = None
+
+    async def acquire(self):
+        """
+        Aguarda até que uma nova requisição possa ser feita: após o fim de
+        uma espera pedida pela API e respeitando o intervalo atual desde a
+        requisição anterior.
+        """
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        loop = asyncio.get_event_loop()
+        async with self.lock:
+            wait = max(self.blocked_until, self.next_time) - loop.time()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            self._recover(loop.time())
+            self.next_time = loop.time() + self.interval
+
+    def blocked_for(self):
+        """
+        Retorna quantos segundos faltam para o fim da espera pedida pela
+        API (zero se não há espera).
+        """
+        return max(0.0, self.blocked_until - asyncio.get_event_loop().time())
+
+    def success(self):
+        """
+        Registra uma requisição bem sucedida.
+        """
+        self.successes += 1
+
+    def _recover(self, now):
+        """
+        Reduz o intervalo uma vez para cada recovery_interval segundos
+        passados desde o fim da última espera pedida pela API.
+        """
+        if self.interval <= self.min_interval:
+            return
+        steps = int((now - self.recovered_at) // self.recovery_interval)
+        if steps <= 0:
+            return
+        self.recovered_at += steps * self.recovery_interval
+        self.interval = self.interval * self.recovery ** steps
+        if self.interval < max(self.min_interval, 0.01):
+            self.interval = self.min_interval
+
+    def flood_wait(self, seconds):
+        """
+        Registra um FloodWaitError: bloqueia as novas requisições pelo tempo
+        pedido e aumenta o intervalo entre requisições. Uma espera de zero
+        segundos só aumenta um intervalo que já não seja nulo.
+
+        Parâmetros
+        ------------
+            seconds : int
+                Tempo de espera pedido pela API.
+        """
+        loop = asyncio.get_event_loop()
+        self.flood_waits += 1
+        FLOOD_WAITS.inc()
+        FLOOD_WAIT_SECONDS.inc(seconds)
+        self.blocked_until = max(self.blocked_until, loop.time() + seconds)
+        # The recovery restarts when the requested wait is over
+        self.recovered_at = self.blocked_until
+        self.interval = min(self.max_interval,
+                            max(self.interval * self.backoff,
+                                min(float(seconds), 1.0)))
+        print('FloodWait of %d seconds. Interval between requests: %.2f '
+              'seconds' % (seconds, self.interval))
+
+    async def call(self, function, *args, **kwargs):
+        """
+        Executa a corotina retornada por function(*args, **kwargs) após
+        aguardar a vez. Em caso de FloodWaitError, aguarda o tempo pedido e
+        executa novamente (a função deve poder ser repetida).
+
+        Parâmetros
+        ------------
+            function : callable
+                Função que retorna a corotina a ser executada.
+        """
+        retries = 0
+        while True:
+            await self.acquire()
+            try:
+                result = await function(*args, **kwargs)
+            except FloodWaitError as e:
+                self.flood_wait(e.seconds)
+                retries += 1
+                if retries > self.max_retries:
+                    raise
+                continue
+            self.success()
+            return result
@@ -0,0 +1,290 @@
+import json
+import sqlite3
+import time
+
+MESSAGE_FIELDS = ['group_id', 'message_id', 'group_name', 'sender', 'data',
+                  'content', 'file', 'mediatype', 'phash', 'checksum']
+NOTIFICATION_FIELDS = ['group_id', 'message_id', 'date', 'sender', 'action']
+MEDIA_FIELDS = ['path', 'file', 'mediatype', 'checksum', 'phash']
+
+# Columns without a declared type keep the value as collected (e.g. the
+# sender is a user id or, in channels, the channel id as a string)
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    group_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    group_name TEXT,
+    sender,
+    data TEXT,
+    content TEXT,
+    file TEXT,
+    mediatype TEXT,
+    phash TEXT,
+    checksum TEXT,
+    PRIMARY KEY (group_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS messages_data ON messages (data);
+CREATE INDEX IF NOT EXISTS messages_group_id ON messages (group_id, data);
+CREATE INDEX IF NOT EXISTS messages_sender ON messages (sender);
+CREATE INDEX IF NOT EXISTS messages_checksum ON messages (checksum);
+CREATE INDEX IF NOT EXISTS messages_phash ON messages (phash);
+
+CREATE TABLE IF NOT EXISTS notifications (
+    group_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    date TEXT,
+    sender,
+    action TEXT,
+    PRIMARY KEY (group_id, message_id)
+);
+CREATE INDEX IF NOT EXISTS notifications_date ON notifications (date);
+CREATE INDEX IF NOT EXISTS notifications_sender ON notifications (sender);
+
+CREATE TABLE IF NOT EXISTS media (
+    path TEXT PRIMARY KEY,
+    file TEXT,
+    mediatype TEXT,
+    checksum TEXT,
+    phash TEXT
+);
+CREATE INDEX IF NOT EXISTS media_checksum ON media (checksum);
+CREATE INDEX IF NOT EXISTS media_phash ON media (phash);
+"""
+
+
+def _insert_statement(table, fields):
+    return 'INSERT OR IGNORE INTO %s (%s) VALUES (%s)' % (
+        table, ', '.join(fields), ', '.join('?' * len(fields)))
+
+
+def _migrate(connection):
+    """
+    Bancos criados por versões anteriores indexavam as mídias pelo nome do
+    arquivo, que se repete entre grupos e dias. A tabela antiga é mantida
+    como "media_by_file" e as mídias passam a ser indexadas pelo caminho.
+    """
+    columns = [row[1] for row in connection.execute('PRAGMA table_info(media)')]
+    if columns and 'path' not in columns:
+        with connection:
+            connection.execute('DROP INDEX IF EXISTS media_checksum')
+            connection.execute('DROP INDEX IF EXISTS media_phash')
+            connection.execute('ALTER TABLE media RENAME TO media_by_file')
+
+
+def connect(path, readonly=False):
+    """
+    Abre o banco de dados da coleta. Em modo somente leitura o banco não é
+    criado caso não exista.
+
+    Parâmetros
+    ------------
+        path : str
+            Caminho do arquivo do banco de dados.
+        readonly : bool
+            Se a conexão é apenas de leitura.
+    """
+    if readonly:
+        return sqlite3.connect('file:%s?mode=ro' % (path), uri=True)
+    connection = sqlite3.connect(path)
+    # WAL lets the summarization read while the collection is writing
+    connection.execute('PRAGMA journal_mode=WAL')
+    connection.execute('PRAGMA synchronous=NORMAL')
+    _migrate(connection)
+    connection.executescript(SCHEMA)
+    return connection
+
+
+def _to_message(row):
+    return dict(zip(MESSAGE_FIELDS, row))
+
+
+def read_day_messages(path, date):
+    """
+    Lê as mensagens de um dia (formato "%Y-%m-%d"), na ordem em que foram
+    inseridas, com os mesmos campos dos arquivos json de coleta.
+
+    Parâmetros
+    ------------
+        path : str
+            Caminho do arquivo do banco de dados.
+        date : str
+            Data das mensagens.
+    """
+    connection = connect(path, readonly=True)
+    try:
+        cursor = connection.execute(
+            'SELECT %s FROM messages WHERE data >= ? AND data < ? '
+            'ORDER BY rowid' % (', '.join(MESSAGE_FIELDS)),
+            (date, date + '~'))
+        for row in cursor:
+            yield _to_message(row)
+    finally:
+        connection.close()
+
+
+def get_day_stamp(path, date):
+    """
+    Retorna a quantidade de mensagens de um dia e o maior rowid entre elas,
+    que mudam sempre que uma mensagem do dia é inserida.
+    """
+    connection = connect(path, readonly=True)
+    try:
+        return connection.execute(
+            'SELECT COUNT(*), MAX(rowid) FROM messages '
+            'WHERE data >= ? AND data < ?', (date, date + '~')).fetchone()
+    finally:
+        connection.close()
+
+
+def find_messages(path, field, value, start_date=None, end_date=None):
+    """
+    Retorna as mensagens com um valor em um campo indexado (group_id,
+    sender, checksum ou phash), opcionalmente restritas a um período.
+
+    Parâmetros
+    ------------
+        path : str
+            Caminho do arquivo do banco de dados.
+        field : str
+            Campo da busca.
+        value : object
+            Valor buscado.
+        start_date : str
+            Data de início do período ("%Y-%m-%d").
+        end_date : str
+            Data de fim do período ("%Y-%m-%d").
+    """
+    if field not in ['group_id', 'sender', 'checksum', 'phash']:
+        raise ValueError('Field is not indexed: %s' % (field))
+
+    query = 'SELECT %s FROM messages WHERE %s = ?' % (
+        ', '.join(MESSAGE_FIELDS), field)
+    params = [value]
+    if start_date is not None:
+        query += ' AND data >= ?'
+        params.append(start_date)
+    if end_date is not None:
+        query += ' AND data < ?'
+        params.append(end_date + '~')
+
+    connection = connect(path, readonly=True)
+    try:
+        return [_to_message(row) for row in
+                connection.execute(query + ' ORDER BY data', params)]
+    finally:
+        connection.close()
+
+
+class SqliteStore():
+    """
+    Armazena as mensagens, notificações e mídias coletadas em um banco
+    SQLite com índices por data, grupo, usuário, checksum e phash. Os
+    registros são acumulados em memória e inseridos em lote, em uma única
+    transação. Registros repetidos (mesmo grupo e id) são ignorados.
+
+    Atributos
+    -----------
+    path : str
+            Caminho do arquivo do banco de dados.
+    max_buffered : int
+            Número de registros acumulados que dispara a escrita em disco.
+    flush_interval : float
+            Intervalo máximo (em segundos) entre duas escritas em disco.
+
+    Métodos
+    -----------
+    write_message(item, media_path)
+        Acumula uma mensagem (e sua mídia) para ser inserida.
+    write_notification(notification)
+        Acumula uma notificação para ser inserida.
+    flush()
+        Insere todos os registros acumulados.
+    close()
+        Insere os registros acumulados e fecha o banco.
+    """
+
+    def __init__(self, path='/data/telegram.db', max_buffered=1000,
+                 flush_interval=5.0):
+        self.path = path
+        self.max_buffered = max(1, max_buffered)
+        self.flush_interval = flush_interval
+        self.connection = connect(path)
+        self.messages = list()
+        self.notifications = list()
+        self.media = list()
+        self.last_flush = time.monotonic()
+
+    def write_message(self, item, media_path=None):
+        """
+        Acumula uma mensagem para ser inserida. Mensagens com arquivo
+        também registram a mídia, identificada pelo caminho em que foi
+        salva (o nome do arquivo se repete entre grupos e dias).
+
+        Parâmetros
+        ------------
+            item : dict
+                Mensagem no formato dos arquivos json de coleta.
+            media_path : str
+                Caminho do arquivo da mídia.
+        """
+        self.messages.append(tuple(item.get(field) for field in MESSAGE_FIELDS))
+        if item.get('file') and media_path:
+            media = dict(item, path=media_path)
+            self.media.append(tuple(media.get(field) for field in MEDIA_FIELDS))
+        self._flush_if_needed()
+
+    def write_notification(self, notification):
+        """
+        Acumula uma notificação para ser inserida. A ação é guardada em
+        json.
+
+        Parâmetros
+        ------------
+            notification : dict
+                Notificação no formato dos arquivos json de coleta.
+        """
+        record = dict(notification, action=json.dumps(notification['action']))
+        self.notifications.append(tuple(record.get(field)
+                                        for field in NOTIFICATION_FIELDS))
+        self._flush_if_needed()
+
+    def flush_if_due(self):
+        """
+        Insere os registros acumulados caso o intervalo máximo entre
+        escritas tenha sido atingido.
+        """
+        if (self._buffered() and
+                time.monotonic() - self.last_flush >= self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        """
+        Insere todos os registros acumulados em uma única transação.
+        """
+        if self._buffered():
+            with self.connection:
+                self.connection.executemany(
+                    _insert_statement('messages', MESSAGE_FIELDS),
+                    self.messages)
+                self.connection.executemany(
+                    _insert_statement('notifications', NOTIFICATION_FIELDS),
+                    self.notifications)
+                self.connection.executemany(
+                    _insert_statement('media', MEDIA_FIELDS), self.media)
+            self.messages = list()
+            self.notifications = list()
+            self.media = list()
+        self.last_flush = time.monotonic()
+
+    def close(self):
+        self.flush()
+        self.connection.close()
+
+    def _buffered(self):
+        return len(self.messages) + len(self.notifications)
+
+    def _flush_if_needed(self):
+        if self._buffered() >= self.max_buffered:
+            self.flush()
+        else:
+            self.flush_if_due()
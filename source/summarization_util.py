@@ -1,9 +1,37 @@
 from datetime import timedelta
 from datetime import datetime
-from os.path import isfile, join
+from os.path import isfile, join, basename
+from concurrent.futures import ProcessPoolExecutor
 
+import os
 import json
+import shutil
+import pickle
+import tempfile
+import hashlib
 import argparse
+import time
+
+from near_duplicates import MinHashLSH, HammingIndex
+import sqlite_store
+import jsonl_writer
+import metrics
+
+DAYS_READ = metrics.counter(
+    'summarization_days_total',
+    'Dias do período lidos ("mapped") ou obtidos do cache ("cached").',
+    ['result'])
+CACHE_LOOKUPS = metrics.counter(
+    'summarization_cache_total',
+    'Consultas ao cache de resultados parciais por dia e etapa.', ['result'])
+MESSAGES_READ = metrics.counter(
+    'summarization_messages_read_total', 'Mensagens lidas dos arquivos diários.')
+MAP_SECONDS = metrics.histogram(
+    'summarization_map_seconds',
+    'Tempo de leitura e mapeamento de um dia (no worker).')
+REDUCE_SECONDS = metrics.histogram(
+    'summarization_reduce_seconds',
+    'Tempo de combinação do resultado parcial de um dia.', ['stage'])
 
 # Example: python summarization_util.py -t images -m checksum -s 2020-09-18 -e 2020-11-11 
 
@@ -41,24 +69,349 @@ def get_days_list(start_date, end_date):
     return dates_list
 
 
+# Fields kept from each message when summaries store references
+MEDIA_FIELDS = ['group_id', 'message_id', 'group_name', 'sender', 'data',
+                'file', 'phash', 'checksum']
+TEXT_FIELDS = ['group_id', 'message_id', 'group_name', 'sender', 'data',
+               'content']
+
+
+def read_group_day(group_path, date):
+    """
+    Lê as mensagens de um dia a partir dos arquivos por grupo escritos em
+    segmentos, abrindo apenas os segmentos cujo intervalo inclui o dia.
+    """
+    for path in jsonl_writer.list_segmented(group_path):
+        for message in jsonl_writer.read_records(path, date, date + '~'):
+            if message['data'].startswith(date):
+                yield message
+
+
+def read_source(source):
+    """
+    Lê as mensagens de um dia. A origem é uma tupla com o tipo e os
+    parâmetros da leitura: ("file", arquivo diário, comprimido ou não),
+    ("sqlite", banco de dados, data) ou ("groups", pasta dos arquivos por
+    grupo, data).
+    """
+    if source[0] == 'sqlite':
+        return sqlite_store.read_day_messages(*source[1:])
+    if source[0] == 'groups':
+        return read_group_day(*source[1:])
+    return jsonl_writer.read_records(source[1])
+
+
+def message_reference(message):
+    """
+    Referência compacta a uma mensagem: [id do grupo, id da mensagem].
+    """
+    return [message['group_id'], message['message_id']]
+
+
+def compact_message(message, fields):
+    """
+    Mantém apenas os campos da mensagem necessários para a sumarização.
+    """
+    return {field: message.get(field) for field in fields}
+
+
+def new_media_summary(comparison_method, hash, message, references=False):
+    """
+    Cria o agregado de uma mídia. Os conjuntos (grupos, usuários, arquivos)
+    são dicionários, que preservam a ordem em que os elementos aparecem e
+    permitem juntar agregados parciais com o mesmo resultado da leitura
+    sequencial. Com referências, o agregado guarda em "message_refs" apenas
+    o grupo e o id de cada mensagem em vez das mensagens completas.
+    """
+    summary = dict()
+    summary[comparison_method] = hash
+    summary['first_share'] = message['data']
+    summary['total'] = 0
+    summary['total_groups'] = 0
+    summary['total_users'] = 0
+    summary['groups_shared'] = dict()
+    summary['users_shared'] = dict()
+    summary['filenames'] = dict()
+    summary['message_refs' if references else 'messages'] = list()
+    return summary
+
+
+def add_media_message(summary, message):
+    if message['data'] < summary['first_share']:
+        summary['first_share'] = message['data']
+    summary['total'] += 1
+    summary['groups_shared'][message['group_name']] = None
+    summary['users_shared'][message['sender']] = None
+    summary['filenames'][message['file']] = None
+    if 'messages' in summary:
+        summary['messages'].append(message)
+    else:
+        summary['message_refs'].append(message_reference(message))
+
+
+def merge_media_summary(summary, other):
+    """
+    Junta ao agregado de uma mídia o agregado parcial de um período
+    posterior.
+    """
+    if other['first_share'] < summary['first_share']:
+        summary['first_share'] = other['first_share']
+    summary['total'] += other['total']
+    summary['groups_shared'].update(other['groups_shared'])
+    summary['users_shared'].update(other['users_shared'])
+    summary['filenames'].update(other['filenames'])
+    for key in ['messages', 'message_refs']:
+        if key in other:
+            summary[key].extend(other[key])
+    if 'members' in other:
+        summary['members'].update(other['members'])
+
+
+def new_text_summary(text, message, references=False):
+    """
+    Cria o agregado de um texto. Com referências, os ids das mensagens
+    ficam apenas em "message_refs" (sem "messages_IDs" e "messages").
+    """
+    summary = dict()
+    summary['first_share'] = message['data']
+    summary['total'] = 0
+    summary['total_groups'] = 0
+    summary['total_users'] = 0
+    summary['groups_shared'] = dict()
+    summary['users_shared'] = dict()
+    if not references:
+        summary['messages_IDs'] = list()
+    summary['filenames'] = list()
+    summary['text'] = text
+    summary['message_refs' if references else 'messages'] = list()
+    return summary
+
+
+def add_text_message(summary, message):
+    if message['data'] < summary['first_share']:
+        summary['first_share'] = message['data']
+    summary['total'] += 1
+    summary['groups_shared'][message['group_name']] = None
+    summary['users_shared'][message['sender']] = None
+    if 'messages' in summary:
+        summary['messages_IDs'].append(message['message_id'])
+        summary['messages'].append(message)
+    else:
+        summary['message_refs'].append(message_reference(message))
+
+
+def finish_summary(summary):
+    """
+    Converte os conjuntos do agregado em listas e calcula os totais de
+    grupos e usuários.
+    """
+    for key in ['groups_shared', 'users_shared', 'filenames', 'members']:
+        if isinstance(summary.get(key), dict):
+            summary[key] = list(summary[key])
+    summary['total_groups'] = len(summary['groups_shared'])
+    summary['total_users'] = len(summary['users_shared'])
+    return summary
+
+
+class ReferenceSpill():
+    """
+    Arquivo temporário para onde são movidas, ao fim de cada dia combinado,
+    as referências às mensagens dos agregados, que assim não ficam em
+    memória até a escrita da sumarização. Cada linha guarda a chave de um
+    agregado ("key") e as referências de um dia ("message_refs").
+
+    Métodos
+    -----------
+    spill(hashes, keys)
+        Move para o arquivo as referências dos agregados indicados.
+    save(filename)
+        Copia as referências para o arquivo final e descarta o temporário.
+    """
+
+    def __init__(self):
+        self.file = tempfile.TemporaryFile('w+')
+
+    def spill(self, hashes, keys):
+        for key in keys:
+            summary = hashes[key]
+            if summary['message_refs']:
+                self.file.write(json.dumps(
+                    {'key': key, 'message_refs': summary['message_refs']}) + '\n')
+                summary['message_refs'] = list()
+
+    def save(self, filename):
+        self.file.seek(0)
+        with open(filename, 'w') as refs_file:
+            shutil.copyfileobj(self.file, refs_file)
+        self.file.close()
+
+
+class MediaSummaryMapper():
+    """
+    Etapa "map" da sumarização de mídias: agrega as mensagens de um arquivo
+    pelo hash da mídia.
+
+    Atributos
+    -----------
+    media : str
+            Tipo da mídia das mensagens agregadas.
+    comparison_method : str
+            Campo com o hash da mídia (checksum ou phash).
+    references : bool
+            Se os agregados guardam referências às mensagens em vez das
+            mensagens completas.
+    """
+
+    def __init__(self, media, comparison_method, references=False):
+        self.media = media
+        self.comparison_method = comparison_method
+        self.references = references
+        self.result = dict()
+
+    def add(self, message):
+        if message['mediatype'] != self.media:
+            return
+        hash = message[self.comparison_method]
+        if hash == "":
+            return
+        if hash not in self.result:
+            self.result[hash] = new_media_summary(
+                self.comparison_method, hash, message, self.references)
+        add_media_message(self.result[hash], message)
+
+
+class MediaFilterMapper():
+    """
+    Etapa "map" do agrupamento por distância de Hamming: seleciona as
+    mensagens do tipo de mídia, que são agrupadas em ordem na etapa
+    seguinte. Com referências, apenas os campos usados na sumarização são
+    mantidos.
+    """
+
+    def __init__(self, media, comparison_method, references=False):
+        self.media = media
+        self.comparison_method = comparison_method
+        self.references = references
+        self.result = list()
+
+    def add(self, message):
+        if (message['mediatype'] == self.media and
+                message[self.comparison_method] != ""):
+            if self.references:
+                message = compact_message(message, MEDIA_FIELDS)
+            self.result.append(message)
+
+
+_text_indexes = dict()
+
+
+class TextFilterMapper():
+    """
+    Etapa "map" da sumarização de textos: seleciona as mensagens com o
+    tamanho mínimo e, no método "minhash", já calcula as assinaturas dos
+    textos.
+
+    Atributos
+    -----------
+    min_size : int
+            Tamanho mínimo do texto das mensagens.
+    index_params : tuple
+            Parâmetros do MinHashLSH usado para calcular as assinaturas
+            (None no método "jaccard").
+    references : bool
+            Se apenas os campos usados na sumarização devem ser mantidos.
+    """
+
+    def __init__(self, min_size, index_params=None, references=False):
+        self.min_size = min_size
+        self.references = references
+        self.index = None
+        if index_params is not None:
+            # One index per process only to reuse its permutations
+            if index_params not in _text_indexes:
+                _text_indexes[index_params] = MinHashLSH(*index_params)
+            self.index = _text_indexes[index_params]
+        self.result = list()
+
+    def add(self, message):
+        text = message['content']
+        if len(text) < self.min_size:
+            return
+        features = self.index.features(text) if self.index is not None else None
+        if self.references:
+            message = compact_message(message, TEXT_FIELDS)
+        self.result.append((message, features))
+
+
+# Map steps by name; a map spec is (name, *parameters of the mapper)
+MAPPERS = {
+    'summarize_media': MediaSummaryMapper,
+    'filter_media': MediaFilterMapper,
+    'filter_text': TextFilterMapper,
+}
+
+
+def map_file(filename, specs):
+    """
+    Lê um arquivo de mensagens uma única vez e aplica a ele todas as
+    etapas "map" indicadas. Retorna os resultados, na mesma ordem, a
+    duração do mapeamento e o número de mensagens lidas (medidos no
+    processo que lê o arquivo).
+
+    Parâmetros
+    ------------
+        filename : tuple
+            Origem das mensagens do dia (ver read_source()).
+        specs : tuple
+            Etapas a aplicar, cada uma no formato (nome, *parâmetros).
+    """
+    start = time.monotonic()
+    mappers = [MAPPERS[spec[0]](*spec[1:]) for spec in specs]
+    count = 0
+    for message in read_source(filename):
+        count += 1
+        for mapper in mappers:
+            mapper.add(message)
+    return [mapper.result for mapper in mappers], time.monotonic() - start, count
+
+
 class SummarizationUtil:
     """
     Biblioteca auxiliar que compreende funções extras para realizar a
     sumarização das mídias e mensagens de um certo período.
 
+    A leitura dos arquivos é feita em duas etapas: cada arquivo diário é
+    processado de forma independente ("map"), opcionalmente em um pool de
+    processos, e os resultados parciais são combinados na ordem das datas
+    ("reduce"). O resultado é idêntico com um ou vários processos, e os
+    resultados parciais de cada dia podem ser mantidos em cache.
+
     Atributos
     -----------
     media_type : str
             Tipo de mídia para gerar a sumarização (images, audios, videos)
     comparison_method : str
             Metódo para calcular a similaridade/igualdade entre mídias (
-            checksum, phash, jaccard).
+            checksum, phash, jaccard, minhash).
     start_date : str
             Data de início da sumarização.
     end_date : str
             Data de fim da sumarização.
     messages_path : str
             Caminho em que estão salvos os arquivos de coleta por data.
+    workers : int
+            Número de processos usados na leitura dos arquivos diários.
+    cache_path : str
+            Pasta do cache de resultados parciais por dia (None desativa o
+            cache). Dias já processados e não alterados não são relidos.
+    sqlite_path : str
+            Banco de dados do modo de escrita "sqlite". Quando fornecido,
+            as mensagens de cada dia são lidas do banco (pelo índice de
+            datas) em vez dos arquivos diários.
+    group_path : str
+            Pasta dos arquivos por grupo. Os dias sem arquivo diário são
+            lidos dos segmentos comprimidos desses arquivos, ignorando os
+            segmentos fora do dia.
 
     Métodos
     -----------
@@ -67,10 +420,18 @@ class SummarizationUtil:
         informações como primeira vez em que a mídia foi compartilhada,
         quantas vezes foi compartilhada, em que grupos, por quais usuários,
         etc.
+    generate_text_summarization()
+        Faz a sumarização das mensagens de texto.
+    generate_summarizations(targets)
+        Faz várias sumarizações do período lendo os arquivos uma única vez.
+    find_messages(field, value)
+        Busca no banco de dados as mensagens do período com um hash, grupo
+        ou usuário.
     """
 
     def __init__(self, media_type, comparison_method, start_date, end_date,
-                 messages_path="/data/mensagens/"):
+                 messages_path="/data/mensagens/", workers=1, cache_path=None,
+                 sqlite_path=None, group_path="/data/mensagens_grupo/"):
         self.media_type = media_type
         self.comparison_method = comparison_method
         self.start_date = start_date
@@ -78,18 +439,230 @@ class SummarizationUtil:
             end_date = start_date
         self.end_date = end_date
         self.messages_path = messages_path
+        self.workers = workers
+        self.cache_path = cache_path
+        self.sqlite_path = sqlite_path
+        self.group_path = group_path
+        # References of the "jsonl" summary being generated
+        self.spill = None
 
-    def generate_media_summarization(self, output='default'):
+    def _get_daily_files(self):
         """
-        Faz a sumarização das mensagens de um certo tipo de mídia. Calcula
-        informações como primeira vez em que a mídia foi compartilhada,
-        quantas vezes foi compartilhada, em que grupos, por quais usuários,
-        etc.
+        Retorna as origens (ver read_source()) das mensagens de cada dia do
+        período, em ordem de data: o banco de dados, se fornecido, ou o
+        arquivo diário (comprimido ou não). Dias sem arquivo diário são
+        lidos dos segmentos dos arquivos por grupo, quando existirem.
+        """
+        group_files = None
+        filenames = list()
+        for date in get_days_list(self.start_date, self.end_date):
+            if self.sqlite_path is not None:
+                if sqlite_store.get_day_stamp(self.sqlite_path, date)[0]:
+                    filenames.append(('sqlite', self.sqlite_path, date))
+                continue
+            json_filename = join(self.messages_path, 'mensagens_%s.json' % (date))
+            if isfile(json_filename) or jsonl_writer.load_segments(json_filename):
+                filenames.append(('file', json_filename))
+                continue
+            if group_files is None:
+                group_files = jsonl_writer.list_segmented(self.group_path)
+            if any(jsonl_writer.get_segments(path, date, date + '~')
+                   for path in group_files):
+                filenames.append(('groups', self.group_path, date))
+        return filenames
+
+    def _map_daily_files(self, specs):
+        """
+        Aplica as etapas "map" a cada arquivo diário do período e retorna,
+        na ordem das datas, a lista de resultados de cada arquivo (um por
+        etapa). Cada arquivo é lido uma única vez para todas as etapas. Com
+        mais de um worker os arquivos são processados em um pool de
+        processos. Com cache, apenas as etapas sem resultado válido em cache
+        são calculadas.
 
         Parâmetros
         ------------
+            specs : list
+                Etapas a aplicar, cada uma no formato (nome, *parâmetros),
+                que também compõe a chave do cache.
+        """
+        filenames = self._get_daily_files()
+        cache_keys = [self._get_cache_key(spec) for spec in specs]
+        results = dict()
+        stamps = dict()
+        missing = list()
+        for filename in filenames:
+            # Taken before the file is read: records appended during the
+            # map change the stamp and invalidate the saved result
+            stamp = self._get_stamp(filename) if self.cache_path is not None else None
+            cached = [self._load_cached(filename, cache_key, stamp)
+                      for cache_key in cache_keys]
+            results[filename] = cached
+            stamps[filename] = stamp
+            missing_specs = tuple(spec for spec, result in zip(specs, cached)
+                                  if result is None)
+            CACHE_LOOKUPS.inc(len(specs) - len(missing_specs), result="hit")
+            CACHE_LOOKUPS.inc(len(missing_specs), result="miss")
+            if missing_specs:
+                missing.append((filename, missing_specs))
+                DAYS_READ.inc(result="mapped")
+            else:
+                DAYS_READ.inc(result="cached")
+
+        mapped = self._map_files(missing)
+        for filename in filenames:
+            cached = results.pop(filename)
+            stamp = stamps.pop(filename)
+            if any(result is None for result in cached):
+                computed = iter(next(mapped))
+                for i, cache_key in enumerate(cache_keys):
+                    if cached[i] is None:
+                        result = next(computed)
+                        self._save_cached(filename, cache_key, result, stamp)
+                        cached[i] = (result,)
+            yield [result[0] for result in cached]
+
+    def _map_files(self, tasks):
+        for result, seconds, count in self._map_files_timed(tasks):
+            MAP_SECONDS.observe(seconds)
+            MESSAGES_READ.inc(count)
+            yield result
+
+    def _map_files_timed(self, tasks):
+        if self.workers <= 1 or len(tasks) <= 1:
+            for filename, specs in tasks:
+                yield map_file(filename, specs)
+            return
+
+        with ProcessPoolExecutor(min(self.workers, len(tasks))) as executor:
+            for result in executor.map(map_file, *zip(*tasks)):
+                yield result
+
+    def _get_cache_key(self, spec):
+        """
+        Identifica o tipo de resultado parcial (etapa e parâmetros) no
+        nome dos arquivos de cache.
+        """
+        return hashlib.sha1(repr(spec).encode('utf-8')).hexdigest()[:16]
+
+    def _get_cache_filename(self, filename, cache_key):
+        if filename[0] == 'file':
+            name = basename(filename[1])
+        elif filename[0] == 'sqlite':
+            name = '%s_%s' % (basename(filename[1]), filename[2])
+        else:
+            name = 'mensagens_grupo_%s' % (filename[2])
+        return join(self.cache_path, '%s.%s.pickle' % (name, cache_key))
+
+    def _get_stamp(self, filename):
+        """
+        Identifica a versão dos dados de um dia: tamanho e data de
+        modificação dos arquivos e segmentos lidos ou, no banco de dados,
+        quantidade e maior rowid das mensagens do dia.
+        """
+        if filename[0] == 'sqlite':
+            return tuple(sqlite_store.get_day_stamp(*filename[1:]))
+        if filename[0] == 'groups':
+            date = filename[2]
+            return tuple(jsonl_writer.get_stamp(path, date, date + '~')
+                         for path in jsonl_writer.list_segmented(filename[1]))
+        return jsonl_writer.get_stamp(filename[1])
+
+    def _load_cached(self, filename, cache_key, stamp):
+        """
+        Retorna o resultado parcial em cache do arquivo (em uma tupla), ou
+        None caso não exista ou os dados do dia tenham sido alterados desde
+        que foram processados (stamp diferente do guardado).
+        """
+        if self.cache_path is None:
+            return None
+        cache_filename = self._get_cache_filename(filename, cache_key)
+        if not isfile(cache_filename):
+            return None
+
+        try:
+            with open(cache_filename, 'rb') as fcache:
+                cached = pickle.load(fcache)
+        except Exception:
+            return None
+        if cached.get('stamp') != stamp:
+            return None
+        return (cached['result'],)
+
+    def _save_cached(self, filename, cache_key, result, stamp):
+        """
+        Guarda o resultado parcial do arquivo com a versão dos dados (stamp)
+        obtida antes da leitura.
+        """
+        if self.cache_path is None:
+            return
+        os.makedirs(self.cache_path, exist_ok=True)
+        cache_filename = self._get_cache_filename(filename, cache_key)
+        with open(cache_filename + '.temp', 'wb') as fcache:
+            pickle.dump({'stamp': stamp, 'result': result}, fcache,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(cache_filename + '.temp', cache_filename)
+
+    def _get_default_output(self, media, output_format, output_path='/data/'):
+        return join(output_path, 'merged_data_%s-%s_%s-%s.%s' %
+                    (media, self.comparison_method, self.start_date,
+                     self.end_date, output_format))
+
+    def _get_refs_output(self, output):
+        """
+        Retorna o caminho do arquivo com as referências às mensagens de uma
+        sumarização no formato "jsonl" (e.g. saida.refs.jsonl).
+        """
+        root, extension = os.path.splitext(output)
+        return root + '.refs' + extension
+
+    def _write_summary(self, hashes, output, media, output_format):
+        """
+        Converte os conjuntos dos agregados em listas e escreve a
+        sumarização. No formato "jsonl" cada grupo é escrito em uma linha
+        (com sua chave em "key") à medida que é convertido, sem montar a
+        saída inteira em memória, e as referências às mensagens, movidas
+        para um arquivo temporário a cada dia, são copiadas para o arquivo
+        de referências (ver _get_refs_output()).
+
+        Parâmetros
+        ------------
+            hashes : dict
+                Agregados da sumarização.
             output : str
                 Caminho para o arquivo onde será escrita a sumarização.
+            media : str
+                Tipo de mídia (usado no nome padrão do arquivo).
+            output_format : str
+                Formato da saída ("json" ou "jsonl").
+        """
+        if output == 'default':
+            output = self._get_default_output(media, output_format)
+
+        if output_format == 'jsonl':
+            with open(output, 'w') as json_file:
+                for hash, summary in hashes.items():
+                    finish_summary(summary)
+                    summary.pop('message_refs', None)
+                    json_file.write(json.dumps(dict(key=hash, **summary)) + '\n')
+            if self.spill is not None:
+                self.spill.save(self._get_refs_output(output))
+                self.spill = None
+            return
+
+        # Convert sets to lists
+        for hash in hashes.keys():
+            finish_summary(hashes[hash])
+
+        with open(output, 'w') as json_file:
+            json.dump(hashes, json_file, indent=4)
+
+    def _media_job(self, hamming_radius=0, output_format='json'):
+        """
+        Prepara a sumarização de um tipo de mídia: retorna a etapa "map",
+        a função que combina o resultado parcial de cada dia ("reduce"), os
+        agregados e o nome da mídia. Retorna None se o tipo de mídia ou o
+        método não forem suportados.
         """
         if self.media_type == 'images':
             media = 'image'
@@ -105,99 +678,70 @@ class SummarizationUtil:
             hash_methods = ['checksum']
         else:
             print("Type of media not supported.")
-            return
+            return None
 
         if self.comparison_method not in hash_methods:
             print("Selected method is not compatible for the type of media.")
-            return
+            return None
 
         print('Grouping %s hashes of %s from %s to %s' %
               (self.comparison_method, self.media_type, self.start_date,
                self.end_date))
 
+        references = output_format == 'jsonl'
+        self.spill = ReferenceSpill() if references else None
         hashes = dict()
-        for date in get_days_list(self.start_date, self.end_date):
-            json_filename = 'mensagens_%s.json' % (date)
-            if not isfile(join(self.messages_path, json_filename)):
-                continue
-            with open(join(self.messages_path, json_filename), 'r') as fdata:
-                for line in fdata:
-                    message = json.loads(line.strip())
-
-                    kind = message['mediatype']
-
-                    if media == kind:
-                        if (media == 'image' or media == 'video' or
-                                media == 'audio' or media == 'other'):
-                            hash = message[self.comparison_method]
-
-                        if hash == "":
-                            continue
-
-                        if hash not in hashes:
-                            hashes[hash] = dict()
-                            hashes[hash][self.comparison_method] = hash
-                            hashes[hash]['first_share'] = message['data']
-                            hashes[hash]['total'] = 0
-                            hashes[hash]['total_groups'] = 0
-                            hashes[hash]['total_users'] = 0
-                            hashes[hash]['groups_shared'] = set()
-                            hashes[hash]['users_shared'] = set()
-                            hashes[hash]['filenames'] = set()
-                            hashes[hash]['messages'] = list()
-
-                        # ADD MESSAGE TO HASH
-                        if message['data'] < hashes[hash]['first_share']:
-                            hashes[hash]['first_share'] = message['data']
-                        hashes[hash]['total'] += 1
-                        hashes[hash]['groups_shared'].add(
-                            message['group_name'])
-                        hashes[hash]['users_shared'].add(message['sender'])
-                        hashes[hash]['filenames'].add(message['file'])
-                        hashes[hash]['messages'].append(message)
-                        hashes[hash]['total_groups'] = len(
-                            hashes[hash]['groups_shared'])
-                        hashes[hash]['total_users'] = len(
-                            hashes[hash]['users_shared'])
+        if self.comparison_method == 'phash' and hamming_radius > 0:
+            index = HammingIndex(hamming_radius)
+            spec = ('filter_media', media, self.comparison_method, references)
 
-        # Convert sets to lists
-        for hash in hashes:
-            hashes[hash]["groups_shared"] = list(hashes[hash]["groups_shared"])
-            hashes[hash]["users_shared"] = list(hashes[hash]["users_shared"])
-            hashes[hash]["filenames"] = list(hashes[hash]["filenames"])
+            def reduce(messages):
+                touched = dict()
+                for message in messages:
+                    member = hash = message[self.comparison_method]
+                    if member is not None:
+                        # Group under the first phash within the radius
+                        value = int(member, 16)
+                        hash = index.match(value)
+                        if hash is None:
+                            hash = member
+                            index.insert(hash, value)
 
-        if output == 'default':
-            output = '/data/merged_data_%s-%s_%s-%s.json' % \
-                (media, self.comparison_method, self.start_date, self.end_date)
-        with open(output, 'w') as json_file:
-            json.dump(hashes, json_file, indent=4)
+                    if hash not in hashes:
+                        hashes[hash] = new_media_summary(
+                            self.comparison_method, hash, message, references)
+                        hashes[hash]['members'] = dict()
+                    add_media_message(hashes[hash], message)
+                    hashes[hash]['members'][member] = None
+                    touched[hash] = None
+                if self.spill is not None:
+                    self.spill.spill(hashes, touched)
+        else:
+            spec = ('summarize_media', media, self.comparison_method,
+                    references)
 
-        return hashes
+            def reduce(partial_hashes):
+                for hash, summary in partial_hashes.items():
+                    if hash not in hashes:
+                        hashes[hash] = summary
+                    else:
+                        merge_media_summary(hashes[hash], summary)
+                if self.spill is not None:
+                    self.spill.spill(hashes, partial_hashes)
 
-    def generate_text_summarization(self, output='default', min_size=200,
-                                    threshold=0.75):
-        """
-        Faz a sumarização das mensagens de texto. Calcula
-        informações como primeira vez em que a mídia foi compartilhada,
-        quantas vezes foi compartilhada, em que grupos, por quais usuários,
-        etc.
+        return spec, reduce, hashes, media
 
-        Parâmetros
-        ------------
-            output : str
-                Caminho para o arquivo onde será escrita a sumarização.
-            min_size : str
-                Tamanho mínimo do texto das mensagens agrupadas.
-            threshold : str
-                Valor mínimo de similariade para o índice de Jaccard para
-                considerar duas mensagens como iguais.
+    def _text_job(self, min_size=200, threshold=0.75, verification='minhash',
+                  num_perm=128, bands=32, shingle_size=5, output_format='json'):
+        """
+        Prepara a sumarização de textos, no mesmo formato de _media_job().
         """
         if self.media_type == 'texts':
             media = 'text'
-            hash_methods = ['jaccard']
+            hash_methods = ['jaccard', 'minhash']
         else:
             print("Type of media not supported.")
-            return
+            return None
 
         if self.comparison_method not in hash_methods:
             print("Selected method is not compatible for the type of media. "
@@ -207,22 +751,32 @@ class SummarizationUtil:
               (self.comparison_method, self.media_type, self.start_date,
                self.end_date))
 
+        index = None
+        index_params = None
+        if self.comparison_method == 'minhash':
+            index_params = (threshold, num_perm, bands, shingle_size,
+                            verification)
+            index = MinHashLSH(*index_params)
+
+        references = output_format == 'jsonl'
+        self.spill = ReferenceSpill() if references else None
         hashes = dict()
-        for date in get_days_list(self.start_date, self.end_date):
-            json_filename = 'mensagens_%s.json' % (date)
-            if not isfile(join(self.messages_path, json_filename)):
-                continue
-            with open(join(self.messages_path, json_filename), 'r') as fdata:
-                for line in fdata:
-                    message = json.loads(line.strip())
+        spec = ('filter_text', min_size, index_params, references)
 
-                    text = message['content']
+        def reduce(records):
+            touched = dict()
+            for message, features in records:
+                text = message['content']
 
-                    if len(text) < min_size:
-                        continue
-                    isNew = True
-                    mID = message['message_id']
-                    hashstring = mID
+                isNew = True
+                mID = message['message_id']
+                hashstring = mID
+                if index is not None:
+                    ID = index.match(features)
+                    if ID is not None:
+                        isNew = False
+                        hashstring = ID
+                else:
                     for ID in hashes.keys():
                         text2 = hashes[ID]['text']
                         score = compare_texts(text, text2)
@@ -231,58 +785,202 @@ class SummarizationUtil:
                             hashstring = ID
                             break
 
-                    if isNew:
-                        hashes[hashstring] = dict()
-                        hashes[hashstring]['first_share'] = message['data']
-                        hashes[hashstring]['total'] = 0
-                        hashes[hashstring]['total_groups'] = 0
-                        hashes[hashstring]['total_users'] = 0
-                        hashes[hashstring]['groups_shared'] = set()
-                        hashes[hashstring]['users_shared'] = set()
-                        hashes[hashstring]['messages_IDs'] = list()
-                        hashes[hashstring]['filenames'] = list()
-                        hashes[hashstring]['text'] = text
-                        hashes[hashstring]['messages'] = list()
-
-                    # ADD MESSAGE TO HASH
-                    if message['data'] < hashes[hashstring]['first_share']:
-                        hashes[hashstring]['first_share'] = message['data']
-                    hashes[hashstring]['total'] += 1
-                    hashes[hashstring]['groups_shared'].add(
-                        message['group_name'])
-                    hashes[hashstring]['users_shared'].add(message['sender'])
-                    hashes[hashstring]['messages_IDs'].append(message['message_id'])
-                    hashes[hashstring]['messages'].append(message)
-                    hashes[hashstring]['total_groups'] = len(
-                        hashes[hashstring]['groups_shared'])
-                    hashes[hashstring]['total_users'] = len(
-                        hashes[hashstring]['users_shared'])
+                if isNew:
+                    hashes[hashstring] = new_text_summary(text, message,
+                                                          references)
+                    if index is not None:
+                        index.insert(hashstring, features)
 
-        # Convert sets to lists
-        for hash in hashes.keys():
-            hashes[hash]["groups_shared"] = list(hashes[hash]["groups_shared"])
-            hashes[hash]["users_shared"] = list(hashes[hash]["users_shared"])
+                # ADD MESSAGE TO HASH
+                add_text_message(hashes[hashstring], message)
+                touched[hashstring] = None
+            if self.spill is not None:
+                self.spill.spill(hashes, touched)
 
-        if output == 'default':
-            output = '/data/merged_data_%s-%s_%s-%s.json' % \
-                (media, self.comparison_method, self.start_date, self.end_date)
-        with open(output, 'w') as json_file:
-            json.dump(hashes, json_file, indent=4)
+        return spec, reduce, hashes, media
+
+    def _run_jobs(self, jobs):
+        """
+        Lê os arquivos diários uma única vez e combina, dia a dia, o
+        resultado parcial de cada sumarização.
+        """
+        for results in self._map_daily_files([job[0] for job in jobs]):
+            for job, result in zip(jobs, results):
+                with REDUCE_SECONDS.time(stage=job[0][0]):
+                    job[1](result)
+
+    def generate_media_summarization(self, output='default', hamming_radius=0,
+                                     output_format='json'):
+        """
+        Faz a sumarização das mensagens de um certo tipo de mídia. Calcula
+        informações como primeira vez em que a mídia foi compartilhada,
+        quantas vezes foi compartilhada, em que grupos, por quais usuários,
+        etc.
+
+        Parâmetros
+        ------------
+            output : str
+                Caminho para o arquivo onde será escrita a sumarização.
+            hamming_radius : int
+                Distância de Hamming máxima entre phashes agrupados (método
+                "phash"). Com raio zero apenas phashes idênticos são
+                agrupados; com raio positivo cada grupo lista os phashes
+                que o compõem em "members".
+            output_format : str
+                Formato da saída: "json" (um único objeto com as mensagens
+                completas) ou "jsonl" (um grupo por linha, escrito em
+                streaming, com as referências às mensagens no arquivo
+                <saída>.refs.jsonl, uma linha por grupo e dia).
+        """
+        job = self._media_job(hamming_radius, output_format)
+        if job is None:
+            return
+
+        self._run_jobs([job])
+        _, _, hashes, media = job
+        self._write_summary(hashes, output, media, output_format)
 
         return hashes
 
+    def generate_text_summarization(self, output='default', min_size=200,
+                                    threshold=0.75, verification='minhash',
+                                    num_perm=128, bands=32, shingle_size=5,
+                                    output_format='json'):
+        """
+        Faz a sumarização das mensagens de texto. Calcula
+        informações como primeira vez em que a mídia foi compartilhada,
+        quantas vezes foi compartilhada, em que grupos, por quais usuários,
+        etc. Com o método "minhash", os textos similares são encontrados por
+        um índice MinHash/LSH em vez da comparação com todos os grupos.
+
+        Parâmetros
+        ------------
+            output : str
+                Caminho para o arquivo onde será escrita a sumarização.
+            min_size : str
+                Tamanho mínimo do texto das mensagens agrupadas.
+            threshold : str
+                Valor mínimo de similariade para o índice de Jaccard para
+                considerar duas mensagens como iguais. No método "jaccard" o
+                índice é calculado entre os conjuntos de caracteres dos
+                textos; no método "minhash", entre os conjuntos de shingles,
+                que só coincidem em textos bem mais parecidos. O mesmo limiar
+                é, portanto, mais restritivo no método "minhash".
+            verification : str
+                Verificação dos candidatos do método "minhash": similaridade
+                estimada pelas assinaturas ("minhash") ou Jaccard exato
+                entre os shingles ("exact"). Nenhuma das duas reproduz a
+                comparação do método "jaccard".
+            num_perm : int
+                Tamanho das assinaturas MinHash.
+            bands : int
+                Número de faixas do índice LSH.
+            shingle_size : int
+                Número de caracteres de cada shingle.
+            output_format : str
+                Formato da saída: "json" (um único objeto com as mensagens
+                completas) ou "jsonl" (um grupo por linha, escrito em
+                streaming, com as referências às mensagens no arquivo
+                <saída>.refs.jsonl, uma linha por grupo e dia).
+        """
+        job = self._text_job(min_size, threshold, verification, num_perm,
+                             bands, shingle_size, output_format)
+        if job is None:
+            return
+
+        self._run_jobs([job])
+        _, _, hashes, media = job
+        self._write_summary(hashes, output, media, output_format)
+
+        return hashes
+
+    def generate_summarizations(self, targets, output_path='/data/',
+                                output_format='json', hamming_radius=0,
+                                **text_params):
+        """
+        Gera várias sumarizações (tipos de mídia e métodos) do mesmo
+        período lendo os arquivos diários uma única vez. Cada sumarização é
+        escrita em seu próprio arquivo, com o nome padrão, na pasta de
+        saída. Alvos não suportados são ignorados.
+
+        Parâmetros
+        ------------
+            targets : list
+                Pares (tipo de mídia, método), e.g. ("images", "phash").
+            output_path : str
+                Pasta onde serão escritas as sumarizações.
+            output_format : str
+                Formato da saída ("json" ou "jsonl").
+            hamming_radius : int
+                Distância de Hamming máxima entre phashes agrupados.
+            text_params : dict
+                Parâmetros da sumarização de textos (min_size, threshold,
+                verification, num_perm, bands, shingle_size).
+        """
+        utils = list()
+        jobs = list()
+        for media_type, comparison_method in targets:
+            util = SummarizationUtil(media_type, comparison_method,
+                                     self.start_date, self.end_date,
+                                     self.messages_path, self.workers,
+                                     self.cache_path, self.sqlite_path,
+                                     self.group_path)
+            if media_type == 'texts':
+                job = util._text_job(output_format=output_format,
+                                     **text_params)
+            else:
+                job = util._media_job(hamming_radius, output_format)
+            if job is not None:
+                utils.append(util)
+                jobs.append(job)
+
+        self._run_jobs(jobs)
+
+        summaries = dict()
+        for util, (_, _, hashes, media) in zip(utils, jobs):
+            output = util._get_default_output(media, output_format, output_path)
+            util._write_summary(hashes, output, media, output_format)
+            summaries[(util.media_type, util.comparison_method)] = hashes
+
+        return summaries
+
+    def find_messages(self, field, value):
+        """
+        Busca no banco de dados, pelos índices, as mensagens do período com
+        um valor de checksum, phash, grupo ou usuário, sem percorrer as
+        mensagens do período.
+
+        Parâmetros
+        ------------
+            field : str
+                Campo da busca (checksum, phash, group_id ou sender).
+            value : object
+                Valor buscado.
+        """
+        if self.sqlite_path is None:
+            raise ValueError('Message lookups require a sqlite database')
+        return sqlite_store.find_messages(self.sqlite_path, field, value,
+                                          self.start_date, self.end_date)
+
 
 def main():
     parser = argparse.ArgumentParser()
 
     parser.add_argument("-t", "--media_type", type=str,
                         help="Tipo de mídia para gerar a sumarização (images,"
-                        " audios, videos, 'texts', others).", required=True)
+                        " audios, videos, 'texts', others).", default=None)
 
     parser.add_argument("-m", "--comparison_method", type=str,
                         help="Metódo para calcular a similaridade/igualdade"
-                        " entre mídias (checksum, phash, jaccard).",
-                        required=True)
+                        " entre mídias (checksum, phash, jaccard, minhash).",
+                        default=None)
+
+    parser.add_argument("--targets", type=str, nargs='+',
+                        help="Sumarizações geradas em uma única leitura dos"
+                        " arquivos, no formato tipo:método (e.g. images:phash"
+                        " videos:checksum texts:minhash). Substitui -t e -m;"
+                        " a saída (-o) passa a ser a pasta das sumarizações.",
+                        default=None)
 
     parser.add_argument("-s", "--start_date", type=str,
                         help="Data de início da sumarização.",
@@ -298,15 +996,98 @@ def main():
                         help="Arquivo de saída para as mensagens salvas",
                         default='default')
 
+    parser.add_argument("--verification", type=str,
+                        help="Verificação dos candidatos do método minhash"
+                        " (\'minhash\' ou \'exact\'). Ambas medem o Jaccard"
+                        " entre os shingles de shingle_size caracteres, e não"
+                        " entre os conjuntos de caracteres como o método"
+                        " jaccard: o mesmo limiar agrupa apenas textos mais"
+                        " parecidos.", default='minhash')
+
+    parser.add_argument("--num_perm", type=int,
+                        help="Tamanho das assinaturas MinHash.", default=128)
+
+    parser.add_argument("--bands", type=int,
+                        help="Número de faixas do índice LSH.", default=32)
+
+    parser.add_argument("--shingle_size", type=int,
+                        help="Número de caracteres de cada shingle.",
+                        default=5)
+
+    parser.add_argument("--hamming_radius", type=int,
+                        help="Distância de Hamming máxima entre phashes"
+                        " agrupados (0 agrupa apenas phashes idênticos).",
+                        default=0)
+
+    parser.add_argument("-f", "--output_format", type=str,
+                        help="Formato da saída (\'json\' ou \'jsonl\', um"
+                        " grupo por linha, com as referências às mensagens"
+                        " em <saída>.refs.jsonl).",
+                        default='json')
+
+    parser.add_argument("-p", "--workers", type=int,
+                        help="Número de processos usados na leitura dos"
+                        " arquivos diários.", default=1)
+
+    parser.add_argument("-c", "--cache_path", type=str,
+                        help="Pasta do cache de resultados parciais por dia"
+                        " (e.g. /data/summarization_cache/). Sem essa opção"
+                        " o cache não é usado.", default=None)
+
+    parser.add_argument("--sqlite_path", type=str,
+                        help="Banco de dados do modo de escrita \'sqlite\'"
+                        " (e.g. /data/telegram.db), lido em vez dos arquivos"
+                        " diários.", default=None)
+
+    parser.add_argument("--metrics_port", type=int,
+                        help="Porta do endpoint de métricas no formato do"
+                        " Prometheus durante a sumarização (0 desativa).",
+                        default=0)
+
     args = parser.parse_args()
 
+    targets = None
+    if args.targets is not None:
+        targets = [tuple(target.split(':')) for target in args.targets]
+        if any(len(target) != 2 for target in targets):
+            parser.error('targets must be in the format type:method')
+    elif args.media_type is None or args.comparison_method is None:
+        parser.error('the following arguments are required: -t/--media_type,'
+                     ' -m/--comparison_method (or --targets)')
+
+    metrics_server = None
+    if args.metrics_port:
+        metrics_server = metrics.start_server(args.metrics_port)
+
     try:
+        if targets is not None:
+            util = SummarizationUtil(None, None, args.start_date,
+                                     args.end_date, workers=args.workers,
+                                     cache_path=args.cache_path,
+                                     sqlite_path=args.sqlite_path)
+            output_path = '/data/' if args.output == 'default' else args.output
+            util.generate_summarizations(
+                targets, output_path, output_format=args.output_format,
+                hamming_radius=args.hamming_radius,
+                verification=args.verification, num_perm=args.num_perm,
+                bands=args.bands, shingle_size=args.shingle_size)
+            return
+
         util = SummarizationUtil(args.media_type, args.comparison_method,
-                                 args.start_date, args.end_date)
+                                 args.start_date, args.end_date,
+                                 workers=args.workers,
+                                 cache_path=args.cache_path,
+                                 sqlite_path=args.sqlite_path)
         if args.media_type in ['audios', 'images', 'videos', 'others']:
-            util.generate_media_summarization(args.output)
+            util.generate_media_summarization(args.output,
+                                              hamming_radius=args.hamming_radius,
+                                              output_format=args.output_format)
         elif args.media_type in ['texts']:
-            util.generate_text_summarization(args.output)
+            util.generate_text_summarization(
+                args.output, verification=args.verification,
+                num_perm=args.num_perm, bands=args.bands,
+                shingle_size=args.shingle_size,
+                output_format=args.output_format)
 
     except Exception as e:
         error_time = str(datetime.datetime.now())
@@ -314,6 +1095,8 @@ def main():
         with open('/data/log.txt', 'w') as ferror:
             print("%s >> Error:\t%s" % (error_time, error_msg))
             print("%s >> Error:\t%s" % (error_time, error_msg), file=ferror)
+    finally:
+        metrics.stop_server(metrics_server)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import json
+import os
+
+
+class DialogWatermarks():
+    """
+    Guarda, para cada grupo ou canal, o intervalo contínuo de mensagens já
+    percorrido pela coleta de histórico. Permite que uma nova execução peça
+    à API apenas as mensagens mais novas que a última coletada e continue a
+    coleta do passado a partir da mensagem mais antiga alcançada.
+
+    Cada marca é um dicionário com os campos:
+        max_id : id da mensagem mais nova do intervalo percorrido.
+        min_id : id da mensagem mais antiga do intervalo percorrido.
+        covered_since : data a partir da qual todo o histórico até max_id
+            foi percorrido ("%Y-%m-%d %H:%M:%S").
+        complete : se o início do histórico do grupo foi alcançado.
+
+    Atributos
+    -----------
+    path : str
+            Caminho do arquivo json com as marcas.
+
+    Métodos
+    -----------
+    get(key)
+        Retorna a marca de um grupo (ou None).
+    set(key, mark)
+        Atualiza a marca de um grupo.
+    save()
+        Escreve as marcas em disco de forma atômica.
+    """
+
+    def __init__(self, path='/data/watermarks.json'):
+        self.path = path
+        self.marks = dict()
+        if os.path.isfile(path):
+            with open(path, 'r') as json_file:
+                self.marks = json.load(json_file)
+
+    def get(self, key):
+        return self.marks.get(key)
+
+    def set(self, key, mark):
+        self.marks[key] = mark
+
+    def save(self):
+        with open(self.path + '.temp', 'w') as json_file:
+            json.dump(self.marks, json_file)
+        os.replace(self.path + '.temp', self.path)
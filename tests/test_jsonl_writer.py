@@ -0,0 +1,71 @@
+import gzip
+import os
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import unittest
+
+SOURCE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'source')
+sys.path.insert(0, SOURCE_PATH)
+
+import jsonl_writer
+
+# Writes 25 records (flushing every 10) and is killed before closing the
+# segment, leaving its gzip member without a trailer
+KILLED_WRITER = '''
+import os, signal, sys
+sys.path.insert(0, %r)
+import jsonl_writer
+writer = jsonl_writer.JsonlWriter(max_buffered=10, compression='gzip')
+for i in range(25):
+    writer.write(%r, {'i': i}, '2020-01-01 00:00:00')
+os.kill(os.getpid(), signal.SIGKILL)
+'''
+
+
+class KilledWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'mensagens_grupo_1.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _read(self):
+        return [record['i'] for record in jsonl_writer.read_records(self.path)]
+
+    def test_restart_after_kill(self):
+        process = subprocess.run(
+            [sys.executable, '-c', KILLED_WRITER % (SOURCE_PATH, self.path)])
+        self.assertEqual(process.returncode, -signal.SIGKILL)
+        self.assertEqual(self._read(), list(range(20)))
+
+        writer = jsonl_writer.JsonlWriter(compression='gzip')
+        for i in range(100, 105):
+            writer.write(self.path, {'i': i}, '2020-01-01 00:00:00')
+        writer.close()
+
+        self.assertEqual(len(jsonl_writer.load_segments(self.path)), 2)
+        self.assertEqual(self._read(), list(range(20)) + list(range(100, 105)))
+
+    def test_read_member_appended_to_truncated_member(self):
+        # Segments written before a restart started a new segment
+        segment_path = jsonl_writer.get_segment_path(self.path, 0)
+        compressor = gzip.zlib.compressobj(wbits=31)
+        truncated = compressor.compress(b'{"i": 0}\n{"i": 1}\n{"i"')
+        truncated += compressor.flush(gzip.zlib.Z_SYNC_FLUSH)
+        with open(segment_path, 'wb') as segment_file:
+            segment_file.write(truncated)
+            segment_file.write(gzip.compress(b'{"i": 2}\n'))
+        with open(jsonl_writer.get_index_path(self.path), 'w') as index_file:
+            index_file.write('[{"file": "%s", "start": null, "end": null}]' % (
+                os.path.basename(segment_path)))
+
+        self.assertEqual(self._read(), [0, 1])
+
+
+if __name__ == '__main__':
+    unittest.main()